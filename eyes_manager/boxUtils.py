@@ -0,0 +1,231 @@
+"""
+The purpose of this module is to implement vectorized operations on boxes,
+shared by the detectors and the stream processors.
+
+A batch of N boxes is a (N, 4) array of integers
+
+    [[left, top, right, bottom], ...]
+
+All pairwise measures are computed at once as (N, M) matrices with numpy
+broadcasting, instead of python loops over the pairs of boxes.
+
+The functions take an offset argument: with offset = 0, right and bottom are
+excluded from the box (as with opencv rectangles x + w), with offset = 1 they
+are included (as with dlib rectangles).
+
+The detectors, the stream processors and the position finders exchange
+detections as a batch, i.e. a structured array of dtype DETECTION with fields
+
+    box: the [left, top, right, bottom] box (int32),
+    score: the score of the detection (float32),
+    detector: the index of the detector that found it (int16),
+    track: the index of the tracker that follows it, -1 if none (int32).
+
+detections['box'] is a (N, 4) view on the boxes of the batch, so that the
+functions above apply to batches without copy. toLocations converts a batch
+into the former list of 4-corner locations.
+"""
+
+###############################################################################
+# Imports.
+###############################################################################
+
+# Packages for numeric computations.
+import numpy as np
+
+
+###############################################################################
+# Definition of global variables.
+###############################################################################
+
+DETECTION = np.dtype([('box', np.int32, (4,)), ('score', np.float32), ('detector', np.int16), ('track', np.int32)])
+
+
+###############################################################################
+# Main content of the module.
+###############################################################################
+
+def detections(boxes, scores = 1.0, detectors = 0, tracks = -1):
+    """
+    Creates a batch of detections.
+
+    :param boxes: The (N, 4) array of boxes.
+    :param scores: The score of each detection, or a score for all of them.
+    :param detectors: The detector of each detection, or a detector for all of them.
+    :param tracks: The tracker of each detection, or a tracker for all of them.
+    :return: The (N,) structured array of dtype DETECTION.
+    """
+    boxes = np.asarray(boxes).reshape((-1, 4))
+    batch = np.empty(len(boxes), dtype = DETECTION)
+    batch['box'] = np.rint(boxes) if boxes.dtype.kind == 'f' else boxes
+    batch['score'] = scores
+    batch['detector'] = detectors
+    batch['track'] = tracks
+    return batch
+
+
+def toBoxes(locations):
+    """
+    Converts locations [[[x1, y1], [x2, y2], [x3, y3], [x4, y4]]] into the
+    (N, 4) array of their bounding boxes.
+
+    :param locations: The list or array of locations.
+    :return: The (N, 4) array [[left, top, right, bottom]].
+    """
+    locations = np.asarray(locations)
+    if len(locations) == 0:
+        return np.zeros((0, 4), dtype = int)
+    return np.concatenate((locations.min(axis = 1), locations.max(axis = 1)), axis = 1)
+
+
+def toLocations(boxes):
+    """
+    Converts a (N, 4) array of boxes or a batch of detections into locations
+    [[[x1, y1], [x2, y2], [x3, y3], [x4, y4]]].
+
+    :param boxes: The (N, 4) array [[left, top, right, bottom]], or the batch of detections.
+    :return: The list of locations [[left, top], [left, bottom], [right, bottom], [right, top]].
+    """
+    boxes = np.asarray(boxes)
+    if boxes.dtype.names is not None:
+        boxes = boxes['box']
+    return [[[left, top], [left, bottom], [right, bottom], [right, top]] for (left, top, right, bottom) in boxes.reshape((-1, 4)).tolist()]
+
+
+def areas(boxes, offset = 0):
+    """
+    Computes the area of each box.
+
+    :param boxes: The (N, 4) array of boxes.
+    :param offset: 1 if right and bottom are included in the boxes, 0 otherwise.
+    :return: The (N,) array of areas.
+    """
+    boxes = np.asarray(boxes)
+    return np.maximum(boxes[:, 2] - boxes[:, 0] + offset, 0) * np.maximum(boxes[:, 3] - boxes[:, 1] + offset, 0)
+
+
+def intersections(boxes_1, boxes_2, offset = 0):
+    """
+    Computes the area of the intersection of each pair of boxes.
+
+    :param boxes_1: The (N, 4) array of boxes.
+    :param boxes_2: The (M, 4) array of boxes.
+    :param offset: 1 if right and bottom are included in the boxes, 0 otherwise.
+    :return: The (N, M) array of areas.
+    """
+    boxes_1 = np.asarray(boxes_1)[:, np.newaxis, :]
+    boxes_2 = np.asarray(boxes_2)[np.newaxis, :, :]
+    width = np.minimum(boxes_1[..., 2], boxes_2[..., 2]) - np.maximum(boxes_1[..., 0], boxes_2[..., 0]) + offset
+    height = np.minimum(boxes_1[..., 3], boxes_2[..., 3]) - np.maximum(boxes_1[..., 1], boxes_2[..., 1]) + offset
+    return np.maximum(width, 0) * np.maximum(height, 0)
+
+
+def iou(boxes_1, boxes_2, offset = 0):
+    """
+    Computes the intersection over union of each pair of boxes.
+
+    :param boxes_1: The (N, 4) array of boxes.
+    :param boxes_2: The (M, 4) array of boxes.
+    :param offset: 1 if right and bottom are included in the boxes, 0 otherwise.
+    :return: The (N, M) array of intersections over unions, 0 for empty unions.
+    """
+    intersection = intersections(boxes_1, boxes_2, offset)
+    union = areas(boxes_1, offset)[:, np.newaxis] + areas(boxes_2, offset)[np.newaxis, :] - intersection
+    return np.divide(intersection, union, out = np.zeros(intersection.shape), where = union > 0)
+
+
+def containment(boxes_1, boxes_2, offset = 0):
+    """
+    Computes the fraction of each box of boxes_1 contained in each box of boxes_2.
+
+    :param boxes_1: The (N, 4) array of boxes.
+    :param boxes_2: The (M, 4) array of boxes.
+    :param offset: 1 if right and bottom are included in the boxes, 0 otherwise.
+    :return: The (N, M) array of fractions of the area of boxes_1[i] inside boxes_2[j], 0 for empty boxes.
+    """
+    intersection = intersections(boxes_1, boxes_2, offset)
+    area = np.broadcast_to(areas(boxes_1, offset)[:, np.newaxis], intersection.shape)
+    return np.divide(intersection, area, out = np.zeros(intersection.shape), where = area > 0)
+
+
+def strictlyInside(boxes_1, boxes_2):
+    """
+    Computes whether each box of boxes_1 is strictly inside each box of boxes_2.
+
+    :param boxes_1: The (N, 4) array of boxes.
+    :param boxes_2: The (M, 4) array of boxes.
+    :return: The (N, M) boolean array.
+    """
+    boxes_1 = np.asarray(boxes_1)[:, np.newaxis, :]
+    boxes_2 = np.asarray(boxes_2)[np.newaxis, :, :]
+    return np.all(boxes_1[..., :2] > boxes_2[..., :2], axis = 2) & np.all(boxes_1[..., 2:] < boxes_2[..., 2:], axis = 2)
+
+
+def nms(boxes, scores = None, threshold = 0.5, metric = 'iou', offset = 0):
+    """
+    Applies a non maxima suppression: the boxes are browsed by decreasing score,
+    and each kept box suppresses the remaining boxes overlapping it by more than
+    the threshold. The overlaps are computed once, as a matrix.
+
+    :param boxes: The (N, 4) array of boxes.
+    :param scores: The (N,) array of scores. By default, the boxes are browsed by decreasing bottom, the last boxes first for equal bottoms.
+    :param threshold: The overlap above which a box is suppressed.
+    :param metric: 'iou' to measure the overlap with the intersection over union, 'containment' with the fraction of the suppressed box inside the kept box.
+    :param offset: 1 if right and bottom are included in the boxes, 0 otherwise.
+    :return: The (K,) array of the indexes of the kept boxes, in the order in which they were kept.
+    """
+    boxes = np.asarray(boxes)
+    if len(boxes) == 0:
+        return np.zeros(0, dtype = int)
+    # Browse the boxes by decreasing score, the first boxes first for equal scores.
+    if scores is None:
+        order = np.argsort(boxes[:, 3], kind = 'stable')[::-1]
+    else:
+        order = np.argsort(-np.asarray(scores, dtype = float), kind = 'stable')
+    # overlaps[i, j] is the overlap of the box j with the box i.
+    if metric == 'iou':
+        overlaps = iou(boxes, boxes, offset)
+    else:
+        overlaps = containment(boxes, boxes, offset).T
+    suppressed = np.zeros(len(boxes), dtype = bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= overlaps[i] > threshold
+    return np.array(keep, dtype = int)
+
+
+def fuse(boxes_list, scores_list = None, threshold = 0.5, offset = 0):
+    """
+    Fuses the boxes found by several detectors: the boxes of all detectors
+    overlapping by more than the threshold (intersection over union) are
+    grouped around the box with the best score, and each group is replaced by
+    the average of its boxes weighted by their scores.
+
+    :param boxes_list: The list of the (N_k, 4) arrays of boxes of each detector.
+    :param scores_list: The list of the (N_k,) arrays of scores of each detector. By default, all scores are 1.
+    :param threshold: The intersection over union above which boxes are grouped.
+    :param offset: 1 if right and bottom are included in the boxes, 0 otherwise.
+    :return: A tuple (boxes, scores, detectors) of the (K, 4) array of fused boxes, the (K,) array of their best scores, and the (K,) array of the index of the detector of their best box.
+    """
+    boxes_list = [np.asarray(boxes).reshape((-1, 4)) for boxes in boxes_list]
+    if scores_list is None:
+        scores_list = [np.ones(len(boxes)) for boxes in boxes_list]
+    boxes = np.concatenate(boxes_list) if len(boxes_list) > 0 else np.zeros((0, 4), dtype = int)
+    scores = np.concatenate([np.asarray(scores, dtype = float).reshape(-1) for scores in scores_list]) if len(scores_list) > 0 else np.zeros(0)
+    detectors = np.repeat(np.arange(len(boxes_list)), [len(boxes) for boxes in boxes_list])
+    if len(boxes) == 0:
+        return (boxes.astype(int), scores, detectors)
+    # Assign each box to the group of the first kept box it overlaps.
+    overlaps = iou(boxes, boxes, offset)
+    np.fill_diagonal(overlaps, 1)
+    keep = nms(boxes, scores, threshold, 'iou', offset)
+    groups = np.argmax(overlaps[keep] > threshold, axis = 0)
+    # Average the boxes of each group, weighted by scores.
+    weights = np.maximum(scores, 1e-12)
+    sums = np.zeros((len(keep), 4))
+    np.add.at(sums, groups, boxes * weights[:, np.newaxis])
+    fused = np.rint(sums / np.bincount(groups, weights = weights, minlength = len(keep))[:, np.newaxis]).astype(int)
+    return (fused, scores[keep], detectors[keep])
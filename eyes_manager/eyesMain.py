@@ -6,6 +6,12 @@ This is the main module for the eyes application.
 # Imports.
 ################################################################################
 
+# Shared video sources.
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_manager'))
+import frameBus
+
 # Packages.
 import peopleDetector
 import streamProcessorEyes
@@ -23,17 +29,26 @@ if __name__ == '__main__':
     # Define detector.
     detector = peopleDetector.peopleDetectorDlib()
 
-    # Define video stream.
-    video_stream = streamProcessorEyes.webcamStream()
+    # Define video stream. Use the frames of the frame bus if its daemon is running (see frameBus.py), so that the webcam is shared with the face recognition application.
+    try:
+        video_stream = frameBus.frameBusStream()
+    except FileNotFoundError:
+        video_stream = streamProcessorEyes.webcamStream()
 
     # Define stream processor based on the video stream and the detector.
     stream_processor = streamProcessorEyes.streamProcessorFromDetector(video_stream, detector)
     #stream_processor = streamProcessorEyes.streamProcessorWithTracker(video_stream, detector, nb_trackers = 5, tracking_time = 100, resize_factor = 2, process_every = 2)
+    #stream_processor = streamProcessorEyes.streamProcessorWithTrackingEngine(video_stream, detector, nb_trackers = 5, resize_factor = 2, track_factor = 2, detect_every = 10)
+
+    # Run the capture and the detection in the background, so that the rendering never waits for them.
+    stream_processor = streamProcessorEyes.asyncStreamProcessor(stream_processor)
 
     # Define position finder based on the stream processor.
     # position_finder = positionFinder.videoStreamFinder(video_stream, detector)
     # position_finder = positionFinder.deterministicFinder()
-    position_finder = positionFinder.positionFinderFromStreamProcessor(stream_processor)
+    # position_finder = positionFinder.positionFinderFromStreamProcessor(stream_processor)
+    # The Kalman filters predict the position between detections, at the rendering rate of the eye model.
+    position_finder = positionFinder.kalmanPositionFinder(stream_processor)
 
     # Define eye model based on the position finder.
     eye_model = eyeModel.basicEye(position_finder.getCurrentPosition)
@@ -42,5 +57,6 @@ if __name__ == '__main__':
     # Run eye model.
     eye_model.run()
 
-    # Release handle to the webcam (does not work apparently).
+    # Stop the detection, and release handle to the webcam (does not work apparently).
+    stream_processor.close()
     video_stream.close()
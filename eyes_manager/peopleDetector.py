@@ -10,7 +10,14 @@ The detectors must implement the function
     getLocations(image)
 
 which takes an image as argument and returns the locations of detected people in
-the image.
+the image, as a batch of detections (see boxUtils.py).
+
+peopleDetectorDlib runs all its fHOG detectors on a single image pyramid, and
+getScoredLocations returns the score and the detector of each detection before
+they are fused. Running this module benchmarks the single pyramid evaluation
+against the evaluation of each detector on its own pyramid:
+
+    python peopleDetector.py video.mp4 --frames 100
 """
 
 ###############################################################################
@@ -22,6 +29,9 @@ import cv2
 import dlib
 import numpy as np
 
+# Vectorized operations on boxes.
+import boxUtils
+
 
 ###############################################################################
 # Definition of global variables.
@@ -39,69 +49,98 @@ class peopleDetectorDlib:
     """
     A class for the detection of people using Dlib.
     """
-    def __init__(self, detectors = [dlib.fhog_object_detector('dlib_pedestrian_detector.svm'), dlib.get_frontal_face_detector()]):
+    def __init__(self, detectors = [dlib.fhog_object_detector('dlib_pedestrian_detector.svm'), dlib.get_frontal_face_detector()], fusion_threshold = 0.5, single_pass = True):
         """
         Initialization of the class.
 
         :param detectors: An array of detectors.
+        :param fusion_threshold: The locations of different detectors whose intersection over union is above this threshold are fused.
+        :param single_pass: Whether to run all the detectors on a single image pyramid, with dlib.fhog_object_detector.run_multiple. Otherwise, each detector builds its own pyramid.
         """
         self.detectors = detectors
+        self.fusion_threshold = fusion_threshold
+        self.single_pass = single_pass
         self.name = 'Dlib'
 
 
-    def _trim_css_to_bounds(self, css, image_shape):
+    def _clipBoxes(self, rects, image):
         """
-        Make sure a tuple in (top, right, bottom, left) order is within the bounds of the image.
+        Returns the boxes of dlib rectangles, within the bounds of the image.
 
-        :param css:  Plain tuple representation of the rect in (top, right, bottom, left) order
-        :param image_shape: Numpy shape of the image array
-        :return: A trimmed plain tuple representation of the rect in (top, right, bottom, left) order
+        :param rects: The dlib rectangles.
+        :param image: The considered image as numpy array.
+        :return: The (N, 4) array [[left, top, right, bottom]].
         """
-        return max(css[0], 0), min(css[1], image_shape[1]), min(css[2], image_shape[0]), max(css[3], 0)
+        boxes = np.array([(rect.left(), rect.top(), rect.right(), rect.bottom()) for rect in rects], dtype = np.int32).reshape((-1, 4))
+        np.maximum(boxes[:, :2], 0, out = boxes[:, :2])
+        np.minimum(boxes[:, 2], image.shape[1], out = boxes[:, 2])
+        np.minimum(boxes[:, 3], image.shape[0], out = boxes[:, 3])
+        return boxes
 
 
-    def _rect_to_css(self, rect):
+    def _getBoxesByDetector(self, detector, image, number_of_times_to_upsample = 1):
         """
-        Convert a dlib 'rect' object to a plain tuple in (top, right, bottom, left) order
+        Returns the boxes of the detected objects in the image, within the bounds of the image.
 
-        :param rect: A dlib 'rect' object
-        :return: A plain tuple representation of the rect in (top, right, bottom, left) order
+        :param detector: The detector used for the detection.
+        :param image: The considered image as numpy array.
+        :param number_of_times_to_upsample: Used to refine detection but increases time of computation.
+        :return: The (N, 4) array [[left, top, right, bottom]].
         """
-        return rect.top(), rect.right(), rect.bottom(), rect.left()
+        return self._clipBoxes(detector(image, number_of_times_to_upsample), image)
 
 
-    def _css_to_locations(self, css):
+    def getLocationsByDetector(self, detector, image, number_of_times_to_upsample = 1):
         """
-        Converts a tuple in (top, right, bottom, left) order into array
-        [[x1, y1], [x2, y2], [x3, y3], [x4, y4]]
+        Returns the locations of the detected objects in the image.
+
+        :param detector: The detector used for the detection.
+        :param image: The considered image as numpy array.
+        :param number_of_times_to_upsample: Used to refine detection but increases time of computation.
+        :return: The batch of detections.
         """
-        (top, right, bottom, left) = css
-        return [[left, top], [left, bottom], [right, bottom], [right, top]]
+        return boxUtils.detections(self._getBoxesByDetector(detector, image, number_of_times_to_upsample))
 
 
-    def getLocationsByDetector(self, detector, image, number_of_times_to_upsample = 1):
+    def getScoredLocations(self, image, number_of_times_to_upsample = 1, adjust_threshold = 0.0):
         """
-        Returns the locations of the detected objects in the image.
+        Returns the locations found by all detectors, with their scores and the
+        index of their detector, without fusion. With single_pass = True, the
+        HOG pyramid of the image is built once for all detectors. If the
+        detectors cannot share a pyramid (e.g. different pyramid settings), each
+        detector is then run on its own pyramid.
 
-        :param detector: The detector used for the detection.
         :param image: The considered image as numpy array.
         :param number_of_times_to_upsample: Used to refine detection but increases time of computation.
+        :param adjust_threshold: Added to the detection threshold of the detectors. Negative values return more, less confident, detections.
+        :return: The batch of detections, with the score and the index of the detector of each detection.
         """
-        locations = detector(image, number_of_times_to_upsample)
-        locations = [self._css_to_locations(self._trim_css_to_bounds(self._rect_to_css(people), image.shape)) for people in locations]
-        return locations
+        if self.single_pass:
+            try:
+                (rects, scores, detectors) = dlib.fhog_object_detector.run_multiple(self.detectors, image, upsample_num_times = number_of_times_to_upsample, adjust_threshold = adjust_threshold)
+                return boxUtils.detections(self._clipBoxes(rects, image), scores, detectors)
+            except RuntimeError:
+                self.single_pass = False
+        # Run each detector on its own pyramid.
+        results = [detector.run(image, number_of_times_to_upsample, adjust_threshold) for detector in self.detectors]
+        rects = [rect for (detector_rects, detector_scores, detector_indexes) in results for rect in detector_rects]
+        scores = np.concatenate([np.asarray(detector_scores, dtype = np.float32) for (detector_rects, detector_scores, detector_indexes) in results]) if len(results) > 0 else np.zeros(0, dtype = np.float32)
+        detectors = np.repeat(np.arange(len(results)), [len(detector_rects) for (detector_rects, detector_scores, detector_indexes) in results])
+        return boxUtils.detections(self._clipBoxes(rects, image), scores, detectors)
 
 
     def getLocations(self, image, number_of_times_to_upsample = 1):
         """
-        Returns all locations for all detectors.
+        Returns all locations for all detectors. The overlapping locations found
+        by different detectors are fused, weighted by their scores.
 
         :param image: The considered image as numpy array.
+        :return: The batch of detections, with the best score and the index of the detector of each detection.
         """
-        locations = []
-        for detector in self.detectors:
-            locations = locations  + self.getLocationsByDetector(detector, image, number_of_times_to_upsample)
-        return locations
+        detections = self.getScoredLocations(image, number_of_times_to_upsample)
+        masks = [detections['detector'] == index for index in range(len(self.detectors))]
+        (boxes, scores, detectors) = boxUtils.fuse([detections['box'][mask] for mask in masks], [detections['score'][mask] for mask in masks], threshold = self.fusion_threshold, offset = 1)
+        return boxUtils.detections(boxes, scores, detectors)
 
 
 class peopleDetectorCV:
@@ -119,28 +158,6 @@ class peopleDetectorCV:
         self.name = 'CV'
 
 
-    def _inside(self, r, q):
-        """
-        Helper function to filter detected locations.
-
-        :param r: Rectangle
-        :param q: Rectangle
-        :return: Whether r is inside q.
-        """
-        rx, ry, rw, rh = r
-        qx, qy, qw, qh = q
-        return rx > qx and ry > qy and rx + rw < qx + qw and ry + rh < qy + qh
-
-
-    def _rectToLocations(self, css):
-        """
-        Converts a tuple in (top, right, bottom, left) order into array
-        [[x1, y1], [x2, y2], [x3, y3], [x4, y4]]
-        """
-        (top, right, bottom, left) = css
-        return [[left, top], [left, bottom], [right, bottom], [right, top]]
-
-
     def getLocations(self, image):
         """
         Returns the locations of the detections.
@@ -148,19 +165,15 @@ class peopleDetectorCV:
         :param image: The considered image.
         """
         found, w = self.hog.detectMultiScale(image, winStride=(4,4), padding=(16,16), scale=1.05, hitThreshold = 0.25)
-        found_filtered = []
-
-        for ri, r in enumerate(found):
-            for qi, q in enumerate(found):
-                if ri != qi and self._inside(r, q):
-                    break
-            else:
-                found_filtered.append(r)
-        locations = []
-        for (x, y, w, h) in found:
-            pad_w, pad_h = int(0.15*w), int(0.05*h)
-            locations.append(self._rectToLocations((y + pad_h, x + w - pad_w, y +h - pad_h, x + pad_w)))
-        return locations
+        found = np.array(found, dtype = int).reshape((-1, 4))
+        (x, y, w, h) = found.T
+        # Drop the detections strictly inside another detection.
+        boxes = np.stack((x, y, x + w, y + h), axis = 1)
+        kept = ~np.any(boxUtils.strictlyInside(boxes, boxes), axis = 1)
+        (x, y, w, h) = found[kept].T
+        # Remove the padding of the detections.
+        pad_w, pad_h = (0.15 * w).astype(int), (0.05 * h).astype(int)
+        return boxUtils.detections(np.stack((x + pad_w, y + pad_h, x + w - pad_w, y + h - pad_h), axis = 1))
 
 
 class peopleDetectorBackSub:
@@ -193,9 +206,9 @@ class peopleDetectorBackSub:
             rect = cv2.minAreaRect(contour)
             ((x, y), (w, h), angle) = rect
             if w * h > 800:
-                box = np.int0(cv2.boxPoints(rect))
-                locations.append(box)
-        return locations
+                locations.append(cv2.boxPoints(rect))
+        # Keep the bounding box of each rotated rectangle.
+        return boxUtils.detections(np.rint(boxUtils.toBoxes(locations)).astype(np.int32))
 
 
 def drawLocations(image, locations, color = RED):
@@ -203,9 +216,48 @@ def drawLocations(image, locations, color = RED):
     Draws the found locations in the image.
 
     :param image: The considered image.
-    :param locations: The locations, as [[x1, y1], [x2, y2], [x3, y3], [x4, y4]] array.
+    :param locations: The batch of detections, or the locations as [[x1, y1], [x2, y2], [x3, y3], [x4, y4]] array.
     :param color: The RGB color of the resulting drawing.
     """
+    if isinstance(locations, np.ndarray) and locations.dtype.names is not None:
+        locations = boxUtils.toLocations(locations)
     for box in locations:
         cv2.drawContours(image,[np.array(box)],0,(0,0,255),2)
     return image
+
+
+if __name__ == '__main__':
+    # Packages for the benchmark.
+    import argparse
+    import os
+    import time
+    import streamProcessorEyes
+
+    # Parse arguments.
+    parser = argparse.ArgumentParser(description = 'Compares the single pyramid and the sequential evaluations of the dlib detectors on a recording.')
+    parser.add_argument('source', help = 'A video file, or a directory of images.')
+    parser.add_argument('--frames', type = int, default = 100, help = 'Number of frames of the benchmark.')
+    parser.add_argument('--resize-factor', type = float, default = 4.0, help = 'The frames are downscaled by this factor before the detection, as in the stream processors.')
+    parser.add_argument('--upsample', type = int, default = 1, help = 'Number of times the frames are upsampled by the detectors.')
+    arguments = parser.parse_args()
+
+    # Decode and downscale the frames beforehand, so that only the detection is measured.
+    if os.path.isdir(arguments.source):
+        video_stream = streamProcessorEyes.imageDirectoryStream(arguments.source, realtime = False, loop = True)
+    else:
+        video_stream = streamProcessorEyes.videoFileStream(arguments.source, realtime = False, loop = True)
+    preprocessor = streamProcessorEyes.framePreprocessor(arguments.resize_factor)
+    frames = [preprocessor.process(video_stream.getCurrentFrame()).copy() for i in range(arguments.frames)]
+    video_stream.close()
+
+    # Run both evaluations on the same frames.
+    results = {}
+    for single_pass in [False, True]:
+        detector = peopleDetectorDlib(single_pass = single_pass)
+        start_time = time.perf_counter()
+        results[single_pass] = [detector.getScoredLocations(frame, arguments.upsample) for frame in frames]
+        elapsed_time = time.perf_counter() - start_time
+        print(('Single pyramid' if detector.single_pass else 'Sequential') + ': ' + str(round(1000 * elapsed_time / len(frames), 2)) + ' ms per frame, ' + str(sum(len(batch) for batch in results[single_pass])) + ' detections.')
+    # Check that both evaluations find the same detections.
+    nb_different = sum(sorted(sequential['box'].tolist()) != sorted(single['box'].tolist()) for (sequential, single) in zip(results[False], results[True]))
+    print(str(nb_different) + ' frames with different detections.')
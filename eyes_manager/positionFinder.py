@@ -8,6 +8,12 @@ For each implementation, we want the class to implement a function
 
 which returns a value in [-1, 1] corresponding to the current position of the
 detection.
+
+kalmanPositionFinder follows each detected target with a constant velocity
+Kalman filter, updated with the sparse results of the stream processor, and
+predicts the position of the followed target every time it is called, i.e. at
+the rendering rate of the eye model. When the detections drop out, the target
+is held for a while and its position then decays towards the center.
 """
 
 ################################################################################
@@ -20,6 +26,9 @@ import math
 # Utilitary packages
 import time
 
+# Package for numeric computations.
+import numpy as np
+
 
 ################################################################################
 # Main content of the class.
@@ -66,16 +75,224 @@ class positionFinderFromStreamProcessor:
 
         :return: A value in [-1, 1] corresponding to the location of the detection in the image. -1 correspond to a detection at the very left of the image and +1 at the very right. If nothing is detected, returns 0.
         """
-        # Get current locations of detections.
-        current_locations = self.stream_processor.getCurrentLocations()
-        # Get current image size.
-        [width, height] = self.stream_processor.getCurrentImageSize()
+        # Get current locations of detections and current image size. The
+        # asynchronous processor returns both at once, from the same image.
+        if hasattr(self.stream_processor, 'getCurrentResults'):
+            current_locations, [width, height] = self.stream_processor.getCurrentResults()
+        else:
+            current_locations = self.stream_processor.getCurrentLocations()
+            [width, height] = self.stream_processor.getCurrentImageSize()
         # Compute the output value. We take the barycenter of the first
         # location and normalizes it by the width of the image.
         if len(current_locations) > 0:
             # Get value for first locations.
-            [[x1, y1], [x2, y2], [x3, y3], [x4, y4]] = current_locations[0]
-            value = 2 * ((x1 + x2 + x3 + x4) / (4 * width)) - 1
+            (left, top, right, bottom) = current_locations['box'][0]
+            value = 2 * ((left + right) / (2 * width)) - 1
         else:
             value = 0
         return value
+
+
+class kalmanPositionFinder:
+    """
+    This class implements a finder that smoothes and interpolates the results of
+    the stream processor.
+
+    Each target is followed along the horizontal axis by a Kalman filter whose
+    state is its normalized position in [-1, 1] and its velocity. The filters
+    are only updated when the stream processor publishes new locations, which
+    may happen a few times per second, while getCurrentPosition predicts the
+    position of the followed target at the current time. Thus the detection can
+    run at a low rate while the eye moves smoothly.
+
+    Detections are associated to the targets by their track index when the
+    stream processor gives one, and otherwise to the closest predicted target.
+    The followed target is kept as long as it is held, so that the eye does not
+    jump between people. A target without detection is held at its predicted
+    position during hold_time, then its position decays towards 0 with the time
+    constant decay_time, and it is forgotten once its position is back to 0.
+    """
+    def __init__(self, stream_processor, process_noise = 2.0, measurement_noise = 0.05, max_distance = 0.3, max_prediction = 0.3, hold_time = 1.0, decay_time = 0.5, max_targets = 5):
+        """
+        Initialization of the class.
+
+        :param stream_processor: The stream processor the class relies on, preferably an asyncStreamProcessor.
+        :param process_noise: The spectral density of the acceleration of the targets, in squared normalized units per cubed second. Higher follows faster motions, lower smoothes more.
+        :param measurement_noise: The standard deviation of the measured positions, in normalized units.
+        :param max_distance: The maximal distance between a detection and the predicted position of a target to associate them, in normalized units.
+        :param max_prediction: The maximal time in seconds during which the velocity of a target is extrapolated after its last detection.
+        :param hold_time: The time in seconds during which a target is held after its last detection.
+        :param decay_time: The time constant in seconds of the decay of the position towards 0 after the hold.
+        :param max_targets: The maximal number of targets followed at once.
+        """
+        # Initialize constructors.
+        self.stream_processor = stream_processor
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.max_distance = max_distance
+        self.max_prediction = max_prediction
+        self.hold_time = hold_time
+        self.decay_time = decay_time
+        self.max_targets = max_targets
+        # Initialize targets. Each target is a dictionary with its state [position, velocity] and its covariance at the time of its last detection, this time, its number of detections and its track index.
+        self.targets = []
+        self.followed_target = None
+        # Initialize the last locations, to detect the new results of the stream processor.
+        self.last_locations = None
+        # Initialize current position.
+        self.currentPosition = 0
+
+
+    def _getMeasurements(self):
+        """
+        Returns the new results of the stream processor, if any.
+
+        :return: A tuple (positions, tracks) of the normalized positions and the track indexes of the detections, or None if the locations were already used.
+        """
+        # Get current locations of detections and current image size.
+        if hasattr(self.stream_processor, 'getCurrentResults'):
+            current_locations, [width, height] = self.stream_processor.getCurrentResults()
+        else:
+            current_locations = self.stream_processor.getCurrentLocations()
+            [width, height] = self.stream_processor.getCurrentImageSize()
+        # The stream processors publish a new array for each new result.
+        if current_locations is self.last_locations:
+            return None
+        self.last_locations = current_locations
+        boxes = current_locations['box']
+        positions = (boxes[:, 0] + boxes[:, 2]) / width - 1
+        return (positions, current_locations['track'])
+
+
+    def _predict(self, target, now):
+        """
+        Predicts the state and the covariance of a target at the given time.
+
+        :param target: The target.
+        :param now: The time of the prediction.
+        :return: A tuple (state, covariance).
+        """
+        dt = now - target['last_seen']
+        transition = np.array([[1, dt], [0, 1]])
+        noise = self.process_noise * np.array([[dt ** 3 / 3, dt ** 2 / 2], [dt ** 2 / 2, dt]])
+        return (transition @ target['state'], transition @ target['covariance'] @ transition.T + noise)
+
+
+    def _update(self, target, position, now):
+        """
+        Updates the filter of a target with a detection.
+
+        :param target: The target.
+        :param position: The normalized position of the detection.
+        :param now: The time of the detection.
+        """
+        state, covariance = self._predict(target, now)
+        # Kalman gain for the measurement of the position only.
+        gain = covariance[:, 0] / (covariance[0, 0] + self.measurement_noise ** 2)
+        target['state'] = state + gain * (position - state[0])
+        target['covariance'] = covariance - np.outer(gain, covariance[0, :])
+        target['last_seen'] = now
+        target['nb_detections'] += 1
+
+
+    def _newTarget(self, position, track, now):
+        """
+        Creates a target at the position of a detection, with an unknown velocity.
+
+        :param position: The normalized position of the detection.
+        :param track: The track index of the detection, -1 if none.
+        :param now: The time of the detection.
+        """
+        return {'state': np.array([position, 0.0]),
+                'covariance': np.diag([self.measurement_noise ** 2, 1.0]),
+                'last_seen': now,
+                'nb_detections': 1,
+                'track': track}
+
+
+    def _associate(self, positions, tracks, now):
+        """
+        Updates the targets with the detections, and creates targets for the
+        detections that were not associated.
+
+        :param positions: The normalized positions of the detections.
+        :param tracks: The track indexes of the detections.
+        :param now: The time of the detections.
+        """
+        updated = set()
+        remaining = []
+        # Associate the detections to the targets with the same track index.
+        for (position, track) in zip(positions.tolist(), tracks.tolist()):
+            target = next((target for target in self.targets if track >= 0 and target['track'] == track and id(target) not in updated), None)
+            if target is None:
+                remaining.append((position, track))
+                continue
+            self._update(target, position, now)
+            updated.add(id(target))
+        # Associate the other detections to the closest predicted targets, the closest pairs first.
+        candidates = [target for target in self.targets if id(target) not in updated]
+        if len(remaining) > 0 and len(candidates) > 0:
+            predictions = np.array([self._predict(target, now)[0][0] for target in candidates])
+            distances = np.abs(np.array([position for (position, track) in remaining])[:, np.newaxis] - predictions[np.newaxis, :])
+            associated = set()
+            for index in np.argsort(distances, axis = None).tolist():
+                i, j = divmod(index, len(candidates))
+                if distances[i, j] > self.max_distance:
+                    break
+                if i in associated or id(candidates[j]) in updated:
+                    continue
+                self._update(candidates[j], remaining[i][0], now)
+                candidates[j]['track'] = remaining[i][1]
+                updated.add(id(candidates[j]))
+                associated.add(i)
+            remaining = [detection for (i, detection) in enumerate(remaining) if i not in associated]
+        # Create new targets, within the limit of targets.
+        for (position, track) in remaining:
+            if len(self.targets) >= self.max_targets:
+                break
+            self.targets.append(self._newTarget(position, track, now))
+
+
+    def _getPosition(self, target, now):
+        """
+        Returns the position of a target at the given time: the velocity is
+        extrapolated during max_prediction after the last detection, and the
+        position decays towards 0 after hold_time.
+
+        :param target: The target.
+        :param now: The current time.
+        """
+        (position, velocity) = target['state']
+        position += velocity * min(now - target['last_seen'], self.max_prediction)
+        missed_time = now - target['last_seen']
+        if missed_time > self.hold_time:
+            position *= np.exp(-(missed_time - self.hold_time) / self.decay_time)
+        return min(max(position, -1), 1)
+
+
+    def getCurrentPosition(self):
+        """
+        Returns the predicted position of the followed target at the current time.
+
+        :return: A value in [-1, 1] corresponding to the location of the followed target in the image. -1 correspond to a target at the very left of the image and +1 at the very right. If no target is followed, returns 0.
+        """
+        now = time.monotonic()
+        # Update the targets with the new results of the stream processor.
+        measurements = self._getMeasurements()
+        if measurements is not None:
+            self._associate(measurements[0], measurements[1], now)
+        # Forget the targets whose position decayed to 0.
+        forget_time = self.hold_time + 5 * self.decay_time
+        self.targets = [target for target in self.targets if now - target['last_seen'] < forget_time]
+        # Keep the followed target as long as it is held, otherwise follow the target seen the most among the visible ones.
+        visible = [target for target in self.targets if now - target['last_seen'] <= self.hold_time]
+        if not any(target is self.followed_target for target in visible) and len(visible) > 0:
+            self.followed_target = max(visible, key = lambda target: target['nb_detections'])
+        elif not any(target is self.followed_target for target in self.targets):
+            self.followed_target = None
+        # Compute the output value.
+        if self.followed_target is not None:
+            self.currentPosition = self._getPosition(self.followed_target, now)
+        else:
+            self.currentPosition = 0
+        return self.currentPosition
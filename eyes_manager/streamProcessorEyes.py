@@ -2,71 +2,61 @@
 The purpose of this module is to implement functions that return in real time
 the locations of detected people in a video stream.
 
-We first implement a class to define a video stream. It must implement the
-function
+The video streams are implemented in video_manager/videoStreams.py, and
+imported here. They must implement the function
 
     getCurrentFrame()
 
 which returns the current frame of the stream as np array.
 
-Then we implement classes that analyse such streams. They must implement the
+We implement classes that analyse such streams. They must implement the
 function
 
     getCurrentLocations()
 
-which returns the locations of detected people in the current frame.
+which returns the locations of detected people in the current frame, as a batch
+of detections (see boxUtils.py).
+
+The class asyncStreamProcessor runs any of these processors on a background
+thread, so that getCurrentLocations returns immediately.
 """
 
 ################################################################################
 # Imports.
 ################################################################################
 
+# Utilitary packages.
+import os
+import threading
+import time
+import concurrent.futures
+
 # Packages for image processing.
-import cv2
-import scipy.misc
 import numpy as np
 import dlib
+from scipy.optimize import linear_sum_assignment
+
+# Vectorized operations on boxes.
+import boxUtils
+
+# Shared video streams and processing of the frames.
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_manager'))
+# The video streams are re-exported, so that the applications create them from this module.
+from videoStreams import webcamStream, replayStream, videoFileStream, imageDirectoryStream
+from frameProcessing import framePreprocessor
 
 
 ################################################################################
 # Main content of the class.
 ################################################################################
 
-class webcamStream:
-    """
-    This class implements the video stream of a webcam.
-    """
-    def __init__(self, webcam_number = 0):
-        """
-        Initialization of the class.
-
-        :param webcam_number: The number of the considered webcam (by default 0).
-        """
-        self.video_capture = cv2.VideoCapture(webcam_number)
-
-
-    def close(self):
-        """
-        Closes the process of the stream.
-        """
-        self.video_capture.release()
-
-
-    def getCurrentFrame(self):
-        """
-        Returns the current frame of the stream, as np.array.
-        """
-        # Grab a single frame of video
-        ret, frame = self.video_capture.read()
-        return frame
-
-
 class streamProcessorFromDetector:
     """
     This class allows for the processig of a stream using only the given
     detector and applying it to every analysed frame.
     """
-    def __init__(self, video_stream, detector, resize_factor = 4.0, process_every = 2):
+    def __init__(self, video_stream, detector, resize_factor = 4.0, process_every = 2, color = None, motion_gate = None, scheduler = None):
         """
         Initialization of the class.
 
@@ -74,16 +64,26 @@ class streamProcessorFromDetector:
         :param detector: The detector used for the analyse of frames.
         :param resize_factor: Before applying the detector, each frame is resized by this factor. This allows for a faster computation.
         :param process_every: We do not process each frame, but only a fraction of them. We process only one frame in process_every.
+        :param color: The layout in which frames are given to the detector: None (BGR, as read from the stream), 'RGB' or 'GRAY'.
+        :param motion_gate: If not None, the motionGate deciding whether to run the detector on frames where nothing is detected.
+        :param scheduler: If not None, the adaptiveScheduler choosing process_every and resize_factor.
         """
         # Initialize constructors.
         self.video_stream = video_stream
         self.detector = detector
         self.resize_factor = resize_factor
         self.process_every = process_every
+        # Initialize the preprocessing of the frames.
+        self.preprocessor = framePreprocessor(resize_factor, color)
+        self.motion_gate = motion_gate
+        self.scheduler = scheduler
+        # The scheduler starts from the configured cadence and downscale factor.
+        if scheduler is not None:
+            scheduler.setInitialDecisions(process_every, resize_factor)
         # Initialize useful parameters for stream analysis.
         self.frame_counter = 0
         # Initialize the current locations and current image size as [width, height].
-        self.current_locations = []
+        self.current_locations = boxUtils.detections([])
         self.current_image_size = [1, 1]
 
 
@@ -94,13 +94,29 @@ class streamProcessorFromDetector:
         """
         # Get current frame.
         frame = self.video_stream.getCurrentFrame()
+        # Apply the decisions of the scheduler.
+        if self.scheduler is not None:
+            self.scheduler.recordFrame()
+            self.process_every = self.scheduler.process_every
+            self.resize_factor = self.scheduler.resize_factor
+            self.preprocessor.setResizeFactor(self.resize_factor)
         # Only process a fraction of the frames.
-        if (self.frame_counter % self.resize_factor == 0):
+        if (self.frame_counter % self.process_every == 0):
+            start_time = time.perf_counter()
             # Resize frame of video for faster face recognition processing
-            small_frame = scipy.misc.imresize(frame, 1.0 / self.resize_factor)
-            # small_frame = frame
-            # Get locations for the normal frame and actualize the current locations.
-            self.current_locations = self.resize_factor * np.array(self.detector.getLocations(small_frame))
+            small_frame = self.preprocessor.process(frame)
+            # Only run the detector if the frame changed or if people are detected.
+            moving = self.motion_gate is None or self.motion_gate.isMoving(small_frame)
+            if moving or len(self.current_locations) > 0:
+                preprocessing_time = time.perf_counter()
+                # Get locations for the normal frame and actualize the current locations.
+                self.current_locations = self.preprocessor.scaleLocations(self.detector.getLocations(small_frame))
+                # Measure the latency of the detection.
+                if self.scheduler is not None:
+                    end_time = time.perf_counter()
+                    self.scheduler.recordLatency('preprocessing', preprocessing_time - start_time)
+                    self.scheduler.recordLatency('detection', end_time - preprocessing_time)
+                    self.scheduler.recordAnalysis(end_time - start_time)
             # Actualizes the current image size.
             height, width, channels = frame.shape
             self.current_image_size = [width, height]
@@ -130,7 +146,7 @@ class streamProcessorWithTracker:
     For this stream processor, we use trackers (implemented in the dlib library)
     to improve the speed of the computations.
     """
-    def __init__(self, video_stream, detector, nb_trackers = 5, tracking_time = 100, resize_factor = 4, process_every = 2):
+    def __init__(self, video_stream, detector, nb_trackers = 5, tracking_time = 100, resize_factor = 4, process_every = 2, color = None, motion_gate = None):
         """
         Initialization of the class.
 
@@ -140,6 +156,8 @@ class streamProcessorWithTracker:
         :param tracking_time: The maximal amount of time a tracker can run.
         :param resize_factor: Before applying the detector, each frame is resized by this factor. This allows for a faster computation.
         :param process_every: We do not process each frame, but only a fraction of them. We process only one frame in process_every.
+        :param color: The layout in which frames are given to the detector: None (BGR, as read from the stream), 'RGB' or 'GRAY'.
+        :param motion_gate: If not None, the motionGate deciding whether to run the detector on frames where nothing is detected.
         """
         # Initialization of constructors.
         self.video_stream = video_stream
@@ -148,80 +166,20 @@ class streamProcessorWithTracker:
         self.tracking_time = tracking_time
         self.resize_factor = resize_factor
         self.process_every = process_every
+        # Initialize the preprocessing of the frames.
+        self.preprocessor = framePreprocessor(resize_factor, color)
+        self.motion_gate = motion_gate
         # Initialize useful parameters for stream analysis.
         self.frame_counter = 0
         # Initialize set of trackers.
         self.trackers = [[dlib.correlation_tracker(), 0, False] for i in range(self.nb_trackers)]
+        # Initialize the detections of the trackers, as a batch with one detection per tracker.
+        self.tracker_detections = boxUtils.detections(np.zeros((self.nb_trackers, 4)), 0.0, -1, np.arange(self.nb_trackers))
         # Initialize the current locations and current image size as [width, height].
-        self.current_locations = []
+        self.current_locations = boxUtils.detections([])
         self.current_image_size = [1, 1]
 
 
-    def _non_max_suppression_fast(self, boxes, overlapThresh):
-        """
-        This function (found on the internet) applies a fast non maxima
-        suppression algorith to avoid having multiple locations for only one
-        detected object.
-
-        :param boxes: The found locations, as [(left, top, right, bottom)] list.
-        :param overlapThresh: The threshold for detecting overlapping boxes.
-        """
-        # If there are no boxes, return an empty list.
-        if len(boxes) == 0:
-            return []
-
-        # If the bounding boxes integers, convert them to floats --
-        # this is important since we'll be doing a bunch of divisions.
-        if boxes.dtype.kind == "i":
-                boxes = boxes.astype("float")
-
-        # Initialize the list of picked indexes.
-        pick = []
-
-        # Grab the coordinates of the bounding boxes.
-        x1 = boxes[:,0]
-        y1 = boxes[:,1]
-        x2 = boxes[:,2]
-        y2 = boxes[:,3]
-
-        # Compute the area of the bounding boxes and sort the bounding
-        # boxes by the bottom-right y-coordinate of the bounding box.
-        area = (x2 - x1 + 1) * (y2 - y1 + 1)
-        idxs = np.argsort(y2)
-
-        # Keep looping while some indexes still remain in the indexes
-        # list.
-        while len(idxs) > 0:
-            # Grab the last index in the indexes list and add the
-            # index value to the list of picked indexes.
-            last = len(idxs) - 1
-            i = idxs[last]
-            pick.append(i)
-
-            # Find the largest (x, y) coordinates for the start of
-            # the bounding box and the smallest (x, y) coordinates
-            # for the end of the bounding box.
-            xx1 = np.maximum(x1[i], x1[idxs[:last]])
-            yy1 = np.maximum(y1[i], y1[idxs[:last]])
-            xx2 = np.minimum(x2[i], x2[idxs[:last]])
-            yy2 = np.minimum(y2[i], y2[idxs[:last]])
-
-            # Compute the width and height of the bounding box.
-            w = np.maximum(0, xx2 - xx1 + 1)
-            h = np.maximum(0, yy2 - yy1 + 1)
-
-            # Compute the ratio of overlap.
-            overlap = (w * h) / area[idxs[:last]]
-
-            # Delete all indexes from the index list that have.
-            idxs = np.delete(idxs, np.concatenate(([last],
-                np.where(overlap > overlapThresh)[0])))
-
-        # Return only the bounding boxes that were picked using the
-        # integer data type.
-        return boxes[pick].astype("int")
-
-
     def _actualizeLocations(self):
         """
         This function actualizes self.current_locations so that it contains
@@ -229,54 +187,53 @@ class streamProcessorWithTracker:
         """
         # Get current frame.
         frame = self.video_stream.getCurrentFrame()
-         # Define array to store all locations.
-        all_locations = []
         # Actualise all current trackers.
-        for element in self.trackers:
-            # Update tracker if available.
+        for (element, detection) in zip(self.trackers, self.tracker_detections):
+            # Update tracker if available, and keep its confidence as score.
             if element[2]:
-                element[0].update(frame)
+                detection['score'] = element[0].update(frame)
                 element[1] += 1
             # Deactivate tracker if it went over tracking time.
             if element[1] >= self.tracking_time:
                 element[2] = False
 
-        # We analyse the frame if there is room for trackers.
+        # We analyse the frame if there is room for trackers, and if the frame changed.
+        small_frame = None
         if not all([elements[2] for elements in self.trackers]):
             # Resize frame of video for faster face recognition processing.
-            small_frame = scipy.misc.imresize(frame, 1.0 / self.resize_factor)
+            small_frame = self.preprocessor.process(frame)
+            if self.motion_gate is not None and not self.motion_gate.isMoving(small_frame):
+                small_frame = None
+        if small_frame is not None:
             # Get locations.
-            locations = self.resize_factor * np.array(self.detector.getLocations(small_frame))
+            locations = self.preprocessor.scaleLocations(self.detector.getLocations(small_frame))
             # Actualizes the current image size.
             height, width, channels = frame.shape
             self.current_image_size = [width, height]
             # Get available trackers.
             available_trackers_position = [i for i in range(len(self.trackers)) if not self.trackers[i][2]]
             # Fill as much trackers as possible.
-            for ([[x1, y1], [x2, y2], [x3, y3], [x4, y4]], i) in zip(locations, available_trackers_position):
+            for (location, i) in zip(locations, available_trackers_position):
                 # Get tracker.
                 tracker = self.trackers[i][0]
                 # Define the dlib rectangle corresponding to the locations.
-                rectangle = dlib.rectangle(int(x1), int(y1), int(x3), int(y3))
+                (left, top, right, bottom) = location['box'].tolist()
+                rectangle = dlib.rectangle(left, top, right, bottom)
                 # Tracker does not accept empty rectangle.
                 if not rectangle.is_empty():
                     tracker.start_track(frame, rectangle)
                     self.trackers[i] = [tracker, 0, True]
+                    self.tracker_detections[i]['score'] = location['score']
+                    self.tracker_detections[i]['detector'] = location['detector']
 
-        # Get all locations.
-        for element in self.trackers:
-            tracker = element[0]
-            # We add locations of current trackers.
+        # Get the boxes of all current trackers.
+        for (element, box) in zip(self.trackers, self.tracker_detections['box']):
             if element[2]:
-                positions = tracker.get_position()
-                left, top, right, bottom = positions.left(), positions.top(), positions.right(), positions.bottom()
-                left, top, right, bottom = int(left), int(top), int(right), int(bottom)
-                all_locations.append([[left, top], [left, bottom], [right, bottom], [right, top]])
-        # Keep only interesting boxes with non maxima suppression.
-        boxes = np.array([(left, top, right, bottom) for [[left, top], [left, bottom], [right, bottom], [right, top]] in all_locations])
-        boxes = self._non_max_suppression_fast(boxes, 0.5)
-        # Actualize locations.
-        self.current_locations = [[[left, top], [left, bottom], [right, bottom], [right, top]] for (left, top, right, bottom) in boxes]
+                positions = element[0].get_position()
+                box[:] = (positions.left(), positions.top(), positions.right(), positions.bottom())
+        active = self.tracker_detections[[element[2] for element in self.trackers]]
+        # Keep only interesting boxes with non maxima suppression: boxes are browsed by decreasing bottom, and a box more than half inside a kept box is dropped.
+        self.current_locations = active[boxUtils.nms(active['box'], threshold = 0.5, metric = 'containment', offset = 1)]
 
 
     def getCurrentLocations(self):
@@ -292,3 +249,280 @@ class streamProcessorWithTracker:
         This function returns the current size of the image as [width, height].
         """
         return self.current_image_size
+
+
+class streamProcessorWithTrackingEngine:
+    """
+    For this stream processor, the detections are followed by dlib correlation
+    trackers, as with streamProcessorWithTracker, but:
+
+        - the trackers are updated concurrently on a pool of threads, on a
+        frame downscaled by track_factor,
+        - the detector only runs every detect_every frames, or when the
+        confidence of a tracker drops below min_confidence,
+        - the detections are associated with the existing tracks by
+        intersection over union, with the Hungarian algorithm: a matched track
+        is restarted on its detection, and only the unmatched detections start
+        new tracks.
+
+    The locations are returned as a batch of detections, whose track is the
+    identifier of the track and whose score is the score of the detection on
+    the frame where the track was started or restarted, and the confidence of
+    the tracker on the next frames.
+    """
+    def __init__(self, video_stream, detector, nb_trackers = 5, tracking_time = 100, resize_factor = 4, track_factor = 2, detect_every = 10, min_confidence = 7.0, iou_threshold = 0.3, nb_threads = 4, color = None, motion_gate = None):
+        """
+        Initialization of the class.
+
+        :param video_stream: The video stream being analyzed.
+        :param detector: The detector used for the analyse of frames.
+        :param nb_trackers: The maximal number of trackers that we use.
+        :param tracking_time: The maximal number of frames a track can run without being matched with a detection.
+        :param resize_factor: Before applying the detector, each frame is resized by this factor.
+        :param track_factor: Before updating the trackers, each frame is resized by this factor.
+        :param detect_every: The detector runs at least once every detect_every frames.
+        :param min_confidence: The detector runs when the confidence (peak to side lobe ratio) of a tracker is below this value, and the unmatched trackers below this value are removed.
+        :param iou_threshold: The minimal intersection over union between a track and a detection to be associated.
+        :param nb_threads: The number of threads updating the trackers.
+        :param color: The layout in which frames are given to the detector and the trackers: None (BGR, as read from the stream), 'RGB' or 'GRAY'.
+        :param motion_gate: If not None, the motionGate deciding whether to run the scheduled detections when nothing is tracked.
+        """
+        # Initialize constructors.
+        self.video_stream = video_stream
+        self.detector = detector
+        self.nb_trackers = nb_trackers
+        self.tracking_time = tracking_time
+        self.detect_every = detect_every
+        self.min_confidence = min_confidence
+        self.iou_threshold = iou_threshold
+        self.motion_gate = motion_gate
+        # Initialize the preprocessing of the frames, for detection and tracking.
+        self.preprocessor = framePreprocessor(resize_factor, color)
+        self.tracking_preprocessor = framePreprocessor(track_factor, color)
+        # Initialize the pool of threads.
+        self.pool = concurrent.futures.ThreadPoolExecutor(nb_threads)
+        # Initialize useful parameters for stream analysis.
+        self.frame_counter = 0
+        self.next_track = 0
+        # Initialize tracks, as lists [tracker, track, detector, age, confidence, box] where box is in the frame.
+        self.tracks = []
+        # Initialize the current locations and current image size as [width, height].
+        self.current_locations = boxUtils.detections([])
+        self.current_image_size = [1, 1]
+
+
+    def close(self):
+        """
+        Stops the pool of threads.
+        """
+        self.pool.shutdown()
+
+
+    def _updateTrack(self, tracking_frame, element):
+        """
+        Updates a tracker with the tracking frame, and actualizes its confidence,
+        its age and its box in the frame.
+
+        :param tracking_frame: The downscaled frame.
+        :param element: The track [tracker, track, detector, age, confidence, box].
+        """
+        [scale_x, scale_y] = self.tracking_preprocessor.scale
+        element[4] = element[0].update(tracking_frame)
+        element[3] += 1
+        position = element[0].get_position()
+        element[5] = np.rint(np.array([position.left(), position.top(), position.right(), position.bottom()]) * [scale_x, scale_y, scale_x, scale_y])
+
+
+    def _startTrack(self, tracking_frame, element, detection):
+        """
+        Starts the tracker of a track on a detection, with the score of the
+        detection as confidence.
+
+        :param tracking_frame: The downscaled frame.
+        :param element: The track [tracker, track, detector, age, confidence, box].
+        :param detection: The detection, in the frame.
+        :return: Whether the tracker was started. Trackers do not accept empty rectangles.
+        """
+        [scale_x, scale_y] = self.tracking_preprocessor.scale
+        (left, top, right, bottom) = np.rint(detection['box'] / [scale_x, scale_y, scale_x, scale_y]).astype(int).tolist()
+        rectangle = dlib.rectangle(left, top, right, bottom)
+        if rectangle.is_empty():
+            return False
+        element[0].start_track(tracking_frame, rectangle)
+        element[2] = detection['detector']
+        element[3] = 0
+        element[4] = float(detection['score'])
+        element[5] = detection['box'].astype(float)
+        return True
+
+
+    def _actualizeLocations(self):
+        """
+        This function actualizes self.current_locations so that it contains
+        the locations corresponding to the current image.
+        """
+        # Get current frame.
+        frame = self.video_stream.getCurrentFrame()
+        height, width = frame.shape[:2]
+        self.current_image_size = [width, height]
+        tracking_frame = self.tracking_preprocessor.process(frame)
+        # Update all trackers concurrently, and remove the tracks that ran for too long without detection.
+        list(self.pool.map(lambda element: self._updateTrack(tracking_frame, element), self.tracks))
+        self.tracks = [element for element in self.tracks if element[3] < self.tracking_time]
+
+        # Run the detector on schedule, or when a tracker loses confidence.
+        detect = (self.frame_counter % self.detect_every == 0) or any(element[4] < self.min_confidence for element in self.tracks)
+        # Downscale the frame once for the motion gate and the detector.
+        small_frame = self.preprocessor.process(frame) if detect else None
+        if detect and len(self.tracks) == 0 and self.motion_gate is not None:
+            detect = self.motion_gate.isMoving(small_frame)
+        if detect:
+            detections = self.preprocessor.scaleLocations(self.detector.getLocations(small_frame))
+            # Associate the detections with the tracks, maximizing the total intersection over union.
+            boxes = np.array([element[5] for element in self.tracks]).reshape((-1, 4))
+            overlaps = boxUtils.iou(boxes, detections['box'], offset = 1)
+            (track_rows, detection_rows) = linear_sum_assignment(-overlaps)
+            matched = overlaps[track_rows, detection_rows] >= self.iou_threshold
+            starts = [(self.tracks[i], detections[j]) for (i, j) in zip(track_rows[matched], detection_rows[matched])]
+            # Remove the unmatched tracks without confidence.
+            matched_tracks = set(track_rows[matched].tolist())
+            self.tracks = [element for (i, element) in enumerate(self.tracks) if i in matched_tracks or element[4] >= self.min_confidence]
+            # Start new tracks on the unmatched detections, by decreasing score.
+            unmatched = np.setdiff1d(np.arange(len(detections)), detection_rows[matched])
+            for j in unmatched[np.argsort(-detections['score'][unmatched], kind = 'stable')]:
+                if len(self.tracks) >= self.nb_trackers:
+                    break
+                element = [dlib.correlation_tracker(), self.next_track, -1, 0, self.min_confidence, None]
+                self.next_track += 1
+                self.tracks.append(element)
+                starts.append((element, detections[j]))
+            # Start the trackers concurrently.
+            started = list(self.pool.map(lambda start: self._startTrack(tracking_frame, *start), starts))
+            failed = [id(element) for ((element, detection), success) in zip(starts, started) if not success]
+            self.tracks = [element for element in self.tracks if id(element) not in failed]
+            self.frame_counter = 0
+        self.frame_counter += 1
+
+        # Actualize locations, keeping only interesting boxes with non maxima suppression.
+        locations = boxUtils.detections(np.array([element[5] for element in self.tracks]).reshape((-1, 4)), [element[4] for element in self.tracks], [element[2] for element in self.tracks], [element[1] for element in self.tracks])
+        self.current_locations = locations[boxUtils.nms(locations['box'], threshold = 0.5, metric = 'containment', offset = 1)]
+
+
+    def getCurrentLocations(self):
+        """
+        This function returns the locations detected in the current image.
+        """
+        self._actualizeLocations()
+        return self.current_locations
+
+
+    def getCurrentImageSize(self):
+        """
+        This function returns the current size of the image as [width, height].
+        """
+        return self.current_image_size
+
+
+class asyncStreamProcessor:
+    """
+    This class runs a stream processor on a background thread, so that the
+    reads of the locations never wait for the capture or the detection.
+
+    The thread continuously actualizes the locations of the given stream
+    processor, and publishes the locations along with the corresponding image
+    size at once. getCurrentLocations and getCurrentImageSize only return the
+    last published results: the caller (typically the rendering loop of the eye
+    model) runs at its own rate, regardless of the latency of the detection.
+
+    The reads of the webcam pace the background thread, so that the video
+    stream of the processor should not be threaded.
+
+    An error of the stream processor (e.g. a lost video stream) does not stop
+    the thread: no location is published, and the thread retries after
+    retry_interval seconds. The last error is kept in self.error until the next
+    successful update.
+    """
+    def __init__(self, stream_processor, retry_interval = 0.5, join_timeout = 2.0):
+        """
+        Initialization of the class.
+
+        :param stream_processor: The stream processor run in the background, e.g. a streamProcessorFromDetector.
+        :param retry_interval: The time in seconds between two attempts after an error of the stream processor.
+        :param join_timeout: The maximal time in seconds that close waits for the background thread, which may be blocked by a read of the video stream.
+        """
+        # Initialize constructors.
+        self.stream_processor = stream_processor
+        self.retry_interval = retry_interval
+        self.join_timeout = join_timeout
+        # Initialize the published results, as a tuple (locations, image size).
+        self.current_results = (boxUtils.detections([]), [1, 1])
+        self.nb_updates = 0
+        self.nb_errors = 0
+        self.error = None
+        # Start the background thread.
+        self.running = True
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+
+    def _run(self):
+        """
+        Actualizes the locations until the processor is closed.
+        """
+        while self.running:
+            try:
+                locations = self.stream_processor.getCurrentLocations()
+                image_size = self.stream_processor.getCurrentImageSize()
+            except Exception as error:
+                # Publish no location rather than outdated ones, and retry later.
+                self.error = error
+                self.nb_errors += 1
+                self.current_results = (boxUtils.detections([]), self.current_results[1])
+                time.sleep(self.retry_interval)
+                continue
+            # Publish both results with a single assignment.
+            self.current_results = (locations, image_size)
+            self.nb_updates += 1
+            self.error = None
+
+
+    def close(self):
+        """
+        Stops the background thread, then closes the stream processor if it has a
+        close function (e.g. the pool of threads of a
+        streamProcessorWithTrackingEngine). The video stream must be closed
+        afterwards.
+
+        The thread is waited for at most join_timeout seconds: if it is still
+        blocked in a read of the video stream, the stream processor is left open,
+        and the thread ends with the process.
+        """
+        self.running = False
+        self.thread.join(self.join_timeout)
+        if self.thread.is_alive():
+            print('The stream processor did not stop within ' + str(self.join_timeout) + ' seconds.')
+            return
+        if hasattr(self.stream_processor, 'close'):
+            self.stream_processor.close()
+
+
+    def getCurrentResults(self):
+        """
+        This function returns the last published results, as a tuple
+        (locations, [width, height]) of results of the same image.
+        """
+        return self.current_results
+
+
+    def getCurrentLocations(self):
+        """
+        This function returns the last locations detected by the background thread.
+        """
+        return self.getCurrentResults()[0]
+
+
+    def getCurrentImageSize(self):
+        """
+        This function returns the size of the image of the last locations as [width, height].
+        """
+        return self.getCurrentResults()[1]
@@ -0,0 +1,431 @@
+"""
+The purpose of this module is to analyse recorded videos offline, e.g. to
+measure the footfall and the dwell time per hour in front of the exhibit, with
+the same detectors as the live applications.
+
+The video is split into chunks starting on keyframes (found with ffprobe when
+it is available), so that each chunk is decoded independently. The chunks are
+analysed in parallel by a pool of processes: one frame every sample_every
+frames is given to peopleDetectorDlib, the detections are associated with
+tracks by intersection over union, and optionally the faces are identified
+with the faceComparator of the face recognition application and assigned to the
+tracks containing them.
+
+Each chunk also analyses the first frames of the next chunk, so that the tracks
+of consecutive chunks can be stitched on these common frames. The resulting
+timeline is written as compressed columns (numpy .npz), with one row per
+detection:
+
+    frame, time, track, box (left, top, right, bottom), score, detector, identity
+
+where identity indexes the array names, -1 if nobody was identified.
+
+The analysis is run with
+
+    python videoAnalytics.py video.mp4 --output timeline.npz
+"""
+
+################################################################################
+# Imports.
+################################################################################
+
+# Utilitary packages.
+import argparse
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+# Packages for image processing.
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# Vectorized operations on boxes, and detectors.
+import boxUtils
+import peopleDetector
+
+
+################################################################################
+# Definition of global variables.
+################################################################################
+
+# The analyser of each worker process, created by _initWorker.
+_analyser = None
+
+
+################################################################################
+# Main content of the module.
+################################################################################
+
+def findKeyframes(file_name):
+    """
+    Returns the indexes of the keyframes of a video, in presentation order,
+    using ffprobe.
+
+    :param file_name: The video file.
+    :return: The sorted list of the indexes of the keyframes, or None if ffprobe is not available or fails.
+    """
+    if shutil.which('ffprobe') is None:
+        return None
+    try:
+        output = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', file_name], stdout = subprocess.PIPE, check = True, universal_newlines = True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    packets = []
+    for line in output.splitlines():
+        fields = line.strip().split(',')
+        if len(fields) < 2 or fields[0] in ('', 'N/A'):
+            continue
+        packets.append((float(fields[0]), 'K' in fields[1]))
+    # The packets are in decoding order: the index of a frame is its rank in presentation order.
+    packets.sort()
+    return [index for (index, (pts_time, keyframe)) in enumerate(packets) if keyframe]
+
+
+def splitChunks(file_name, chunk_size = 1800, min_chunks = 1):
+    """
+    Splits a video into chunks of about chunk_size frames, starting on keyframes
+    when they are known.
+
+    :param file_name: The video file.
+    :param chunk_size: The wanted number of frames per chunk.
+    :param min_chunks: The minimal number of chunks, e.g. to keep all worker processes busy.
+    :return: A list [(start, end)] of ranges of frames, with end None for the last chunk (which ends with the video).
+    """
+    video_capture = cv2.VideoCapture(file_name)
+    if not video_capture.isOpened():
+        raise IOError('Cannot read video ' + file_name)
+    nb_frames = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    video_capture.release()
+    keyframes = findKeyframes(file_name)
+    if keyframes is not None and len(keyframes) > 0:
+        nb_frames = max(nb_frames, keyframes[-1] + 1)
+    chunk_size = max(1, min(chunk_size, nb_frames // max(min_chunks, 1)))
+    # Place the boundaries on the keyframes closest to the multiples of chunk_size.
+    boundaries = list(range(chunk_size, nb_frames, chunk_size))
+    if keyframes is not None:
+        keyframes = np.array(keyframes)
+        boundaries = [int(keyframes[np.argmin(np.abs(keyframes - boundary))]) for boundary in boundaries] if len(keyframes) > 0 else []
+    starts = sorted(set([0] + [boundary for boundary in boundaries if 0 < boundary < nb_frames]))
+    return list(zip(starts, starts[1:] + [None]))
+
+
+class chunkAnalyser:
+    """
+    This class implements the analysis of a chunk of video in a worker process:
+    detection, tracking and optional identification.
+    """
+    def __init__(self, resize_factor = 2.0, sample_every = 5, iou_threshold = 0.3, max_missed = 2, database_file = None):
+        """
+        Initialization of the class.
+
+        :param resize_factor: The frames are downscaled by this factor before the detection.
+        :param sample_every: Only one frame every sample_every frames is analysed.
+        :param iou_threshold: The minimal intersection over union between the box of a track and a detection to associate them.
+        :param max_missed: The number of analysed frames without detection after which a track ends.
+        :param database_file: The prefix of the files of the face database (see databaseManager.py). By default, the faces are not identified.
+        """
+        # Initialize constructors.
+        self.resize_factor = resize_factor
+        self.sample_every = sample_every
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        # Initialize the detector.
+        self.detector = peopleDetector.peopleDetectorDlib()
+        # Initialize the identification, with the modules of the face recognition application.
+        self.face_comparator = None
+        self.database = None
+        if database_file is not None:
+            sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'facial_recognition_manager'))
+            import databaseManager
+            import facialRecognition
+            self.face_comparator = facialRecognition.faceComparator()
+            self.database = databaseManager.database(file_name = database_file)
+
+
+    def _identify(self, frame, boxes):
+        """
+        Identifies the faces of a frame, and assigns them to the boxes containing their center.
+
+        :param frame: The BGR frame.
+        :param boxes: The (N, 4) array of boxes of the detections in the frame.
+        :return: The list of the names of the detections, None if nobody was identified.
+        """
+        names = [None] * len(boxes)
+        if self.face_comparator is None or len(boxes) == 0:
+            return names
+        for (name, distance, (top, right, bottom, left)) in self.face_comparator.analyseFrame(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), self.database):
+            if name == 'Unknown':
+                continue
+            (x, y) = ((left + right) / 2, (top + bottom) / 2)
+            inside = np.flatnonzero((boxes[:, 0] <= x) & (x <= boxes[:, 2]) & (boxes[:, 1] <= y) & (y <= boxes[:, 3]))
+            if len(inside) > 0:
+                # Assign the face to the smallest box containing it.
+                names[inside[np.argmin(boxUtils.areas(boxes[inside], offset = 1))]] = name
+        return names
+
+
+    def analyseChunk(self, file_name, start, end):
+        """
+        Analyses the frames of a video in [start, end).
+
+        :param file_name: The video file.
+        :param start: The first frame.
+        :param end: The frame after the last one, None for the end of the video.
+        :return: A dictionary of columns frame, track, box, score, detector and name, with the tracks numbered from 0 in the chunk.
+        """
+        video_capture = cv2.VideoCapture(file_name)
+        video_capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        rows = {'frame': [], 'track': [], 'box': [], 'score': [], 'detector': [], 'name': []}
+        # Initialize tracks as lists [track, box, missed].
+        tracks = []
+        nb_tracks = 0
+        index = start
+        while end is None or index < end:
+            # Only decode the analysed frames, aligned on the whole video so that consecutive chunks analyse the same frames.
+            if index % self.sample_every != 0:
+                if not video_capture.grab():
+                    break
+                index += 1
+                continue
+            ret, frame = video_capture.read()
+            if not ret:
+                break
+            small_frame = cv2.resize(frame, (0, 0), fx = 1 / self.resize_factor, fy = 1 / self.resize_factor, interpolation = cv2.INTER_AREA)
+            detections = self.detector.getLocations(small_frame)
+            detections['box'] = np.rint(detections['box'] * self.resize_factor)
+            # Associate the detections with the tracks, maximizing the total intersection over union.
+            boxes = np.array([element[1] for element in tracks]).reshape((-1, 4))
+            overlaps = boxUtils.iou(boxes, detections['box'], offset = 1)
+            (track_rows, detection_rows) = linear_sum_assignment(-overlaps)
+            matched = overlaps[track_rows, detection_rows] >= self.iou_threshold
+            detection_tracks = np.full(len(detections), -1)
+            for (track_row, detection_row) in zip(track_rows[matched], detection_rows[matched]):
+                tracks[track_row][1] = detections['box'][detection_row]
+                tracks[track_row][2] = -1
+                detection_tracks[detection_row] = tracks[track_row][0]
+            # End the tracks without detection for too long, and start tracks for the new detections.
+            for element in tracks:
+                element[2] += 1
+            tracks = [element for element in tracks if element[2] <= self.max_missed]
+            for detection_row in np.flatnonzero(detection_tracks < 0):
+                tracks.append([nb_tracks, detections['box'][detection_row], 0])
+                detection_tracks[detection_row] = nb_tracks
+                nb_tracks += 1
+            # Record the detections.
+            rows['frame'].extend([index] * len(detections))
+            rows['track'].extend(detection_tracks.tolist())
+            rows['box'].append(detections['box'])
+            rows['score'].append(detections['score'])
+            rows['detector'].append(detections['detector'])
+            rows['name'].extend(self._identify(frame, detections['box']))
+            index += 1
+        video_capture.release()
+        return {'frame': np.array(rows['frame'], dtype = np.int64),
+                'track': np.array(rows['track'], dtype = np.int64),
+                'box': np.concatenate(rows['box']) if len(rows['box']) > 0 else np.zeros((0, 4), dtype = np.int32),
+                'score': np.concatenate(rows['score']) if len(rows['score']) > 0 else np.zeros(0, dtype = np.float32),
+                'detector': np.concatenate(rows['detector']) if len(rows['detector']) > 0 else np.zeros(0, dtype = np.int16),
+                'name': rows['name']}
+
+
+def _initWorker(options):
+    """
+    Initializes the analyser of a worker process.
+
+    :param options: The keyword arguments of chunkAnalyser.
+    """
+    global _analyser
+    _analyser = chunkAnalyser(**options)
+
+
+def _analyseChunkWorker(task):
+    """
+    Analyses a chunk in a worker process.
+
+    :param task: A tuple (chunk index, file name, start, end).
+    :return: A tuple (chunk index, columns).
+    """
+    (chunk_index, file_name, start, end) = task
+    return (chunk_index, _analyser.analyseChunk(file_name, start, end))
+
+
+def stitchChunks(results, starts, iou_threshold = 0.3):
+    """
+    Stitches the tracks of consecutive chunks into global tracks. The tracks of
+    two consecutive chunks are matched on the frames analysed by both, by their
+    average intersection over union, and the rows of the first chunk on these
+    frames are then dropped.
+
+    :param results: The list of the columns of each chunk, in the order of the video.
+    :param starts: The list of the first frame of each chunk.
+    :param iou_threshold: The minimal average intersection over union between two tracks to stitch them.
+    :return: A dictionary of columns frame, track, box, score, detector and name, with global tracks.
+    """
+    columns = {'frame': [], 'track': [], 'box': [], 'score': [], 'detector': [], 'name': []}
+    nb_tracks = 0
+    # Global tracks of the local tracks of the previous chunk.
+    previous_tracks = {}
+    for (chunk_index, result) in enumerate(results):
+        global_tracks = {}
+        # Match the tracks with the tracks of the previous chunk, on the common frames.
+        if chunk_index > 0:
+            previous = results[chunk_index - 1]
+            common_frames = np.intersect1d(previous['frame'][previous['frame'] >= starts[chunk_index]], result['frame'])
+            previous_ids = np.unique(previous['track'][np.isin(previous['frame'], common_frames)])
+            current_ids = np.unique(result['track'][np.isin(result['frame'], common_frames)])
+            if len(previous_ids) > 0 and len(current_ids) > 0:
+                overlaps = np.zeros((len(previous_ids), len(current_ids)))
+                presences = np.zeros((len(previous_ids), len(current_ids)))
+                for frame in common_frames:
+                    previous_rows = np.flatnonzero(previous['frame'] == frame)
+                    current_rows = np.flatnonzero(result['frame'] == frame)
+                    (i, j) = (np.searchsorted(previous_ids, previous['track'][previous_rows]), np.searchsorted(current_ids, result['track'][current_rows]))
+                    overlaps[np.ix_(i, j)] += boxUtils.iou(previous['box'][previous_rows], result['box'][current_rows], offset = 1)
+                    # Count the frames on which either track is present.
+                    present_previous = np.zeros(len(previous_ids), dtype = bool)
+                    present_previous[i] = True
+                    present_current = np.zeros(len(current_ids), dtype = bool)
+                    present_current[j] = True
+                    presences += present_previous[:, np.newaxis] | present_current[np.newaxis, :]
+                scores = overlaps / np.maximum(presences, 1)
+                (previous_rows, current_rows) = linear_sum_assignment(-scores)
+                for (i, j) in zip(previous_rows, current_rows):
+                    if scores[i, j] >= iou_threshold:
+                        global_tracks[current_ids[j]] = previous_tracks[previous_ids[i]]
+        # Number the other tracks.
+        for track in np.unique(result['track']).tolist():
+            if track not in global_tracks:
+                global_tracks[track] = nb_tracks
+                nb_tracks += 1
+        # Keep the rows until the start of the next chunk.
+        keep = result['frame'] < starts[chunk_index + 1] if chunk_index + 1 < len(results) else np.ones(len(result['frame']), dtype = bool)
+        columns['frame'].append(result['frame'][keep])
+        columns['track'].append(np.array([global_tracks[track] for track in result['track'][keep].tolist()], dtype = np.int64))
+        columns['box'].append(result['box'][keep])
+        columns['score'].append(result['score'][keep])
+        columns['detector'].append(result['detector'][keep])
+        columns['name'].extend([name for (name, kept) in zip(result['name'], keep) if kept])
+        previous_tracks = global_tracks
+    return {'frame': np.concatenate(columns['frame']) if len(results) > 0 else np.zeros(0, dtype = np.int64),
+            'track': np.concatenate(columns['track']) if len(results) > 0 else np.zeros(0, dtype = np.int64),
+            'box': np.concatenate(columns['box']) if len(results) > 0 else np.zeros((0, 4), dtype = np.int32),
+            'score': np.concatenate(columns['score']) if len(results) > 0 else np.zeros(0, dtype = np.float32),
+            'detector': np.concatenate(columns['detector']) if len(results) > 0 else np.zeros(0, dtype = np.int16),
+            'name': columns['name']}
+
+
+def writeTimeline(file_name, columns, fps):
+    """
+    Writes the timeline as compressed columns, with the smallest sufficient types.
+
+    :param file_name: The .npz file of the timeline.
+    :param columns: The columns returned by stitchChunks.
+    :param fps: The frame rate of the video.
+    """
+    names = np.array(sorted(set(name for name in columns['name'] if name is not None)), dtype = str)
+    lookup = {name: identity for (identity, name) in enumerate(names.tolist())}
+    identities = np.array([lookup.get(name, -1) for name in columns['name']], dtype = np.int16 if len(names) < 2 ** 15 else np.int32)
+    np.savez_compressed(file_name,
+                        frame = columns['frame'].astype(np.int32),
+                        time = (columns['frame'] / fps).astype(np.float32),
+                        track = columns['track'].astype(np.int32),
+                        box = columns['box'].astype(np.int16),
+                        score = columns['score'].astype(np.float32),
+                        detector = columns['detector'].astype(np.int8),
+                        identity = identities,
+                        names = names,
+                        fps = np.float64(fps))
+
+
+def summarize(timeline, period = 3600.0, start_time = 0.0):
+    """
+    Computes the footfall and the dwell times per period from a timeline.
+
+    :param timeline: The columns of the timeline, as loaded from the .npz file.
+    :param period: The duration of a period, in seconds.
+    :param start_time: The time of the beginning of the video, in seconds, e.g. to align the periods on the hours of the day.
+    :return: A list [(period start, footfall, mean dwell time, maximal dwell time)] where the footfall counts the tracks appearing in the period.
+    """
+    if len(timeline['track']) == 0:
+        return []
+    tracks, inverse = np.unique(timeline['track'], return_inverse = True)
+    times = timeline['time'].astype(np.float64) + start_time
+    # Compute the first and last times of each track.
+    first_times = np.full(len(tracks), np.inf)
+    last_times = np.full(len(tracks), -np.inf)
+    np.minimum.at(first_times, inverse, times)
+    np.maximum.at(last_times, inverse, times)
+    dwell_times = last_times - first_times
+    periods = np.floor(first_times / period).astype(np.int64)
+    summary = []
+    for index in np.unique(periods).tolist():
+        in_period = periods == index
+        summary.append((index * period, int(in_period.sum()), float(dwell_times[in_period].mean()), float(dwell_times[in_period].max())))
+    return summary
+
+
+def analyseVideo(file_name, output_file, nb_workers = os.cpu_count(), chunk_size = 1800, resize_factor = 2.0, sample_every = 5, overlap = 3, iou_threshold = 0.3, max_missed = 2, database_file = None):
+    """
+    Analyses a video in parallel, and writes its timeline.
+
+    :param file_name: The video file.
+    :param output_file: The .npz file of the timeline.
+    :param nb_workers: The number of worker processes. With 0, the chunks are analysed in the current process.
+    :param chunk_size: The wanted number of frames per chunk.
+    :param resize_factor: The frames are downscaled by this factor before the detection.
+    :param sample_every: Only one frame every sample_every frames is analysed.
+    :param overlap: The number of analysed frames of the next chunk also analysed by each chunk, to stitch the tracks.
+    :param iou_threshold: The minimal intersection over union to associate detections and to stitch tracks.
+    :param max_missed: The number of analysed frames without detection after which a track ends.
+    :param database_file: The prefix of the files of the face database. By default, the faces are not identified.
+    :return: The columns of the timeline.
+    """
+    video_capture = cv2.VideoCapture(file_name)
+    fps = video_capture.get(cv2.CAP_PROP_FPS) or 30.0
+    video_capture.release()
+    # Split the video, with at least two chunks per worker to balance their loads.
+    chunks = splitChunks(file_name, chunk_size, 2 * max(nb_workers, 1))
+    starts = [start for (start, end) in chunks]
+    tasks = [(chunk_index, file_name, start, None if end is None else end + overlap * sample_every) for (chunk_index, (start, end)) in enumerate(chunks)]
+    options = {'resize_factor': resize_factor, 'sample_every': sample_every, 'iou_threshold': iou_threshold, 'max_missed': max_missed, 'database_file': database_file}
+    # Analyse the chunks.
+    start_time = time.time()
+    results = [None] * len(chunks)
+    if nb_workers <= 0:
+        _initWorker(options)
+        for task in tasks:
+            (chunk_index, result) = _analyseChunkWorker(task)
+            results[chunk_index] = result
+    else:
+        with multiprocessing.Pool(nb_workers, initializer = _initWorker, initargs = (options,)) as pool:
+            for (nb_done, (chunk_index, result)) in enumerate(pool.imap_unordered(_analyseChunkWorker, tasks)):
+                results[chunk_index] = result
+                print('Analysed chunk ' + str(nb_done + 1) + '/' + str(len(tasks)) + ' after ' + str(round(time.time() - start_time, 1)) + ' s.')
+    # Stitch the chunks and write the timeline.
+    columns = stitchChunks(results, starts, iou_threshold)
+    writeTimeline(output_file, columns, fps)
+    return columns
+
+
+if __name__ == '__main__':
+    # Parse arguments.
+    parser = argparse.ArgumentParser(description = 'Analyses a recorded video offline, and writes the timeline of the detected people.')
+    parser.add_argument('video', help = 'The video file.')
+    parser.add_argument('--output', default = 'timeline.npz', help = 'The .npz file of the timeline.')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'Number of worker processes. With 0, the video is analysed in the current process.')
+    parser.add_argument('--chunk-size', type = int, default = 1800, help = 'Wanted number of frames per chunk.')
+    parser.add_argument('--resize-factor', type = float, default = 2.0, help = 'The frames are downscaled by this factor before the detection.')
+    parser.add_argument('--sample-every', type = int, default = 5, help = 'Only one frame every sample-every frames is analysed.')
+    parser.add_argument('--database', default = None, help = 'Prefix of the files of the face database, to identify the faces.')
+    parser.add_argument('--start-time', type = float, default = 0.0, help = 'Time of the beginning of the video in seconds since midnight, to align the summary on the hours of the day.')
+    arguments = parser.parse_args()
+
+    analyseVideo(arguments.video, arguments.output, arguments.workers, arguments.chunk_size, arguments.resize_factor, arguments.sample_every, database_file = arguments.database)
+    timeline = np.load(arguments.output)
+    # Print the footfall and the dwell times per hour.
+    for (period_start, footfall, mean_dwell, max_dwell) in summarize(timeline, 3600.0, arguments.start_time):
+        print(time.strftime('%H:%M', time.gmtime(period_start)) + ' footfall ' + str(footfall) + ', mean dwell ' + str(round(mean_dwell, 1)) + ' s, maximal dwell ' + str(round(max_dwell, 1)) + ' s.')
@@ -8,11 +8,30 @@ We will implement 4 functions :
     - GetImage(name) to retrieve a picture of a person knowing their name.
     - GetProfile(name) to retrieve the profile of a person knowing their name.
 
-Our implementation is based on an array of the form
+Our implementation is based on the columnar format implemented in faceStore.py,
+i.e. the columns
 
-    [(encodings, name, path_to_image, profile)]
+    encodings, squared_norms, identity_ids, paths
 
-for every stored image.
+for every stored image, and the columns
+
+    identity_names, identity_profiles
+
+for every person. The columns are opened as memory maps, and the encodings
+form one contiguous float32 matrix used for the search of the closest faces
+(see faceMatcher.py). The candidates for the closest faces are given by a
+pluggable index, either an exact linear scan or an approximate inverted file
+for large databases (see faceIndex.py).
+
+Additions and removals are recorded in a journal (see faceJournal.py) and
+applied in memory, the columns growing by doubling their capacity and removed
+images being marked by a tombstone. The journal is compacted into the columns
+on demand, or in the background once it holds compact_every records. When the
+database is opened, the journal is replayed on top of the columns.
+
+The rows of each person are kept in a lookup, so that the profile and the image
+of a person are found without scanning the database. The images returned by
+getImage are kept in a least recently used cache.
 """
 
 ###############################################################################
@@ -25,10 +44,15 @@ import shutil
 import re
 from os.path import join, split
 import os.path
+import threading
+import collections
 
 # Packages used for image processing and numeric computing.
 import numpy as np
 import facialRecognition
+import faceIndex
+import faceStore
+import faceJournal
 import cv2
 
 
@@ -40,29 +64,305 @@ class database:
     """
     A class for the management of the database.
     """
-    def __init__(self, file_name = join('Database','London_database')):
+    def __init__(self, file_name = join('Database','London_database'), index = None, compact_every = 1000, image_cache_size = 64 * 1024 * 1024):
         """
         Initialization of the class.
 
-        :param file_name: Filename to the numpy file containing the encoding
-        information. It must be an array of the form [(encodings, name, path_to_image, profile)]
+        :param file_name: Prefix of the numpy files containing the columns of the
+        database (see faceStore.py). If the database is still in the former format,
+        i.e. an array [(encodings, name, path_to_image, profile)] in file_name.npy,
+        it is converted first.
+        :param index: The index used to search the closest faces, as implemented in faceIndex.py. By default, an exact linear scan.
+        :param compact_every: The number of records in the journal after which the journal is compacted into the columns, in the background.
+        :param image_cache_size: The maximal size in bytes of the images kept in memory by getImage.
         """
         # Initialize constructor.
         self.file_name = file_name
+        self.compact_every = compact_every
+        self.image_cache = imageCache(image_cache_size)
+
+        # Default profile value.
+        self.DEFAULT_PROFILE = 'No Arup People profile'
 
-        # Open file.
+        # Initialize locks: one for the modifications of the database, one for the compactions.
+        self.lock = threading.RLock()
+        self.compaction_lock = threading.Lock()
+        self.compaction_thread = None
+
+        # Convert the database if it is in the former format.
+        if not faceStore.exists(self.file_name) and os.path.isfile(self.file_name + '.npy'):
+            print('Converting faces from file ' + self.file_name + '.npy')
+            faceStore.convert(self.file_name)
+
+        # Open files.
         print('Loading faces from file ' + self.file_name)
-        self.table_faces = np.load(self.file_name + '.npy')
-        print('Loaded ' + str(len(self.table_faces)) + ' faces.')
+        self._open()
+
+        # Initialize the index, from the file saved alongside the database if it is up to date.
+        self.index = index if index is not None else faceIndex.linearIndex()
+        if not self.index.load(self):
+            self.index.build(self)
+            self.index.save(self)
+
+        # Apply the modifications recorded in the journal since the last compaction.
+        self.journal = faceJournal.journal(self.file_name + '_journal.bin')
+        self.journal_length = 0
+        self._replay()
+        print('Loaded ' + str(self.size()) + ' faces.')
 
         # Get path to images folder.
-        self.folder_name_images = join(split(self.file_name)[0], split(split(self.table_faces[0][2])[0])[0])
+        self.folder_name_images = join(split(self.file_name)[0], split(split(self.paths[0].decode('utf-8'))[0])[0])
 
         # Initialize algorithm for facial recognition.
         self.facial_recognition = facialRecognition.faceComparator()
 
-        # Default profile value.
-        self.DEFAULT_PROFILE = 'No Arup People profile'
+
+    def _open(self):
+        """
+        Opens the columns of the database as memory maps.
+        """
+        store = faceStore.columnarStore(self.file_name)
+        self.sequence = store.sequence
+        self.nb_rows = len(store.encodings)
+        self.nb_alive = self.nb_rows
+        # Columns with one element per image. They are copied in memory at the first modification.
+        self.columns = {
+            'encodings': store.encodings,
+            'squared_norms': store.squared_norms,
+            'identity_ids': store.identity_ids,
+            'paths': store.paths,
+            'alive': np.ones(self.nb_rows, dtype = bool)
+        }
+        self._actualizeViews()
+        # Columns with one element per identity.
+        self.identity_names = store.identity_names
+        self.identity_profiles = store.identity_profiles
+        # The lookups from names to identities and from identities to rows are only built when needed.
+        self.identity_lookup = None
+        self.identity_rows = None
+
+
+    def _actualizeViews(self):
+        """
+        Actualizes the attributes giving the used part of each column.
+        """
+        self.encodings = self.columns['encodings'][:self.nb_rows]
+        self.squared_norms = self.columns['squared_norms'][:self.nb_rows]
+        self.identity_ids = self.columns['identity_ids'][:self.nb_rows]
+        self.paths = self.columns['paths'][:self.nb_rows]
+        self.alive = self.columns['alive'][:self.nb_rows]
+
+
+    def _reserve(self, nb_rows):
+        """
+        Makes sure that the columns can hold nb_rows images. The capacity of the
+        columns is doubled when needed, so that adding an image costs a constant
+        time on average.
+
+        :param nb_rows: The required number of images.
+        """
+        capacity = len(self.columns['encodings'])
+        # The memory maps are read-only, and are copied at the first modification.
+        if nb_rows <= capacity and self.columns['encodings'].flags.writeable:
+            return
+        new_capacity = max(16, 2 * capacity, nb_rows)
+        for (column, values) in self.columns.items():
+            new_values = np.zeros((new_capacity,) + values.shape[1:], dtype = values.dtype)
+            new_values[:self.nb_rows] = values[:self.nb_rows]
+            self.columns[column] = new_values
+        self._actualizeViews()
+
+
+    def _append(self, encoding, name, link):
+        """
+        Appends an image to the columns, without recording it in the journal.
+
+        :param encoding: The encoding of the image.
+        :param name: The name of the person in the image.
+        :param link: The path to the image.
+        """
+        self._reserve(self.nb_rows + 1)
+        # Widen the column of paths if the path is too long.
+        path = faceStore.encodeStrings([link])
+        if path.dtype.itemsize > self.columns['paths'].dtype.itemsize:
+            self.columns['paths'] = self.columns['paths'].astype(path.dtype)
+        # Write the new row.
+        row = self.nb_rows
+        encoding = np.array([encoding], dtype = np.float32)
+        identity = self._identity(name, create = True)
+        self.identity_rows[identity].append(row)
+        self.columns['encodings'][row] = encoding[0]
+        self.columns['squared_norms'][row] = np.einsum('ij,ij->i', encoding, encoding)[0]
+        self.columns['identity_ids'][row] = identity
+        self.columns['paths'][row] = path[0]
+        self.columns['alive'][row] = True
+        self.nb_rows += 1
+        self.nb_alive += 1
+        self._actualizeViews()
+        self.index.add(self, [row])
+
+
+    def _tombstone(self, link):
+        """
+        Marks the images with the given path as removed, without recording it in
+        the journal. The rows are only deleted from the files at the next
+        compaction.
+
+        :param link: The path to the removed image.
+        """
+        rows = np.flatnonzero((self.paths == link.encode('utf-8')) & self.alive)
+        self.alive[rows] = False
+        self.nb_alive -= len(rows)
+        self.index.remove(self, rows)
+        if self.identity_rows is not None:
+            for row in rows:
+                self.identity_rows[int(self.identity_ids[row])].remove(row)
+        self.image_cache.remove(link)
+
+
+    def _replay(self):
+        """
+        Applies the records of the journal that are not yet in the columns.
+        """
+        for (operation, sequence, encoding, name, link) in self.journal.read():
+            self.journal_length += 1
+            # The record was already compacted into the columns.
+            if sequence <= self.sequence:
+                continue
+            if operation == faceJournal.ADD:
+                self._append(encoding, name, link)
+            else:
+                self._tombstone(link)
+            self.sequence = sequence
+
+
+    def _record(self, operation, encoding = None, name = '', link = ''):
+        """
+        Records a modification in the journal and applies it.
+
+        :param operation: faceJournal.ADD or faceJournal.REMOVE.
+        :param encoding: The encoding of the added image.
+        :param name: The name of the person in the added image.
+        :param link: The path to the added or removed image.
+        """
+        with self.lock:
+            self.sequence += 1
+            self.journal.append(operation, self.sequence, encoding, name, link)
+            self.journal_length += 1
+            if operation == faceJournal.ADD:
+                self._append(encoding, name, link)
+            else:
+                self._tombstone(link)
+        # Compact the journal in the background when it becomes too long.
+        if self.journal_length >= self.compact_every:
+            self.compact(background = True)
+
+
+    def compact(self, background = False):
+        """
+        Writes the current state of the database in the columns, without the
+        removed images, and discards the corresponding records of the journal.
+
+        :param background: Whether to compact in a separate thread. The database can be used and modified meanwhile.
+        """
+        if not background:
+            self._compact()
+        elif self.compaction_thread is None or not self.compaction_thread.is_alive():
+            self.compaction_thread = threading.Thread(target = self._compact)
+            self.compaction_thread.start()
+
+
+    def _compact(self):
+        """
+        Compacts the journal into the columns.
+        """
+        with self.compaction_lock:
+            # Take a snapshot of the database. The rows of the snapshot are not modified by later additions.
+            with self.lock:
+                sequence = self.sequence
+                journal_offset = self.journal.size()
+                journal_length = self.journal_length
+                columns = dict(self.columns)
+                rows = np.flatnonzero(self.alive)
+                identity_names = self.identity_names
+                identity_profiles = self.identity_profiles
+            # Write the snapshot.
+            faceStore.write(self.file_name, columns['encodings'][rows], columns['identity_ids'][rows], columns['paths'][rows], identity_names, identity_profiles, sequence)
+            # Save the index and discard the compacted records.
+            with self.lock:
+                self.index.save(self, rows)
+                self.journal.discard(journal_offset)
+                self.journal_length -= journal_length
+
+
+    def close(self):
+        """
+        Waits for the end of the compaction, and closes the journal.
+        """
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+        self.journal.close()
+
+
+    def _buildLookups(self):
+        """
+        Builds the lookup from names to identities, and the lookup from identities
+        to the rows of their images. Both are then kept up to date by the
+        modifications of the database.
+        """
+        self.identity_lookup = {identity_name.decode('utf-8'): i for (i, identity_name) in enumerate(self.identity_names)}
+        self.identity_rows = {i: [] for i in range(len(self.identity_names))}
+        # Group the rows by identity.
+        rows = self.getRows()
+        rows = rows[np.argsort(self.identity_ids[rows], kind = 'stable')]
+        identities = self.identity_ids[rows]
+        for group in np.split(rows, np.flatnonzero(np.diff(identities)) + 1):
+            if len(group) > 0:
+                self.identity_rows[int(self.identity_ids[group[0]])] = group.tolist()
+
+
+    def _identity(self, name, create = False):
+        """
+        Returns the identity number corresponding to the name.
+
+        :param name: The considered name.
+        :param create: Whether to create the identity if the name is new.
+        :return: The identity number, or None if the name is unknown and create is False.
+        """
+        if self.identity_lookup is None:
+            self._buildLookups()
+        if create and name not in self.identity_lookup:
+            self.identity_lookup[name] = len(self.identity_names)
+            self.identity_rows[len(self.identity_names)] = []
+            self.identity_names = np.append(self.identity_names, faceStore.encodeStrings([name]))
+            self.identity_profiles = np.append(self.identity_profiles, faceStore.encodeStrings([self.DEFAULT_PROFILE]))
+        return self.identity_lookup.get(name)
+
+
+    def size(self):
+        """
+        Returns the number of stored images, without the removed ones.
+        """
+        return self.nb_alive
+
+
+    def getRows(self):
+        """
+        Returns the rows of the matrix of encodings that are not removed.
+        """
+        if self.nb_alive == self.nb_rows:
+            return np.arange(self.nb_rows)
+        return np.flatnonzero(self.alive)
+
+
+    def getNames(self, rows):
+        """
+        Returns the names corresponding to the given rows of the matrix of encodings.
+
+        :param rows: The considered rows.
+        :return: The list of names.
+        """
+        return [name.decode('utf-8') for name in self.identity_names[self.identity_ids[rows]]]
 
 
     def add(self, frame, face_name, file_name, check_name = True):
@@ -96,9 +396,8 @@ class database:
         if one_face_detected and not name_already_exists:
             # Save data
             link = join(self.folder_name_images, face_name, file_name) + '.jpg'
-            self.table_faces = np.append(self.table_faces, [(encodings[0], face_name, link, self.DEFAULT_PROFILE)], axis = 0)
-            cv2.imwrite(join(self.folder_name_images, face_name, file_name) + '.jpg', frame)
-            np.save(self.file_name, self.table_faces)
+            cv2.imwrite(link, frame)
+            self._record(faceJournal.ADD, encodings[0], face_name, link)
         # Return results.
         return name_already_exists, one_face_detected
 
@@ -111,8 +410,8 @@ class database:
         :param link: The link to the image we want to erase.
         :param hard_remove: Parameter to decide whether or not we physically erase the image from the computer.
         """
-        # Remove the corresponding list to table_faces.
-        self.table_faces = list(filter(lambda x : x[2] != link, self.table_faces))
+        # Remove the corresponding rows from the database.
+        self._record(faceJournal.REMOVE, link = link)
         # Try to remove from folder if required.
         if hard_remove:
             try:
@@ -123,8 +422,6 @@ class database:
                     shutil.rmtree(link_to_folder)
             except Exception:
                 print('Hard remove did not succeed.')
-        # Actualize database.
-        np.save(self.file_name, self.table_faces)
 
 
     def getImage(self, name):
@@ -134,14 +431,27 @@ class database:
         :param name: The considered name.
         :return: The corresponding image. Returns None if no image is found (even though it should not happen).
         """
+        # Get the identity first, since it builds the lookups on the first call.
+        identity = self._identity(name)
+        if identity is None or len(self.identity_rows[identity]) == 0:
+            # Unknown name, or every image of the person has been removed.
+            return None
+        # Get link to image from the first image of the person.
+        row = self.identity_rows[identity][0]
         try:
-            # Get link to image from the table of encodings.
-            link = [path_to_image for (encoding, user_name, path_to_image, profile) in self.table_faces if user_name == name][0]
-            # Return cv2 image.
-            return cv2.imread(link)
-        except:
-            # Return default value.
+            link = self.paths[row].decode('utf-8')
+        except UnicodeDecodeError:
             return None
+        # Read the image, unless it is in the cache.
+        image = self.image_cache.get(link)
+        if image is None:
+            image = cv2.imread(link)
+            if image is None:
+                # The file is missing or unreadable.
+                return None
+            self.image_cache.put(link, image)
+        # Return a copy of the cv2 image, so that the cached image is not modified.
+        return image.copy()
 
 
     def getProfile(self, name):
@@ -152,8 +462,68 @@ class database:
         :return: A string corresponding to the profile. Either precomputed profile or 'Unable to match description with profile' if name is not in the database (even though it should not happen).
         """
         try:
-            # Get profile from the table of encodings.
-            return [profile for (encoding, user_name, path_to_image, profile) in self.table_faces if user_name == name][0]
+            # Get profile from the profiles of the identities.
+            identity = self._identity(name)
+            if identity is None:
+                return self.DEFAULT_PROFILE
+            return self.identity_profiles[identity].decode('utf-8')
         except:
             # Return default value.
             return self.DEFAULT_PROFILE
+
+
+class imageCache:
+    """
+    A class to keep the least recently used images in memory, within a maximal
+    total size.
+    """
+    def __init__(self, max_bytes = 64 * 1024 * 1024):
+        """
+        Initialization of the class.
+
+        :param max_bytes: The maximal total size of the kept images, in bytes.
+        """
+        self.max_bytes = max_bytes
+        self.nb_bytes = 0
+        self.images = collections.OrderedDict()
+
+
+    def get(self, key):
+        """
+        Returns the image corresponding to the key, or None if it is not kept.
+
+        :param key: The key of the image.
+        """
+        image = self.images.get(key)
+        if image is not None:
+            self.images.move_to_end(key)
+        return image
+
+
+    def put(self, key, image):
+        """
+        Keeps the image, and forgets the least recently used images if the total
+        size goes over max_bytes.
+
+        :param key: The key of the image.
+        :param image: The image as numpy array. None and images larger than max_bytes are not kept.
+        """
+        if image is None or image.nbytes > self.max_bytes:
+            return
+        self.remove(key)
+        self.images[key] = image
+        self.nb_bytes += image.nbytes
+        while self.nb_bytes > self.max_bytes:
+            (old_key, old_image) = self.images.popitem(last = False)
+            self.nb_bytes -= old_image.nbytes
+
+
+    def remove(self, key):
+        """
+        Forgets the image corresponding to the key, if it is kept.
+
+        :param key: The key of the image.
+        """
+        image = self.images.pop(key, None)
+        if image is not None:
+            self.nb_bytes -= image.nbytes
@@ -0,0 +1,408 @@
+"""
+The purpose of this module is to implement the indexes used by the database to
+find the candidates for the closest faces.
+
+Each index must implement the functions
+
+    build(database)
+    add(database, rows)
+    remove(database, rows)
+    save(database, rows = None)
+    load(database)
+    candidates(database, face_encodings)
+
+where remove marks rows as removed without renumbering the others (the database
+keeps tombstones until its next compaction), save saves the index restricted to
+the given rows (by default, the rows that are not removed), and candidates returns, for each encoding, the rows of the database that may
+be the closest ones along with their approximate squared distances (the exact
+distances are then recomputed by the face matcher, see faceMatcher.py).
+
+We implement two indexes:
+
+    - linearIndex, an exact linear scan over all the rows.
+    - ivfIndex, an inverted file index: the encodings are clustered with k-means
+    and only the rows of the nb_probes closest clusters are scanned. nb_probes
+    is the knob between recall and latency.
+"""
+
+###############################################################################
+# Imports.
+###############################################################################
+
+# Utilitary packages.
+import os.path
+import threading
+
+# Packages for numeric computations.
+import numpy as np
+
+# On-disk format of the database.
+import faceStore
+
+
+###############################################################################
+# Main content of the module.
+###############################################################################
+
+def squaredDistances(encodings, squared_norms, face_encodings):
+    """
+    Computes the approximate squared distances between a batch of encodings and
+    the rows of a matrix of encodings, with a single matrix product:
+
+        ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+
+    :param encodings: The (N, 128) float32 matrix of encodings.
+    :param squared_norms: The (N,) float32 array of the squared norms of the rows of encodings.
+    :param face_encodings: The (M, 128) array of encodings to compare.
+    :return: The (M, N) float32 array of squared distances.
+    """
+    queries = np.asarray(face_encodings, dtype = np.float32)
+    distances = queries @ encodings.T
+    distances *= -2
+    distances += squared_norms[np.newaxis, :]
+    distances += np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+    # Rounding errors may give small negative values.
+    np.maximum(distances, 0, out = distances)
+    return distances
+
+
+class linearIndex:
+    """
+    An exact index: every row of the database is a candidate.
+    """
+    def build(self, database):
+        """
+        Builds the index. Nothing to do for a linear scan.
+
+        :param database: The indexed database.
+        """
+        pass
+
+
+    def add(self, database, rows):
+        """
+        Adds rows to the index. Nothing to do for a linear scan.
+
+        :param database: The indexed database.
+        :param rows: The rows appended to the database.
+        """
+        pass
+
+
+    def remove(self, database, rows):
+        """
+        Removes rows from the index. Nothing to do for a linear scan.
+
+        :param database: The indexed database.
+        :param rows: The rows removed from the database.
+        """
+        pass
+
+
+    def save(self, database, rows = None):
+        """
+        Saves the index. Nothing to do for a linear scan.
+
+        :param database: The indexed database.
+        :param rows: The saved rows.
+        """
+        pass
+
+
+    def load(self, database):
+        """
+        Loads the index. Nothing to do for a linear scan.
+
+        :param database: The indexed database.
+        :return: Whether the index was loaded.
+        """
+        return True
+
+
+    def candidates(self, database, face_encodings):
+        """
+        Returns all the rows of the database that are not removed as candidates
+        for each encoding.
+
+        :param database: The indexed database.
+        :param face_encodings: The (M, 128) array of encodings to compare.
+        :return: A list [(rows, squared_distances)] with one element per encoding.
+        """
+        distances = squaredDistances(database.encodings, database.squared_norms, face_encodings)
+        rows = database.getRows()
+        if len(rows) < len(database.encodings):
+            distances = distances[:, rows]
+        return [(rows, distances[i]) for i in range(len(distances))]
+
+
+class ivfIndex:
+    """
+    An approximate index based on an inverted file: the encodings are clustered
+    with k-means, and for each encoding we only scan the rows of the closest
+    clusters.
+
+    Below min_size rows, the index falls back to a linear scan. When additions
+    make the database large enough, the clustering runs in a background thread
+    and the linear scan is used until it is done.
+    """
+    def __init__(self, nb_lists = None, nb_probes = 8, min_size = 10000, nb_iterations = 10, sample_size = 100000, batch_size = 16384, seed = 0, background = True):
+        """
+        Initialization of the class.
+
+        :param nb_lists: The number of clusters. By default, 4 * sqrt(N).
+        :param nb_probes: The number of clusters scanned for each encoding. Higher is more accurate, but slower. With nb_probes = nb_lists, the search is exact.
+        :param min_size: Below this number of rows, we do not cluster and use a linear scan.
+        :param nb_iterations: The number of iterations of k-means.
+        :param sample_size: The maximal number of rows used to train k-means.
+        :param batch_size: The number of rows assigned to clusters at once, to bound memory usage.
+        :param seed: The seed of the random generator, so that the clustering is reproducible.
+        :param background: Whether the clustering triggered by an addition runs in a background thread, instead of the thread of the caller.
+        """
+        # Initialize constructors.
+        self.nb_lists = nb_lists
+        self.nb_probes = nb_probes
+        self.min_size = min_size
+        self.nb_iterations = nb_iterations
+        self.sample_size = sample_size
+        self.batch_size = batch_size
+        self.seed = seed
+        self.background = background
+        # Initialize the linear scan used as fallback.
+        self.linear_index = linearIndex()
+        # Initialize clusters. None means that we use the linear scan.
+        self.centroids = None
+        self.assignments = None
+        self.lists = None
+        # Initialize the thread of the clustering in the background.
+        self.build_thread = None
+
+
+    def _fileName(self, database):
+        """
+        Returns the file in which the index is saved, alongside the database.
+
+        :param database: The indexed database.
+        """
+        return database.file_name + '_index.npz'
+
+
+    def _columnsVersion(self, database):
+        """
+        Returns the version and the sequence number of the columns of the
+        database, as written in their manifest, which identify the content of the
+        database the index is built for without reading the encodings.
+
+        :param database: The indexed database.
+        :return: A tuple (version, sequence), or None if the columns have no manifest.
+        """
+        manifest = faceStore.readManifest(database.file_name)
+        if manifest is None:
+            return None
+        return (manifest['version'], manifest['sequence'])
+
+
+    def _assign(self, encodings, squared_norms, centroids = None):
+        """
+        Returns the closest cluster of each encoding.
+
+        :param encodings: The (N, 128) float32 matrix of encodings.
+        :param squared_norms: The (N,) array of the squared norms of the rows of encodings.
+        :param centroids: The centroids of the clusters. By default, the centroids of the index.
+        :return: The (N,) int32 array of clusters.
+        """
+        if centroids is None:
+            centroids = self.centroids
+        assignments = np.zeros(len(encodings), dtype = np.int32)
+        centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        for start in range(0, len(encodings), self.batch_size):
+            distances = squaredDistances(centroids, centroid_norms, encodings[start:start + self.batch_size])
+            assignments[start:start + self.batch_size] = np.argmin(distances, axis = 1)
+        return assignments
+
+
+    def _buildLists(self, database):
+        """
+        Builds the list of rows of each cluster from the assignments, without the
+        removed rows.
+
+        :param database: The indexed database.
+        """
+        order = np.argsort(self.assignments, kind = 'stable')
+        order = order[database.alive[order]]
+        bounds = np.searchsorted(self.assignments[order], np.arange(1, len(self.centroids)))
+        self.lists = np.split(order, bounds)
+
+
+    def _train(self, encodings, squared_norms, rows):
+        """
+        Clusters the encodings of the given rows with k-means.
+
+        :param encodings: The (N, 128) float32 matrix of encodings.
+        :param squared_norms: The (N,) array of the squared norms of the rows of encodings.
+        :param rows: The clustered rows.
+        :return: The centroids of the clusters.
+        """
+        # Initialize the centroids with random rows of a training sample.
+        random = np.random.RandomState(self.seed)
+        nb_lists = self.nb_lists if self.nb_lists is not None else int(4 * np.sqrt(len(rows)))
+        sample = np.sort(random.choice(rows, min(len(rows), self.sample_size), replace = False))
+        training = np.ascontiguousarray(encodings[sample])
+        training_norms = squared_norms[sample]
+        centroids = training[random.choice(len(training), nb_lists, replace = False)].copy()
+        # Run k-means.
+        for iteration in range(self.nb_iterations):
+            assignments = self._assign(training, training_norms, centroids)
+            counts = np.bincount(assignments, minlength = nb_lists)
+            # Sum the rows of each cluster, with the rows sorted by cluster.
+            order = np.argsort(assignments, kind = 'stable')
+            non_empty = counts > 0
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty]
+            sums = np.add.reduceat(training[order], starts, axis = 0)
+            # Empty clusters keep their previous centroid.
+            centroids[non_empty] = sums / counts[non_empty, np.newaxis]
+        return centroids
+
+
+    def build(self, database):
+        """
+        Clusters the encodings of the database with k-means, and assigns each row
+        to its closest cluster.
+
+        :param database: The indexed database.
+        """
+        rows = database.getRows()
+        # Use a linear scan for small databases.
+        if len(rows) < self.min_size:
+            self.centroids = None
+            self.assignments = None
+            self.lists = None
+            return
+        self.centroids = self._train(database.encodings, database.squared_norms, rows)
+        # Assign every row.
+        self.assignments = self._assign(database.encodings, database.squared_norms)
+        self._buildLists(database)
+
+
+    def _buildInBackground(self, database):
+        """
+        Clusters the encodings of the database without holding its lock, then
+        assigns the rows added in the meantime and switches from the linear scan
+        to the clusters.
+
+        :param database: The indexed database.
+        """
+        # Take a snapshot of the rows. The rows already written are not modified by later additions.
+        with database.lock:
+            encodings = database.encodings
+            squared_norms = database.squared_norms
+            rows = database.getRows()
+        centroids = self._train(encodings, squared_norms, rows)
+        assignments = self._assign(encodings, squared_norms, centroids)
+        with database.lock:
+            # Assign the rows added during the clustering.
+            nb_assigned = len(assignments)
+            if len(database.encodings) > nb_assigned:
+                assignments = np.concatenate((assignments, self._assign(database.encodings[nb_assigned:], database.squared_norms[nb_assigned:], centroids)))
+            self.centroids = centroids
+            self.assignments = assignments
+            self._buildLists(database)
+
+
+    def add(self, database, rows):
+        """
+        Assigns the new rows to their closest cluster.
+
+        :param database: The indexed database.
+        :param rows: The rows appended to the database.
+        """
+        # Cluster the database once it becomes large enough. The rows added meanwhile are assigned at the end of the clustering.
+        if self.centroids is None:
+            if database.size() >= self.min_size:
+                if not self.background:
+                    self.build(database)
+                elif self.build_thread is None or not self.build_thread.is_alive():
+                    self.build_thread = threading.Thread(target = self._buildInBackground, args = (database,), daemon = True)
+                    self.build_thread.start()
+            return
+        rows = np.asarray(rows, dtype = np.int64)
+        assignments = self._assign(database.encodings[rows], database.squared_norms[rows])
+        self.assignments = np.concatenate((self.assignments, assignments))
+        for (row, cluster) in zip(rows, assignments):
+            self.lists[cluster] = np.append(self.lists[cluster], row)
+
+
+    def remove(self, database, rows):
+        """
+        Removes rows from their clusters.
+
+        :param database: The indexed database.
+        :param rows: The rows removed from the database.
+        """
+        if self.centroids is None:
+            return
+        for row in rows:
+            cluster = self.assignments[row]
+            self.lists[cluster] = self.lists[cluster][self.lists[cluster] != row]
+
+
+    def save(self, database, rows = None):
+        """
+        Saves the index alongside the database.
+
+        :param database: The indexed database.
+        :param rows: The saved rows, i.e. the rows written in the files of the database. By default, the rows that are not removed.
+        """
+        columns_version = self._columnsVersion(database)
+        if self.centroids is None or columns_version is None:
+            return
+        if rows is None:
+            rows = database.getRows()
+        (version, sequence) = columns_version
+        np.savez(self._fileName(database), centroids = self.centroids, assignments = self.assignments[rows], version = version, sequence = sequence)
+
+
+    def load(self, database):
+        """
+        Loads the index saved alongside the database, if it was saved for the
+        current columns of the database, as checked with the version and the
+        sequence number of their manifest.
+
+        :param database: The indexed database.
+        :return: Whether the index was loaded.
+        """
+        columns_version = self._columnsVersion(database)
+        if columns_version is None or not os.path.isfile(self._fileName(database)):
+            return False
+        with np.load(self._fileName(database)) as data:
+            # Check that the index corresponds to the database.
+            if 'version' not in data.files or len(data['assignments']) != database.size():
+                return False
+            if (int(data['version']), int(data['sequence'])) != columns_version:
+                return False
+            self.centroids = data['centroids']
+            self.assignments = data['assignments']
+        self._buildLists(database)
+        return True
+
+
+    def candidates(self, database, face_encodings):
+        """
+        Returns the rows of the nb_probes closest clusters as candidates for each
+        encoding.
+
+        :param database: The indexed database.
+        :param face_encodings: The (M, 128) array of encodings to compare.
+        :return: A list [(rows, squared_distances)] with one element per encoding.
+        """
+        if self.centroids is None:
+            return self.linear_index.candidates(database, face_encodings)
+        # Find the closest clusters of each encoding.
+        centroid_distances = squaredDistances(self.centroids, np.einsum('ij,ij->i', self.centroids, self.centroids), face_encodings)
+        nb_probes = min(self.nb_probes, len(self.centroids))
+        probes = np.argpartition(centroid_distances, nb_probes - 1, axis = 1)[:, :nb_probes]
+        # Scan the rows of these clusters.
+        result = []
+        for (face_encoding, clusters) in zip(face_encodings, probes):
+            rows = np.concatenate([self.lists[cluster] for cluster in clusters])
+            result.append((rows, squaredDistances(database.encodings[rows], database.squared_norms[rows], [face_encoding])[0]))
+        return result
@@ -0,0 +1,162 @@
+"""
+The purpose of this module is to implement the journal of the database.
+
+Instead of rewriting the whole database for every added or removed image, the
+database appends a small record to the journal file, and regularly compacts the
+journal into its columns (see databaseManager.py and faceStore.py).
+
+Each record is made of a header
+
+    operation (1 byte), sequence (8 bytes), name length (2 bytes), path length (2 bytes), crc32 (4 bytes)
+
+followed by the payload
+
+    encoding (128 float32), name, path     for the operation ADD
+    path                                   for the operation REMOVE
+
+The sequence numbers increase with every record. The crc32 covers the header
+and the payload, so that a record partially written during a crash is detected
+and dropped when the journal is replayed.
+"""
+
+###############################################################################
+# Imports.
+###############################################################################
+
+# Utilitary packages.
+import os
+import os.path
+import struct
+import zlib
+
+# Packages for numeric computations.
+import numpy as np
+
+
+###############################################################################
+# Definition of global variables.
+###############################################################################
+
+ADD = b'A'
+REMOVE = b'R'
+HEADER = struct.Struct('<cQHHI')
+ENCODING_SIZE = 128 * 4
+
+
+###############################################################################
+# Main content of the module.
+###############################################################################
+
+class journal:
+    """
+    A class for the management of the journal of the database.
+    """
+    def __init__(self, file_name):
+        """
+        Initialization of the class.
+
+        :param file_name: The journal file.
+        """
+        self.file_name = file_name
+        self.file = None
+
+
+    def _checksum(self, operation, sequence, name, path, payload):
+        """
+        Computes the crc32 of a record.
+        """
+        return zlib.crc32(HEADER.pack(operation, sequence, len(name), len(path), 0) + payload)
+
+
+    def read(self):
+        """
+        Reads the valid records of the journal. Reading stops at the first
+        truncated or corrupted record, and the journal is truncated after the last
+        valid record so that new records are not appended after invalid data.
+
+        :return: A list [(operation, sequence, encoding, name, path)], with encoding None for the operation REMOVE.
+        """
+        records = []
+        if not os.path.isfile(self.file_name):
+            return records
+        with open(self.file_name, 'rb') as file:
+            content = file.read()
+        offset = 0
+        while offset + HEADER.size <= len(content):
+            (operation, sequence, name_length, path_length, checksum) = HEADER.unpack_from(content, offset)
+            encoding_size = ENCODING_SIZE if operation == ADD else 0
+            end = offset + HEADER.size + encoding_size + name_length + path_length
+            if operation not in (ADD, REMOVE) or end > len(content):
+                break
+            payload = content[offset + HEADER.size:end]
+            name = payload[encoding_size:encoding_size + name_length]
+            path = payload[encoding_size + name_length:]
+            if self._checksum(operation, sequence, name, path, payload) != checksum:
+                break
+            encoding = np.frombuffer(payload[:encoding_size], dtype = np.float32) if operation == ADD else None
+            records.append((operation, sequence, encoding, name.decode('utf-8'), path.decode('utf-8')))
+            offset = end
+        # Drop the invalid end of the journal.
+        if offset < len(content):
+            print('Dropped ' + str(len(content) - offset) + ' invalid bytes at the end of the journal.')
+            with open(self.file_name, 'r+b') as file:
+                file.truncate(offset)
+        return records
+
+
+    def append(self, operation, sequence, encoding = None, name = '', path = ''):
+        """
+        Appends a record to the journal, and waits for it to be written on disk.
+
+        :param operation: ADD or REMOVE.
+        :param sequence: The sequence number of the record.
+        :param encoding: The encoding of the added image.
+        :param name: The name of the person of the added image.
+        :param path: The path to the added or removed image.
+        """
+        name = name.encode('utf-8')
+        path = path.encode('utf-8')
+        payload = (np.asarray(encoding, dtype = np.float32).tobytes() if operation == ADD else b'') + name + path
+        if self.file is None:
+            self.file = open(self.file_name, 'ab')
+        self.file.write(HEADER.pack(operation, sequence, len(name), len(path), self._checksum(operation, sequence, name, path, payload)) + payload)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+
+    def size(self):
+        """
+        Returns the size of the journal in bytes.
+        """
+        if self.file is not None:
+            return self.file.tell()
+        return os.path.getsize(self.file_name) if os.path.isfile(self.file_name) else 0
+
+
+    def discard(self, offset):
+        """
+        Discards the beginning of the journal, up to the given offset. The end of
+        the journal is written in a temporary file, which then replaces the journal.
+
+        :param offset: The size of the discarded beginning, in bytes.
+        """
+        self.close()
+        if not os.path.isfile(self.file_name):
+            return
+        with open(self.file_name, 'rb') as file:
+            file.seek(offset)
+            content = file.read()
+        with open(self.file_name + '.tmp', 'wb') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.file_name + '.tmp', self.file_name)
+
+
+    def close(self):
+        """
+        Closes the journal file.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,145 @@
+"""
+The purpose of this module is to implement the search of the closest faces of
+the database, for a batch of encodings at once.
+
+The database owns a contiguous float32 matrix of encodings (one row per stored
+image), along with the squared norm and the identity of each row. For a batch
+of query encodings A and the matrix B, all squared distances are obtained with
+a single matrix product,
+
+    ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+
+which is computed by BLAS instead of a python loop over the database. The rows
+to compare with are given by the index of the database (see faceIndex.py).
+
+The float32 distances are only used to select candidates. The distances of the
+candidates are then recomputed exactly, the same way as faceComparator.face_distance,
+so that the returned names and distances are the same as with a linear scan.
+Note that the dlib encoder computes the encodings in float32, so that storing
+them in float32 does not lose any information.
+"""
+
+###############################################################################
+# Imports.
+###############################################################################
+
+# Packages for numeric computations.
+import numpy as np
+
+# Indexes of the database.
+import faceIndex
+
+
+###############################################################################
+# Main content of the module.
+###############################################################################
+
+class faceMatcher:
+    """
+    A class to find the closest names in the database for a batch of encodings.
+    """
+    def __init__(self, margin = 1e-3):
+        """
+        Initialization of the class.
+
+        :param margin: Error margin on the float32 squared distances. Every row whose approximate squared distance is within this margin of the selection threshold is recomputed exactly.
+        """
+        self.margin = margin
+        # Initialize the exact scan, used when the index of the database returns too few candidates.
+        self.linear_index = faceIndex.linearIndex()
+
+
+    def _candidates(self, database, face_encodings, exact = False):
+        """
+        Returns the candidate rows for each encoding, along with their
+        approximate squared distances, as given by the index of the database.
+
+        :param database: The database to search.
+        :param face_encodings: The (M, 128) array of encodings to compare.
+        :param exact: Whether to bypass the index of the database and scan all rows.
+        :return: A list [(rows, squared_distances)] with one element per encoding.
+        """
+        if exact:
+            return self.linear_index.candidates(database, face_encodings)
+        return database.index.candidates(database, face_encodings)
+
+
+    def exactDistances(self, database, rows, face_encoding):
+        """
+        Computes the exact distances between the encoding and the given rows,
+        as faceComparator.face_distance does.
+
+        :param database: The database to search.
+        :param rows: The considered rows of the database.
+        :param face_encoding: The encoding to compare.
+        :return: A numpy array of distances, in the same order as rows.
+        """
+        return np.linalg.norm(database.encodings[rows].astype(np.float64) - face_encoding, axis = 1)
+
+
+    def nearest(self, database, face_encodings):
+        """
+        Returns the closest row of the database for each encoding.
+
+        :param database: The database to search.
+        :param face_encodings: The list of encodings to compare.
+        :return: A list [(distance, name)] with one element per encoding, or an empty list if the database is empty. Ties are broken on the name, as min() over [(distance, name)] does.
+        """
+        if len(face_encodings) == 0 or database.size() == 0:
+            return []
+        result = []
+        for (face_encoding, (rows, distances)) in zip(face_encodings, self._candidates(database, face_encodings)):
+            # Scan all rows if the index gave no candidate.
+            if len(rows) == 0:
+                ((rows, distances),) = self._candidates(database, [face_encoding], exact = True)
+            # Keep the rows that may be the closest one, and compute their exact distance.
+            rows = rows[distances <= distances.min() + self.margin]
+            exact_distances = self.exactDistances(database, rows, face_encoding)
+            result.append(min(zip(exact_distances, database.getNames(rows))))
+        return result
+
+
+    def _identityDistances(self, database, rows, distances):
+        """
+        Computes the approximate distance of each identity to its closest row.
+
+        :param database: The database to search.
+        :param rows: The candidate rows.
+        :param distances: The approximate squared distances of the candidate rows.
+        :return: The array of the distances of the identities present in rows.
+        """
+        if len(rows) == 0:
+            return np.empty(0, dtype = np.float32)
+        identities = database.identity_ids[rows]
+        identity_distances = np.full(np.max(identities) + 1, np.inf, dtype = np.float32)
+        np.minimum.at(identity_distances, identities, distances)
+        return identity_distances[np.isfinite(identity_distances)]
+
+
+    def closestNames(self, database, face_encoding, nb_names):
+        """
+        Returns the closest distinct names of the database for the encoding.
+
+        :param database: The database to search.
+        :param face_encoding: The encoding to compare.
+        :param nb_names: The number of names to retrieve.
+        :return: A list [(distance, name)] of at most nb_names elements, sorted by distance, with distinct names. The distance of a name is the distance of its closest image.
+        """
+        if database.size() == 0 or nb_names <= 0:
+            return []
+        ((rows, distances),) = self._candidates(database, [face_encoding])
+        identity_distances = self._identityDistances(database, rows, distances)
+        # Scan all rows if the index gave too few names.
+        if len(identity_distances) < nb_names:
+            ((rows, distances),) = self._candidates(database, [face_encoding], exact = True)
+            identity_distances = self._identityDistances(database, rows, distances)
+        # Get the distance of the last retrieved name, and keep every row that may be closer.
+        nb_names = min(nb_names, len(identity_distances))
+        threshold = np.partition(identity_distances, nb_names - 1)[nb_names - 1]
+        rows = rows[distances <= threshold + self.margin]
+        # Compute the exact distances, and keep the closest image of each name.
+        closest = {}
+        for (distance, name) in zip(self.exactDistances(database, rows, face_encoding), database.getNames(rows)):
+            if name not in closest or distance < closest[name]:
+                closest[name] = distance
+        return sorted((distance, name) for (name, distance) in closest.items())[:nb_names]
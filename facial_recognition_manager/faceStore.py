@@ -0,0 +1,226 @@
+"""
+The purpose of this module is to implement the on-disk format of the database.
+
+The database is stored as columns, each column being a numpy file saved next to
+the others with the same prefix and the same version number:
+
+    - file_name_encodings.version.npy: (N, 128) float32 matrix of encodings.
+    - file_name_squared_norms.version.npy: (N,) float32 squared norms of the encodings.
+    - file_name_identity_ids.version.npy: (N,) int32 identity number of each image.
+    - file_name_paths.version.npy: (N,) paths to the images.
+    - file_name_identity_names.version.npy: (K,) name of each identity.
+    - file_name_identity_profiles.version.npy: (K,) profile of each identity.
+
+The manifest file_name_columns.json names the current version of the columns,
+along with the number of the last record of the journal of the database
+included in the columns (see databaseManager.py). A new version is written
+next to the current one, and the manifest is then replaced with a single
+atomic rename: after a crash, the columns and the sequence number are either
+all former or all new. Databases written before the manifest, with the files
+file_name_column.npy and file_name_sequence.npy, are still read.
+
+Strings are stored as fixed-width UTF-8 byte strings. None of the columns
+requires pickle, and all of them are opened as read-only memory maps: opening
+the database does not depend on its size, and several processes opening the
+same database share the same pages in memory.
+
+The former format, a pickled array [(encodings, name, path_to_image, profile)]
+in file_name.npy, can be converted with
+
+    python faceStore.py file_name
+"""
+
+###############################################################################
+# Imports.
+###############################################################################
+
+# Utilitary packages.
+import json
+import os
+import sys
+import os.path
+
+# Packages for numeric computations.
+import numpy as np
+
+
+###############################################################################
+# Definition of global variables.
+###############################################################################
+
+COLUMNS = ['encodings', 'squared_norms', 'identity_ids', 'paths', 'identity_names', 'identity_profiles']
+
+
+###############################################################################
+# Main content of the module.
+###############################################################################
+
+def columnFileName(file_name, column, version = None):
+    """
+    Returns the file in which the column is stored.
+
+    :param file_name: The prefix of the files of the database.
+    :param column: The name of the column.
+    :param version: The version of the columns. By default, the file of the databases written without manifest.
+    """
+    return file_name + '_' + column + ('' if version is None else '.' + str(version)) + '.npy'
+
+
+def manifestFileName(file_name):
+    """
+    Returns the file of the manifest of the columns.
+
+    :param file_name: The prefix of the files of the database.
+    """
+    return file_name + '_columns.json'
+
+
+def readManifest(file_name):
+    """
+    Reads the manifest of the columns.
+
+    :param file_name: The prefix of the files of the database.
+    :return: A dictionary {'version': version, 'sequence': sequence}, or None if the database has no manifest.
+    """
+    if not os.path.isfile(manifestFileName(file_name)):
+        return None
+    with open(manifestFileName(file_name)) as file:
+        return json.load(file)
+
+
+def exists(file_name):
+    """
+    Returns whether the database is stored in columnar format.
+
+    :param file_name: The prefix of the files of the database.
+    """
+    manifest = readManifest(file_name)
+    version = None if manifest is None else manifest['version']
+    return all(os.path.isfile(columnFileName(file_name, column, version)) for column in COLUMNS)
+
+
+def encodeStrings(strings):
+    """
+    Converts a list of strings into an array of fixed-width UTF-8 byte strings.
+
+    :param strings: The list of strings. Byte strings are kept as they are.
+    """
+    if isinstance(strings, np.ndarray) and strings.dtype.kind == 'S':
+        return strings
+    return np.array([string if isinstance(string, bytes) else string.encode('utf-8') for string in strings], dtype = np.bytes_)
+
+
+def write(file_name, encodings, identity_ids, paths, identity_names, identity_profiles, sequence = 0):
+    """
+    Writes the database in columnar format. All columns are written as a new
+    version, and the manifest is then replaced to switch to this version at
+    once, so that processes that map the former files are not affected and a
+    crash never mixes former and new columns.
+
+    :param file_name: The prefix of the files of the database.
+    :param encodings: The (N, 128) matrix of encodings.
+    :param identity_ids: The (N,) identity number of each image.
+    :param paths: The (N,) paths to the images, as strings or UTF-8 byte strings.
+    :param identity_names: The (K,) name of each identity, as strings or UTF-8 byte strings.
+    :param identity_profiles: The (K,) profile of each identity, as strings or UTF-8 byte strings.
+    :param sequence: The number of the last record of the journal included in the columns.
+    """
+    encodings = np.ascontiguousarray(encodings, dtype = np.float32).reshape((-1, 128))
+    columns = {
+        'encodings': encodings,
+        'squared_norms': np.einsum('ij,ij->i', encodings, encodings),
+        'identity_ids': np.asarray(identity_ids, dtype = np.int32),
+        'paths': encodeStrings(paths),
+        'identity_names': encodeStrings(identity_names),
+        'identity_profiles': encodeStrings(identity_profiles)
+    }
+    # Write the columns of the new version. The files of an interrupted write of the same version are overwritten.
+    manifest = readManifest(file_name)
+    version = 1 if manifest is None else manifest['version'] + 1
+    for column in COLUMNS:
+        with open(columnFileName(file_name, column, version), 'wb') as file:
+            np.save(file, columns[column])
+            file.flush()
+            os.fsync(file.fileno())
+    # Switch to the new version.
+    with open(manifestFileName(file_name) + '.tmp', 'w') as file:
+        json.dump({'version': version, 'sequence': int(sequence)}, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(manifestFileName(file_name) + '.tmp', manifestFileName(file_name))
+    # Remove the former version. The files may still be mapped by other processes, where they cannot be removed (e.g. on Windows).
+    former_files = [columnFileName(file_name, column, None if manifest is None else manifest['version']) for column in COLUMNS]
+    if manifest is None:
+        former_files.append(columnFileName(file_name, 'sequence'))
+    for former_file in former_files:
+        try:
+            os.remove(former_file)
+        except OSError:
+            pass
+
+
+def writeTable(file_name, table_faces, sequence = 0):
+    """
+    Writes a table [(encodings, name, path_to_image, profile)] in columnar
+    format. The profile of an identity is the profile of its first image.
+
+    :param file_name: The prefix of the files of the database.
+    :param table_faces: The list [(encodings, name, path_to_image, profile)].
+    :param sequence: The number of the last record of the journal included in the columns.
+    """
+    identity_lookup = {}
+    identity_names = []
+    identity_profiles = []
+    identity_ids = []
+    for (encoding, name, path_to_image, profile) in table_faces:
+        if name not in identity_lookup:
+            identity_lookup[name] = len(identity_names)
+            identity_names.append(name)
+            identity_profiles.append(profile)
+        identity_ids.append(identity_lookup[name])
+    encodings = np.array([encoding for (encoding, name, path_to_image, profile) in table_faces], dtype = np.float32)
+    paths = [path_to_image for (encoding, name, path_to_image, profile) in table_faces]
+    write(file_name, encodings, identity_ids, paths, identity_names, identity_profiles, sequence)
+
+
+def convert(file_name):
+    """
+    Converts the database file_name.npy from the former pickled format to the
+    columnar format.
+
+    :param file_name: The prefix of the files of the database.
+    """
+    table_faces = np.load(file_name + '.npy', allow_pickle = True)
+    writeTable(file_name, table_faces)
+
+
+class columnarStore:
+    """
+    A class to open a database stored in columnar format. Each column is an
+    attribute of the class, as read-only memory map.
+    """
+    def __init__(self, file_name):
+        """
+        Initialization of the class.
+
+        :param file_name: The prefix of the files of the database.
+        """
+        self.file_name = file_name
+        manifest = readManifest(file_name)
+        version = None if manifest is None else manifest['version']
+        for column in COLUMNS:
+            setattr(self, column, np.load(columnFileName(file_name, column, version), mmap_mode = 'r'))
+        # Databases written without journal have no sequence number.
+        self.sequence = 0
+        if manifest is not None:
+            self.sequence = manifest['sequence']
+        elif os.path.isfile(columnFileName(file_name, 'sequence')):
+            self.sequence = int(np.load(columnFileName(file_name, 'sequence')))
+
+
+if __name__ == '__main__':
+    # Convert the given database, by default the London database.
+    file_name = sys.argv[1] if len(sys.argv) > 1 else os.path.join('Database', 'London_database')
+    print('Converting ' + file_name + '.npy to columnar format.')
+    convert(file_name)
+    print('Converted ' + str(len(columnarStore(file_name).encodings)) + ' faces.')
@@ -23,12 +23,14 @@ location, for each location detected in the image.
 ###############################################################################
 
 # Packages for image processing and numeric computations.
-import scipy.misc
 import dlib
 import numpy as np
 import cv2
 from os.path import join
 
+# Batched search of the closest faces.
+import faceMatcher
+
 ###############################################################################
 # Definition of global variables.
 ###############################################################################
@@ -63,6 +65,8 @@ class faceComparator:
         self.pose_predictor = dlib.shape_predictor(self.predictor_model)
         self.face_recognition_model = join('Models','dlib_face_recognition_resnet_model_v1.dat')
         self.face_encoder = dlib.face_recognition_model_v1(self.face_recognition_model)
+        # Initialize the search of the closest faces in the database.
+        self.face_matcher = faceMatcher.faceMatcher()
 
 
     def _rect_to_css(self, rect):
@@ -119,7 +123,14 @@ class faceComparator:
         :param mode: Format to convert the image to. Only 'RGB' (8-bit RGB, 3 channels) and 'L' (black and white) are supported.
         :return: Image contents as numpy array
         """
-        return scipy.misc.imread(filename, mode=mode)
+        # As with PIL, the orientation stored in the EXIF data is ignored.
+        flags = cv2.IMREAD_GRAYSCALE if mode == 'L' else cv2.IMREAD_COLOR
+        image = cv2.imread(filename, flags | cv2.IMREAD_IGNORE_ORIENTATION)
+        if image is None:
+            raise IOError('Cannot read image ' + filename)
+        if mode == 'L':
+            return image
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
 
     def _raw_face_locations(self, img, number_of_times_to_upsample=1):
@@ -213,8 +224,12 @@ class faceComparator:
         :param database: The database to search.
         :return: List [(distance, name)]
         """
-        # TODO: improve the code.
-        return [(self.face_distance([known_encoding], face_encoding)[0], name) for (known_encoding, name, link, profile) in database.table_faces]
+        with database.lock:
+            if database.size() == 0:
+                return []
+            rows = database.getRows()
+            distances = self.face_matcher.exactDistances(database, rows, face_encoding)
+            return list(zip(distances, database.getNames(rows)))
 
 
     def analyseFrame(self, frame, database):
@@ -229,24 +244,37 @@ class faceComparator:
         # Find all the faces and face encodings in the current frame of video.
         face_locations = self.face_locations(frame)
         face_encodings = self.face_encodings(frame, face_locations)
+        return [(name_match, distance, face_location) for ((name_match, distance), face_location) in zip(self.identify(face_encodings, database), face_locations)]
+
+
+    def identify(self, face_encodings, database):
+        """
+        Returns the name of the person corresponding to the closest face in the
+        database for each encoding, along with the corresponding distance.
+
+        :param face_encodings: The list of encodings to identify.
+        :param database: The database to search.
+        :return: A list [(name, distance)], with name "Unknown" if the distance is larger than the tolerance.
+        """
+        # Find the closest face in the database for all the faces at once. Only
+        # the search holds the lock of the database, so that the database can be
+        # modified from another thread during the detection and the encoding.
+        with database.lock:
+            closest_faces = self.face_matcher.nearest(database, face_encodings)
         result = []
-        for i in range(len(face_locations)):
-            face_location = face_locations[i]
-            face_encoding = face_encodings[i]
-            # See if the face is a match for the known face(s).
-            distances = self.computeDistances(face_encoding, database)
+        for i in range(len(face_encodings)):
             name_match = "Unknown"
             # If database is empty, we impose distance = 1.
-            if len(distances) == 0:
+            if len(closest_faces) == 0:
                 distance = 1
-            # Else, we compute closest distance and name.
+            # Else, we get closest distance and name.
             else:
-                (distance, name) = min(distances)
+                (distance, name) = closest_faces[i]
             # If the distance is smaller than tolerance, we keep the found name.
             if distance <= self.tolerance:
                 name_match = name
             # Compute result array.
-            result.append((name_match, distance, face_location))
+            result.append((name_match, distance))
         return result
 
 
@@ -292,16 +320,7 @@ class faceComparator:
 
         # We proceed if we notice only one face.
         if len(face_encodings) == 1:
-            for face_encoding in face_encodings:
-                # Compare with known faces.
-                distances = self.computeDistances(face_encoding, database)
-                # Sort the array of distances.
-                similar_faces = sorted(distances)
-                # Get the unique name values.
-                u, indices = np.unique([name for (distance, name) in similar_faces], return_index=True)
-                closest_unique_faces_indices = indices[np.argpartition(indices, (1, nb_faces))[:nb_faces]]
-                similar_faces = [similar_faces[i] for i in closest_unique_faces_indices]
-                # Extract values.-
-                return similar_faces
+            # Compare with known faces, and keep the closest distinct names.
+            return self.face_matcher.closestNames(database, face_encodings[0], nb_faces)
         else:
             raise Exception('Wrong number of faces.')
@@ -36,9 +36,6 @@ from kivy.graphics.texture import Texture
 # from kivy.core.window import Window
 # Window.fullscreen = 'auto'
 
-# Imports for Image analysis.
-import cv2
-
 # Modules for the analysis of data.
 import databaseManager
 import facialRecognition
@@ -49,6 +46,12 @@ import streamProcessor
 import time
 import requests
 
+# Shared video sources.
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_manager'))
+import frameBus
+
 ################################################################################
 # Definition of the graphical user interface.
 ################################################################################
@@ -192,12 +195,23 @@ class MainApp(App):
         self.face_comparator = facialRecognition.faceComparator(tolerance = 0.6)
         # Load log file. TODO: log different actions.
         self.log_file = logFileWriter.logFile(file_name = 'log.txt', keepLog = False)
-        # Initialize video stream.
-        self.video_stream = streamProcessor.webcamStream()
+        # Initialize video stream. Use the frames of the frame bus if its daemon is running (see frameBus.py), so that the webcam is shared with the eyes application.
+        try:
+            self.video_stream = frameBus.frameBusStream()
+        except FileNotFoundError:
+            self.video_stream = streamProcessor.webcamStream()
+        # Initialize face tracks, so that faces are only encoded when they appear or move.
+        self.face_tracks = streamProcessor.faceTracks(self.face_comparator)
         # Initialize stream processor.
-        self.stream_processor = streamProcessor.streamProcessor(self.video_stream, self.face_comparator, nb_frames_in_history = 10, closeness_threshold = 2.5, resize_factor = 4, process_every = 2)
+        self.stream_processor = streamProcessor.streamProcessor(self.video_stream, self.face_tracks, nb_frames_in_history = 10, closeness_threshold = 2.5, resize_factor = 4, process_every = 2)
+        # Run the analysis in the background, so that the interface never waits for it.
+        self.analysis_engine = streamProcessor.analysisEngine(self.stream_processor, self.database)
 
         # Initialized useful parameters.
+        self.clean_frame = None
+        self.frame = None
+        self.texture = None
+        self.displayed_sequence = 0
         self.current_name = None
         self.current_profile = None
         self.is_identified = False
@@ -227,12 +241,13 @@ class MainApp(App):
 
         :param dt: Time interval.
         """
-        # Get the current modified frame.
-        (self.clean_frame, self.frame) = self.stream_processor.drawCurrentFrame(self.database)
+        # Get the last analysed frame, if it was not displayed yet.
+        snapshot = self.analysis_engine.getCurrentSnapshot()
+        if snapshot is None or snapshot[0] == self.displayed_sequence:
+            return
+        (self.displayed_sequence, self.clean_frame, self.frame, analysis, self.current_name) = snapshot
         # Display image from the texture.
-        self.camera_layout.ids['webcam'].texture = self._cvToKivy(self.frame)
-        # Get name.
-        self.current_name = self.stream_processor.getCurrentName()
+        self._displayFrame(self.frame)
         # If name is not None, display it on the output frame.
         if self.current_name != None:
             if not self.is_identified:
@@ -244,17 +259,28 @@ class MainApp(App):
             self._reInitializeOutputFrame()
 
 
-    def _cvToKivy(self, frame):
+    def on_stop(self):
+        """
+        Stops the analysis and releases the webcam when the app is closed.
+        """
+        self.analysis_engine.close()
+        self.video_stream.close()
+
+
+    def _displayFrame(self, frame):
         """
-        Converts cv2 image to texture, so that it can be displayed in the layout.
+        Uploads a cv2 image to the texture displayed in the layout. The texture
+        is created once, and flipped instead of the image.
 
-        :param frame: The cv2 image to convert.
+        :param frame: The cv2 image to display.
         """
-        buf1 = cv2.flip(frame, 0)
-        buf = buf1.tostring()
-        texture1 = Texture.create(size=(frame.shape[1], frame.shape[0]), colorfmt='bgr')
-        texture1.blit_buffer(buf, colorfmt='bgr', bufferfmt='ubyte')
-        return texture1
+        size = (frame.shape[1], frame.shape[0])
+        if self.texture is None or self.texture.size != size:
+            self.texture = Texture.create(size = size, colorfmt = 'bgr')
+            self.texture.flip_vertical()
+            self.camera_layout.ids['webcam'].texture = self.texture
+        self.texture.blit_buffer(frame.tobytes(), colorfmt = 'bgr', bufferfmt = 'ubyte')
+        self.camera_layout.ids['webcam'].canvas.ask_update()
 
 
     def _addNameToOutputFrame(self):
@@ -377,7 +403,7 @@ class MainApp(App):
         Reinitializes the output frame.
         """
         # Reinitialize current name and profile.
-        self.stream_processor.reinitializeCurrentName()
+        self.analysis_engine.reinitializeCurrentName()
         self.current_profile = None
         # Reinitialize is_identified boolean.
         self.is_identified = False
@@ -41,8 +41,29 @@ i.e. an array
 
     [(encodings, name, path_to_image, profile)]
 
+stored in the columnar format implemented in faceStore.py.
+
 To do that, we define here a basic recommender system. We also call for the
-functions of the facialRecognition module.
+functions of the facialRecognition module. The description files are parsed
+once, and the parsed descriptions are cached next to 'London_info' in the file
+'London_info_cache.json', so that only the new or modified descriptions are
+parsed again in the next runs.
+
+The images are encoded in parallel by a pool of worker processes, each of them
+loading the dlib models once. The encodings are regularly saved in a checkpoint
+file, so that an interrupted run resumes where it stopped. The resulting
+database does not depend on the number of workers nor on the order in which
+the images are encoded. Usage:
+
+    python filesToDatabase.py --images Database/London_images --info Database/London_info --output Database/file --workers 8
+
+Each run also saves a manifest of the encoded images (path, size, modification
+time, content hash and encoding) and of the description files (size,
+modification time, content hash and profile). With --incremental, only the new
+or modified images are encoded, the deleted images are dropped, and the profile
+of a person is only computed again if their description file changed.
+Note that the profiles which are not computed again keep the word frequencies
+of the run in which they were computed.
 """
 
 
@@ -54,6 +75,12 @@ functions of the facialRecognition module.
 import shutil
 import os
 import re
+import argparse
+import threading
+import multiprocessing
+import queue
+import hashlib
+import json
 from os.path import join, split
 
 # Beautiful loading bars.
@@ -61,6 +88,8 @@ from tqdm import tqdm
 
 # Image analysis and scientific computations.
 import facialRecognition
+import faceStore
+import faceJournal
 import numpy as np
 
 # Natural language analysis.
@@ -70,6 +99,121 @@ import nltk
 # Main content of the module.
 ###############################################################################
 
+class profileStore:
+    """
+    A class to parse the descriptions of all persons once.
+
+    For each person, we keep the record
+
+        {'name': name, 'job': job, 'office': office, 'words': words}
+
+    where words is the list of words of the job and of the bio. The records are
+    saved in a cache file along with the size and modification time of the
+    description, so that only new or modified descriptions are parsed again.
+    """
+    def __init__(self, folder_name_info, cache_file = None):
+        """
+        Initialization of the class.
+
+        :param folder_name_info: The folder in which all descriptions are stored.
+        :param cache_file: The cache file of the records. By default, next to the folder, with suffix '_cache.json'.
+        """
+        # Initialize constructors.
+        self.folder_name_info = folder_name_info
+        self.cache_file = cache_file if cache_file is not None else os.path.normpath(folder_name_info) + '_cache.json'
+        # Load records.
+        self.records = {}
+        self._load()
+
+
+    def _parse(self, file_name):
+        """
+        Parses a description.
+
+        :param file_name: The description file.
+        :return: The corresponding record.
+        """
+        # Read content of file.
+        with open(file_name, 'r') as file:
+            # Obtain card and bio.
+            file_content = file.read()
+            file_card = file_content.split('CARD:\n')[1].split('BIO:\n')[0]
+            file_bio = file_content.split('BIO:\n')[1]
+        # From card, extract name, job, office.
+        people_name = file_card.split('\n')[0]
+        people_job = file_card.split('\n')[1]
+        people_office = file_card.split('\n')[2]
+        # From bio, extract different categories and content for each category.
+        bio_info = [(content.split('\n')[0], content.split('\n', 1)[-1]) for content in file_bio.split('\n\n')]
+        # Define interesting words.
+        interesting_words_individual = []
+        # Add job description.
+        if len(people_job.split(',')) == 2:
+            for word in people_job.casefold().split(',')[0].split(' '):
+                interesting_words_individual.append(word.casefold())
+        # Add content
+        for (categories, content) in bio_info:
+            for word in re.split('\W+', content):
+                interesting_words_individual.append(word.casefold())
+        # Remove useless words.
+        interesting_words_individual = list(filter(lambda a: a != '', interesting_words_individual))
+        return {'name': people_name, 'job': people_job, 'office': people_office, 'words': interesting_words_individual}
+
+
+    def _load(self):
+        """
+        Loads the records of all descriptions, from the cache file for the
+        descriptions that did not change, and saves the cache file if needed.
+        """
+        # Without descriptions, there is no record.
+        if not os.path.isdir(self.folder_name_info):
+            return
+        # Load cache.
+        cache = {}
+        if os.path.isfile(self.cache_file):
+            try:
+                with open(self.cache_file, 'r', encoding = 'utf-8') as file:
+                    cache = json.load(file)
+            except ValueError:
+                print('Ignoring invalid cache file ' + self.cache_file)
+        # Browse all names.
+        modified = False
+        entries = {}
+        for name in sorted(os.listdir(self.folder_name_info)):
+            file_name = join(self.folder_name_info, name, name + '_.txt')
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                continue
+            entry = cache.get(name)
+            if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+                # Parse the description. Invalid descriptions have no record.
+                try:
+                    record = self._parse(file_name)
+                except Exception:
+                    record = None
+                entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'record': record}
+                modified = True
+            entries[name] = entry
+            if entry['record'] is not None:
+                self.records[name] = entry['record']
+        # Save cache.
+        if modified or len(entries) != len(cache):
+            with open(self.cache_file + '.tmp', 'w', encoding = 'utf-8') as file:
+                json.dump(entries, file)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+
+
+    def getWords(self, name):
+        """
+        Returns the words of the description of the person.
+
+        :param name: The considered name.
+        :return: A list of words extracted from the description. Raises KeyError if there is no valid description.
+        """
+        return self.records[name]['words']
+
+
 class basicRecommender:
     """
     A class for basic computation for recommendations.
@@ -78,7 +222,11 @@ class basicRecommender:
 
         computeProfile(name),
 
-    which assigns a category to the given name.
+    which assigns a category to the given name. The function
+
+        computeProfiles(names)
+
+    assigns the categories of several names at once.
 
     The different categories we aim at are by default:
 
@@ -92,16 +240,18 @@ class basicRecommender:
 
         'Unable to match description with profile'.
     """
-    def __init__(self, folder_name_info, fdist = 'default', categories = 'default'):
+    def __init__(self, folder_name_info, fdist = 'default', categories = 'default', profile_store = None):
         """
         Initialization of the class.
 
         :param folder_name_info: The folder in which all descriptions are stored.
         :param fdist: The frequency distribution of words in the whole description.
         :param categories: The different categories in which to classify people, along with corresponding keywords.
+        :param profile_store: The parsed descriptions. By default, a profileStore of folder_name_info.
         """
         # Initialize set of info.
         self.folder_name_info = folder_name_info
+        self.profile_store = profile_store if profile_store is not None else profileStore(folder_name_info)
         # Initialize categories.
         if categories == 'default':
                 businessleader_words = ['senior', 'business', 'leader', 'director', 'associate', 'collaboration', 'consultant', 'administrator', 'planner', 'business', 'manager', 'management', 'project', 'projects', 'service']
@@ -117,6 +267,8 @@ class basicRecommender:
             self.fdist = self._getAllInfo()
         else:
             self.fdist = fdist
+        # Initialize the weights of the words for each category.
+        self._buildWeights()
 
 
     def _getInfo(self, name):
@@ -126,33 +278,7 @@ class basicRecommender:
         :param name: The considered name.
         :return: A list of words extracted from the description.
         """
-        # Get to location.
-        filename = self.folder_name_info + '\\' + name + '\\' + name + '_.txt'
-        # Read content of file.
-        with open(filename, 'r') as file:
-            # Obtain card and bio.
-            file_content = file.read()
-            file_card = file_content.split('CARD:\n')[1].split('BIO:\n')[0]
-            file_bio = file_content.split('BIO:\n')[1]
-        # From card, extract name, job, office.
-        people_name = file_card.split('\n')[0]
-        people_job = file_card.split('\n')[1]
-        people_office = file_card.split('\n')[2]
-        # From bio, extract different categories and content for each category.
-        bio_info = [(content.split('\n')[0], content.split('\n', 1)[-1]) for content in file_bio.split('\n\n')]
-        # Define interesting words.
-        interesting_words_individual = []
-        # Add job description.
-        if len(people_job.split(',')) == 2:
-            for word in people_job.casefold().split(',')[0].split(' '):
-                interesting_words_individual.append(word.casefold())
-        # Add content
-        for (categories, content) in bio_info:
-            for word in re.split('\W+', content):
-                interesting_words_individual.append(word.casefold())
-        # Remove useless words.
-        interesting_words_individual = list(filter(lambda a: a != '', interesting_words_individual))
-        return interesting_words_individual
+        return self.profile_store.getWords(name)
 
 
     def _getAllInfo(self):
@@ -175,44 +301,10 @@ class basicRecommender:
         'there', 'when', 'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more',
         'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so',
         'than', 'too', 'very', 's', 't', 'can', 'will', 'just', 'don', 'should', 'now', 'also']
+        stopwords = set(stopwords)
 
-        # Extract info from all files.
-        people_info = []
-        # Browse all names.
-        for name in os.listdir(self.folder_name_info):
-            filename = self.folder_name_info + '\\' + name + '\\' + name + '_.txt'
-            # Read content of file.
-            with open(filename, 'r') as file:
-                # Obtain card and bio.
-                file_content = file.read()
-                file_card = file_content.split('CARD:\n')[1].split('BIO:\n')[0]
-                file_bio = file_content.split('BIO:\n')[1]
-                # From card, extract name, job, office.
-                people_name = file_card.split('\n')[0]
-                people_job = file_card.split('\n')[1]
-                people_office = file_card.split('\n')[2]
-                # From bio, extract different categories and content for each category.
-                bio_info = [(content.split('\n')[0], content.split('\n', 1)[-1]) for content in file_bio.split('\n\n')]
-                # Update info file.
-                people_info.append((people_name, people_job, people_office, bio_info))
-
-        # Get list of interesting words for each person.
-        interesting_words = []
-        for (people_name, people_job, people_office, bio_info) in people_info:
-            interesting_words_individual = []
-            # Add job description.
-            if len(people_job.split(',')) == 2:
-                for word in people_job.casefold().split(',')[0].split(' '):
-                    interesting_words_individual.append(word.casefold())
-            # Add content
-            for (categories, content) in bio_info:
-                for word in re.split('\W+', content):
-                    interesting_words_individual.append(word.casefold())
-            # Remove useless words.
-            interesting_words_individual = list(filter(lambda a: a != '', interesting_words_individual))
-            # Append result
-            for word in interesting_words_individual:
-                interesting_words.append(word)
+        # Get list of interesting words of all persons.
+        interesting_words = [word for record in self.profile_store.records.values() for word in record['words']]
         # Compute freuency distribution.
         fdist = nltk.FreqDist([word for word in interesting_words if not word in stopwords])
 
@@ -220,15 +312,71 @@ class basicRecommender:
         return fdist
 
 
-    def _bagOfWords(self, reference_words, text):
+    def _buildWeights(self):
+        """
+        Computes the terms of the score of each category.
+
+        The score of a text for a category is the sum, over the words of the
+        category, of the number of occurences of the word in the text divided by
+        its number of occurences in all descriptions, divided by the number of
+        words of the category. Words that never occur in the descriptions are
+        ignored. The terms of all texts are computed at once from the matrix of
+        word counts, and summed in the order of the words of each
+        category, so that the scores are exactly the ones of a word by word
+        computation.
+        """
+        self.profile_names = [profile for (profile, category) in self.categories]
+        # Keep the words that occur in the descriptions.
+        categories = [[word for word in category if self.fdist[word] != 0] for (profile, category) in self.categories]
+        # An empty category cannot be scored, hence no text can be classified.
+        self.can_classify = all(len(category) > 0 for category in categories)
+        # Compute the vocabulary, and the column and the number of occurences of each word of each category, duplicates included.
+        self.vocabulary = {}
+        self.term_columns = np.array([self.vocabulary.setdefault(word, len(self.vocabulary)) for category in categories for word in category], dtype = np.int64)
+        self.term_occurences = np.array([self.fdist[word] for category in categories for word in category], dtype = np.float64)
+        self.category_sizes = [len(category) for category in categories]
+
+
+    def _wordCounts(self, texts):
+        """
+        Computes the matrix of the number of occurences of each word of the
+        vocabulary in each text.
+
+        :param texts: A list of texts, each of them being a list of words.
+        :return: A (len(texts), len(vocabulary)) matrix.
+        """
+        rows = []
+        columns = []
+        for (i, text) in enumerate(texts):
+            for word in text:
+                column = self.vocabulary.get(word)
+                if column is not None:
+                    rows.append(i)
+                    columns.append(column)
+        counts = np.zeros((len(texts), len(self.vocabulary)))
+        np.add.at(counts, (np.array(rows, dtype = np.int64), np.array(columns, dtype = np.int64)), 1)
+        return counts
+
+
+    def _computeProfilesFromTexts(self, texts):
         """
-        Computes the 'bag of words' feature of the text in relation to the reference words.
+        Computes in which profile to classify each text.
 
-        :param reference_words: A list [(word, number_of_occurence)] corresponding to the different reference words, along with their total number of occurence in all descriptions.
-        :param text: A list [word] of words in which to search.
-        :return: The list [n1, n2, n3, ...] with ni being the number of occurences of the ith reference word in the text divided by the total number of occurences of this word in the total environment.
+        :param texts: A list of texts, each of them being a list of words.
+        :return: The list of the string representations of the found profiles.
         """
-        return [len([word for word in text if word == reference_words[i][0]]) /reference_words[i][1] for i in range(len(reference_words))]
+        if not self.can_classify:
+            return ['No Arup People profile' for text in texts]
+        terms = self._wordCounts(texts)[:, self.term_columns] / self.term_occurences
+        # Sum the terms of each category from left to right, as a word by word computation does.
+        scores = np.zeros((len(texts), len(self.category_sizes)))
+        start = 0
+        for (j, size) in enumerate(self.category_sizes):
+            scores[:, j] = np.cumsum(terms[:, start:start + size], axis = 1)[:, -1] / size
+            start += size
+        # Take the first best category.
+        best = np.argmax(scores, axis = 1)
+        return [self.profile_names[j] if scores[i, j] > 0 else 'No Arup People profile' for (i, j) in enumerate(best.tolist())]
 
 
     def _computeProfileFromText(self, text):
@@ -238,26 +386,28 @@ class basicRecommender:
         :param text: List of words, corresponding to the text to analyse.
         :return: The string representation of the found profile.
         """
-        # Count occurence of each word of each categories in global text.
-        new_categories = []
-        for (profile, category) in self.categories:
-            new_category = []
-            for word in category:
-                occurence = self.fdist[word]
-                if occurence != 0:
-                    new_category.append((word, occurence))
-            new_categories.append((profile, new_category))
-        categories = new_categories
-
-        # For each category, compute bag of word and cumulative sum / length of category.
-        scores = []
-        for (profile, category) in categories:
-            scores.append((profile, sum(self._bagOfWords(category, text)) / len(category)))
-        best_score = max(scores, key = lambda x : x[1])
-        if best_score[1] > 0:
-            return best_score[0]
-        else:
-            return 'No Arup People profile'
+        return self._computeProfilesFromTexts([text])[0]
+
+
+    def computeProfiles(self, names):
+        """
+        Computes in which profile to classify each person.
+        For that, we look into their descriptions.
+
+        :param names: The list of names.
+        :return: The list of the string representations of the found profiles.
+        """
+        # Get the descriptions. Persons without a readable description get no profile.
+        texts = []
+        for name in names:
+            try:
+                texts.append(self._getInfo(name))
+            except Exception as e:
+                texts.append(None)
+        profiles = self._computeProfilesFromTexts([text for text in texts if text is not None])
+        profiles = iter(profiles)
+        return [next(profiles) if text is not None else 'No Arup People profile' for text in texts]
+
 
     def computeProfile(self, name):
         """
@@ -267,63 +417,360 @@ class basicRecommender:
         :param name: The name of person.
         :return: The string representation of the found profile.
         """
-        try:
-            personal_info = self._getInfo(name)
-            profile = self._computeProfileFromText(personal_info)
-        except Exception as e:
-            profile = 'No Arup People profile'
-        return profile
+        return self.computeProfiles([name])[0]
 
 
 
-if __name__ == '__main__':
-    # Define face comparator.
+def _encodeImage(face_comparator, image_path):
+    """
+    Computes the encoding of the image.
+
+    :param face_comparator: The face comparator used to encode the image.
+    :param image_path: The path to the image.
+    :return: The float32 encoding if the image contains one and only one face, None otherwise.
+    """
+    try:
+        encodings = face_comparator.face_encodings(face_comparator.load_image_file(image_path))
+    except Exception:
+        return None
+    if len(encodings) != 1:
+        return None
+    return np.asarray(encodings[0], dtype = np.float32)
+
+
+def _encodingWorker(task_queue, result_queue):
+    """
+    Main function of the worker processes: loads the models once, then encodes
+    the images of the task queue until it receives None.
+
+    :param task_queue: The queue of paths to the images to encode.
+    :param result_queue: The queue of results (image_path, encoding).
+    """
     face_comparator = facialRecognition.faceComparator()
-    # Define recommender system.
-    recommender = basicRecommender(join('Database', 'London_info'))
+    while True:
+        image_path = task_queue.get()
+        if image_path is None:
+            break
+        result_queue.put((image_path, _encodeImage(face_comparator, image_path)))
 
-    # Name of the folder from which we extract the data.
-    images_path = join('Database', 'London_images')
-    infos_path = join('Database', 'London_info')
-    # Name of the file into which we store data.
-    file_name = join('Database', 'file')
 
-    # Initialize counters.
-    countValidFaces = 0
-    countProfiles = {}
+def _fileSignature(file_path):
+    """
+    Returns the size and the modification time of the file.
+
+    :param file_path: The path to the file.
+    :return: A tuple (size, mtime), (-1, -1) for a missing file.
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return (-1, -1)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def loadCheckpoint(checkpoint_file):
+    """
+    Loads the encodings saved by an interrupted run.
+
+    :param checkpoint_file: The checkpoint file.
+    :return: A dictionary {image_path: (size, mtime, encoding)}, the encoding being None for invalid images. A checkpoint without sizes and modification times is ignored.
+    """
+    results = {}
+    if os.path.isfile(checkpoint_file):
+        with np.load(checkpoint_file) as data:
+            if 'sizes' not in data.files:
+                return results
+            for (image_path, size, mtime, encoding, valid) in zip(data['paths'], data['sizes'], data['mtimes'], data['encodings'], data['valid']):
+                results[image_path.decode('utf-8')] = (int(size), int(mtime), encoding if valid else None)
+    return results
+
+
+def saveCheckpoint(checkpoint_file, results, signatures):
+    """
+    Saves the encodings computed so far, along with the size and modification
+    time of their images. The checkpoint is first written in a temporary file,
+    which then replaces the former checkpoint.
+
+    :param checkpoint_file: The checkpoint file.
+    :param results: A dictionary {image_path: encoding}, the encoding being None for invalid images.
+    :param signatures: A dictionary {image_path: (size, mtime)} of the encoded images.
+    """
+    image_paths = sorted(results)
+    encodings = np.zeros((len(image_paths), 128), dtype = np.float32)
+    valid = np.zeros(len(image_paths), dtype = bool)
+    for (i, image_path) in enumerate(image_paths):
+        if results[image_path] is not None:
+            encodings[i] = results[image_path]
+            valid[i] = True
+    with open(checkpoint_file + '.tmp', 'wb') as file:
+        np.savez(file,
+                 paths = faceStore.encodeStrings(image_paths),
+                 sizes = np.array([signatures[image_path][0] for image_path in image_paths], dtype = np.int64),
+                 mtimes = np.array([signatures[image_path][1] for image_path in image_paths], dtype = np.int64),
+                 encodings = encodings,
+                 valid = valid)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def encodeImages(image_paths, nb_workers = os.cpu_count(), checkpoint_file = None, checkpoint_every = 500, queue_size = 64):
+    """
+    Encodes the images, in parallel if nb_workers > 0.
+
+    :param image_paths: The list of paths to the images.
+    :param nb_workers: The number of worker processes. With 0, the images are encoded in the current process.
+    :param checkpoint_file: The file in which the encodings are regularly saved. If it exists, the images it contains are not encoded again, unless their size or modification time changed.
+    :param checkpoint_every: The number of encoded images between two checkpoints.
+    :param queue_size: The maximal number of images waiting in the queues of the workers.
+    :return: A dictionary {image_path: encoding}, the encoding being None for invalid images.
+    """
+    # Resume from the checkpoint, only reusing the encodings of the given images that did not change since.
+    signatures = {image_path: _fileSignature(image_path) for image_path in image_paths}
+    results = {}
+    if checkpoint_file is not None:
+        for (image_path, (size, mtime, encoding)) in loadCheckpoint(checkpoint_file).items():
+            if signatures.get(image_path) == (size, mtime):
+                results[image_path] = encoding
+    remaining = [image_path for image_path in image_paths if image_path not in results]
+    if len(results) > 0:
+        print('Resuming from checkpoint with ' + str(len(results)) + ' encoded images.')
+
+    def _checkpoint(nb_encoded):
+        if checkpoint_file is not None and nb_encoded % checkpoint_every == 0:
+            saveCheckpoint(checkpoint_file, results, signatures)
+
+    if nb_workers <= 0:
+        # Encode the images in the current process.
+        face_comparator = facialRecognition.faceComparator()
+        for (i, image_path) in enumerate(tqdm(remaining, desc = 'Progress', leave = False)):
+            results[image_path] = _encodeImage(face_comparator, image_path)
+            _checkpoint(i + 1)
+        return results
+
+    # Start the workers. Both queues are bounded, so that memory does not grow with the number of images.
+    task_queue = multiprocessing.Queue(queue_size)
+    result_queue = multiprocessing.Queue(queue_size)
+    workers = [multiprocessing.Process(target = _encodingWorker, args = (task_queue, result_queue)) for i in range(nb_workers)]
+    for worker in workers:
+        worker.start()
+
+    # Feed the task queue from a separate thread, so that the results are consumed meanwhile.
+    def _feed():
+        for image_path in remaining:
+            task_queue.put(image_path)
+        for worker in workers:
+            task_queue.put(None)
+    feeder = threading.Thread(target = _feed, daemon = True)
+    feeder.start()
+
+    # Collect the results.
+    progress_bar = tqdm(total = len(remaining), desc = 'Progress', leave = False)
+    nb_encoded = 0
+    while nb_encoded < len(remaining):
+        try:
+            (image_path, encoding) = result_queue.get(timeout = 1)
+        except queue.Empty:
+            # Stop if a worker died, after saving what was encoded.
+            if any(worker.exitcode not in (None, 0) for worker in workers):
+                if checkpoint_file is not None:
+                    saveCheckpoint(checkpoint_file, results, signatures)
+                for worker in workers:
+                    worker.terminate()
+                raise RuntimeError('An encoding worker stopped unexpectedly.')
+            continue
+        results[image_path] = encoding
+        nb_encoded += 1
+        progress_bar.update(1)
+        _checkpoint(nb_encoded)
+    progress_bar.close()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def _fileHash(file_path):
+    """
+    Computes the hash of the content of the file.
+
+    :param file_path: The path to the file.
+    :return: The hexadecimal sha1 digest as bytes.
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest().encode('ascii')
+
+
+def _checkFile(file_path, entry):
+    """
+    Compares the file with its entry in the manifest. The content of the file is
+    only hashed if its size or modification time changed.
+
+    :param file_path: The path to the file.
+    :param entry: The entry (size, mtime, hash, value) of the manifest, or None if the file is new.
+    :return: A tuple (size, mtime, hash, changed). A missing file has size -1, mtime -1 and an empty hash.
+    """
+    if not os.path.isfile(file_path):
+        return (-1, -1, b'', entry is None or entry[2] != b'')
+    stat = os.stat(file_path)
+    if entry is not None and (stat.st_size, stat.st_mtime_ns) == (entry[0], entry[1]):
+        return (entry[0], entry[1], entry[2], False)
+    file_hash = _fileHash(file_path)
+    return (stat.st_size, stat.st_mtime_ns, file_hash, entry is None or entry[2] != file_hash)
+
+
+def loadManifest(manifest_file):
+    """
+    Loads the manifest of a previous run.
+
+    :param manifest_file: The manifest file.
+    :return: Two dictionaries, {image_path: (size, mtime, hash, encoding)} and {name: (size, mtime, hash, profile)}, the encoding being None for invalid images.
+    """
+    images = {}
+    infos = {}
+    if os.path.isfile(manifest_file):
+        with np.load(manifest_file) as data:
+            for (image_path, size, mtime, file_hash, encoding, valid) in zip(data['image_paths'], data['image_sizes'], data['image_mtimes'], data['image_hashes'], data['encodings'], data['valid']):
+                images[image_path.decode('utf-8')] = (int(size), int(mtime), bytes(file_hash), encoding if valid else None)
+            for (name, size, mtime, file_hash, profile) in zip(data['info_names'], data['info_sizes'], data['info_mtimes'], data['info_hashes'], data['profiles']):
+                infos[name.decode('utf-8')] = (int(size), int(mtime), bytes(file_hash), profile.decode('utf-8'))
+    return (images, infos)
+
+
+def saveManifest(manifest_file, images, infos):
+    """
+    Saves the manifest. It is first written in a temporary file, which then
+    replaces the former manifest.
+
+    :param manifest_file: The manifest file.
+    :param images: A dictionary {image_path: (size, mtime, hash, encoding)}, the encoding being None for invalid images.
+    :param infos: A dictionary {name: (size, mtime, hash, profile)}.
+    """
+    image_paths = sorted(images)
+    encodings = np.zeros((len(image_paths), 128), dtype = np.float32)
+    for (i, image_path) in enumerate(image_paths):
+        if images[image_path][3] is not None:
+            encodings[i] = images[image_path][3]
+    names = sorted(infos)
+    with open(manifest_file + '.tmp', 'wb') as file:
+        np.savez(file,
+                 image_paths = faceStore.encodeStrings(image_paths),
+                 image_sizes = np.array([images[image_path][0] for image_path in image_paths], dtype = np.int64),
+                 image_mtimes = np.array([images[image_path][1] for image_path in image_paths], dtype = np.int64),
+                 image_hashes = np.array([images[image_path][2] for image_path in image_paths], dtype = 'S40'),
+                 encodings = encodings,
+                 valid = np.array([images[image_path][3] is not None for image_path in image_paths], dtype = bool),
+                 info_names = faceStore.encodeStrings(names),
+                 info_sizes = np.array([infos[name][0] for name in names], dtype = np.int64),
+                 info_mtimes = np.array([infos[name][1] for name in names], dtype = np.int64),
+                 info_hashes = np.array([infos[name][2] for name in names], dtype = 'S40'),
+                 profiles = faceStore.encodeStrings([infos[name][3] for name in names]))
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def ingest(images_path, infos_path, file_name, nb_workers = os.cpu_count(), checkpoint_every = 500, queue_size = 64, remove_invalid = False, incremental = False):
+    """
+    Encodes all the images and computes all the profiles, and saves the resulting
+    database. The rows of the database are sorted by name and image, so that the
+    result does not depend on the order in which the images were encoded.
+
+    :param images_path: The folder of images, with one folder per person.
+    :param infos_path: The folder of descriptions, with one folder per person.
+    :param file_name: The prefix of the files of the resulting database.
+    :param nb_workers: The number of worker processes. With 0, the images are encoded in the current process.
+    :param checkpoint_every: The number of encoded images between two checkpoints.
+    :param queue_size: The maximal number of images waiting in the queues of the workers.
+    :param remove_invalid: Whether to delete the folder of the persons with an image that does not contain one and only one face.
+    :param incremental: Whether to reuse the encodings and profiles of the manifest of the previous run for unchanged files.
+    """
+    manifest_file = file_name + '_manifest.npz'
+    (image_manifest, info_manifest) = loadManifest(manifest_file) if incremental else ({}, {})
+
     print('Loading faces from folder ' + images_path)
+    # Get list of all names and images.
+    list_names = sorted(os.listdir(images_path))
+    list_images = [(name, join(images_path, name, image)) for name in list_names for image in sorted(os.listdir(join(images_path, name)))]
+
+    # Find the new and modified images.
+    new_image_manifest = {}
+    changed_images = []
+    for (name, image_path) in list_images:
+        (size, mtime, file_hash, changed) = _checkFile(image_path, image_manifest.get(image_path))
+        new_image_manifest[image_path] = (size, mtime, file_hash, None if changed else image_manifest[image_path][3])
+        if changed:
+            changed_images.append(image_path)
+    nb_deleted_images = len(set(image_manifest) - set(new_image_manifest))
+
+    # Find the modified descriptions.
+    new_info_manifest = {}
+    changed_names = []
+    for name in list_names:
+        (size, mtime, file_hash, changed) = _checkFile(join(infos_path, name, name + '_.txt'), info_manifest.get(name))
+        new_info_manifest[name] = (size, mtime, file_hash, None if changed else info_manifest[name][3])
+        if changed:
+            changed_names.append(name)
+    if incremental:
+        print('Found ' + str(len(changed_images)) + ' new or modified images, ' + str(nb_deleted_images) + ' deleted images, and ' + str(len(changed_names)) + ' new or modified descriptions.')
+        if len(changed_images) == 0 and nb_deleted_images == 0 and len(changed_names) == 0 and len(set(info_manifest) - set(new_info_manifest)) == 0 and faceStore.exists(file_name):
+            print('Database is up to date.')
+            return
+
+    # Compute encodings. We only keep valid images, i.e. containg one and only one face.
+    checkpoint_file = file_name + '_checkpoint.npz'
+    encodings = encodeImages(changed_images, nb_workers, checkpoint_file, checkpoint_every, queue_size)
+    for (image_path, encoding) in encodings.items():
+        (size, mtime, file_hash, previous_encoding) = new_image_manifest[image_path]
+        new_image_manifest[image_path] = (size, mtime, file_hash, encoding)
+    invalid_names = set(name for (name, image_path) in list_images if new_image_manifest[image_path][3] is None)
+    if remove_invalid:
+        for name in sorted(invalid_names):
+            # The image is not valid, we delete the directory.
+            shutil.rmtree(join(images_path, name))
+        list_images = [(name, image_path) for (name, image_path) in list_images if name not in invalid_names]
+        new_image_manifest = {image_path: new_image_manifest[image_path] for (name, image_path) in list_images}
+
+    # Compute profiles. The recommender system is only built if a profile must be computed.
+    if len(changed_names) > 0:
+        recommender = basicRecommender(infos_path)
+        for (name, profile) in zip(changed_names, recommender.computeProfiles(changed_names)):
+            (size, mtime, file_hash, previous_profile) = new_info_manifest[name]
+            new_info_manifest[name] = (size, mtime, file_hash, profile)
+    profiles = {name: new_info_manifest[name][3] for name in list_names}
 
-    # Get list of all names.
-    list_names = os.listdir(images_path)
     # Initialize result array.
-    table_faces = []
-    # Browse each name. We use tqdm to make a beautiful progress bar.
-    for name in tqdm(list_names, desc = 'Progress', leave = False):
-        # Compute profile.
-        profile = recommender.computeProfile(name)
-        # Get list of images corresponding to name.
-        list_images = os.listdir(images_path + '\\' + name)
-        # Browse the images. We only keep valid images, i.e. containg one and only one face.
-        for image in tqdm(list_images, desc = name, leave = False):
-            # Compute encodings.
-            encodings = face_comparator.face_encodings(face_comparator.load_image_file(images_path + '\\' + name + '\\' + image))
-            if len(encodings) == 1:
-                # The image contains only one face, we append it to the data.
-                table_faces.append((encodings[0], name, join(images_path, name, image), profile))
-                # Actualize counters.
-                countValidFaces += 1
-                try:
-                    countProfiles[profile] += 1
-                except:
-                    countProfiles[profile] = 1
-
-            else:
-                # The image is not valid, we delete the directory.
-                shutil.rmtree(images_path + '\\' + name)
-    #Save the resulting data.
-    np.save(file_name, table_faces)
+    table_faces = [(new_image_manifest[image_path][3], name, image_path, profiles[name]) for (name, image_path) in list_images if new_image_manifest[image_path][3] is not None]
+    #Save the resulting data. The columns replace the records of the journal of
+    #the database: they are written with a sequence number past its last record,
+    #so that the records are never replayed on top of them, and then discarded.
+    journal = faceJournal.journal(file_name + '_journal.bin')
+    manifest = faceStore.readManifest(file_name)
+    sequence = max([0 if manifest is None else manifest['sequence']] + [record[1] for record in journal.read()])
+    faceStore.writeTable(file_name, table_faces, sequence)
+    journal.discard(journal.size())
+    saveManifest(manifest_file, new_image_manifest, new_info_manifest)
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
 
     # Print results.
-    print('Loaded ' + str(countValidFaces) + ' valid faces.')
+    countProfiles = {}
+    for (encoding, name, image_path, profile) in table_faces:
+        countProfiles[profile] = countProfiles.get(profile, 0) + 1
+    print('Loaded ' + str(len(table_faces)) + ' valid faces.')
     for profile, occurences in countProfiles.items():
         print('\tOccurences for ' + profile + ' profile: ' + str(occurences))
+
+
+if __name__ == '__main__':
+    # Parse arguments.
+    parser = argparse.ArgumentParser(description = 'Encodes the images and profiles of all persons into a database.')
+    parser.add_argument('--images', default = join('Database', 'London_images'), help = 'Folder of images, with one folder per person.')
+    parser.add_argument('--info', default = join('Database', 'London_info'), help = 'Folder of descriptions, with one folder per person.')
+    parser.add_argument('--output', default = join('Database', 'file'), help = 'Prefix of the files of the resulting database.')
+    parser.add_argument('--workers', type = int, default = os.cpu_count(), help = 'Number of worker processes. With 0, the images are encoded in the current process.')
+    parser.add_argument('--checkpoint-every', type = int, default = 500, help = 'Number of encoded images between two checkpoints.')
+    parser.add_argument('--queue-size', type = int, default = 64, help = 'Maximal number of images waiting in the queues of the workers.')
+    parser.add_argument('--remove-invalid', action = 'store_true', help = 'Delete the folder of the persons with an image that does not contain one and only one face.')
+    parser.add_argument('--incremental', action = 'store_true', help = 'Only encode the new or modified images, and only compute the profiles of the modified descriptions.')
+    arguments = parser.parse_args()
+
+    ingest(arguments.images, arguments.info, arguments.output, arguments.workers, arguments.checkpoint_every, arguments.queue_size, arguments.remove_invalid, arguments.incremental)
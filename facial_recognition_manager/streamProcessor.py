@@ -2,65 +2,269 @@
 The purpose of this module is to implement functions that return in real time
 the name, distance, and locations of people in the video stream.
 
-We first implement a class to define a video stream. It must implement the
-function
+The video streams are implemented in video_manager/videoStreams.py, and
+imported here. They must implement the function
 
     getCurrentFrame()
 
 which returns the current frame of the stream as np array.
 
-Then we implement classes that analyse such streams. They must implement the
+We implement classes that analyse such streams. They must implement the
 function
 
     getCurrentAnalysis()
 
 which returns the list [(name, distance, location)] corresponding to the list of
 the closest name, the corresponding distance and location, for each detected
-location in the image.
+location in the image. The class faceTracks can replace the face comparator of
+a stream processor, to avoid encoding again faces that were already identified.
+
+Finally, the class analysisEngine runs such an analysis on a background thread
+and publishes its latest results, for the graphical user interface.
 """
 
 ################################################################################
 # Imports.
 ################################################################################
 
+# Utilitary packages.
+import os
+import threading
+import time
+from collections import deque
+
 # Packages for image processing.
-import cv2
-import scipy.misc
 import numpy as np
 import dlib
 
+# Shared video streams and processing of the frames.
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_manager'))
+# The video streams are re-exported, so that the applications create them from this module.
+from videoStreams import webcamStream, replayStream, videoFileStream, imageDirectoryStream
+from frameProcessing import framePreprocessor
+
 
 ################################################################################
 # Main content of the class.
 ################################################################################
 
-class webcamStream:
+class identityVoter:
     """
-    This class implements the video stream of a webcam.
+    This class implements the fusion of the analysis of the last frames: each
+    face votes for its name with its closeness (1 - distance), and the score of
+    a name is the sum of its votes over the last nb_frames analysed frames.
+
+    The analysed frames are kept in a deque of bounded size, along with the
+    running score of each name, so that the scores are only updated when a
+    frame enters or leaves the history.
+
+    By default, as in the original analysis, only the frames with exactly one
+    face vote. With multi_face = True, every face of every frame votes.
     """
-    def __init__(self, webcam_number = 0):
+    def __init__(self, nb_frames = 10, multi_face = False):
         """
         Initialization of the class.
 
-        :param webcam_number: The number of the considered webcam (by default 0).
+        :param nb_frames: The number of frames over which the votes are summed.
+        :param multi_face: Whether the frames with several faces vote.
         """
-        self.video_capture = cv2.VideoCapture(webcam_number)
+        # Initialize constructors.
+        self.nb_frames = nb_frames
+        self.multi_face = multi_face
+        # Initialize the votes [(name, closeness)] of each frame, the score and the number of votes of each name.
+        self.history = deque()
+        self.scores = {}
+        self.counts = {}
+        # Initialize the name with the best score, as (name, score), or None.
+        self.best = None
 
 
-    def close(self):
+    def add(self, analysis):
         """
-        Closes the process of the stream.
+        Adds the analysis of a frame to the history, and removes the oldest
+        frame if the history is full.
+
+        :param analysis: The analysis [(name, distance, location)] of the frame.
         """
-        self.video_capture.release()
+        # Remove the votes of the oldest frame.
+        if len(self.history) >= self.nb_frames:
+            for (name, closeness) in self.history.popleft():
+                self.counts[name] -= 1
+                if self.counts[name] == 0:
+                    del self.counts[name]
+                    del self.scores[name]
+                else:
+                    self.scores[name] -= closeness
+        # Add the votes of the new frame.
+        votes = []
+        if self.multi_face or len(analysis) == 1:
+            votes = [(name, 1 - distance) for (name, distance, location) in analysis]
+        for (name, closeness) in votes:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.scores[name] = self.scores.get(name, 0) + closeness
+        self.history.append(votes)
+        # Actualize the best name.
+        self.best = max(self.scores.items(), key = lambda a : a[1]) if len(self.scores) > 0 else None
 
 
-    def getCurrentFrame(self):
+    def getBest(self):
         """
-        Returns the current frame of the stream, as np.array.
+        Returns the name with the best score as (name, score), or None if no
+        face voted in the history.
         """
-        # Grab a single frame of video
-        ret, frame = self.video_capture.read()
-        return frame
+        return self.best
+
+
+    def getResults(self):
+        """
+        Returns the list [(name, score)] of all names of the history, sorted by
+        decreasing score.
+        """
+        return sorted(self.scores.items(), key = lambda a : -a[1])
+
+
+class faceTracks:
+    """
+    This class sits between a stream processor and a face comparator, and
+    avoids encoding again the faces that were already identified.
+
+    The faces detected in consecutive analysed frames are associated when their
+    boxes overlap (intersection over union above iou_threshold). Each track
+    keeps the name and the distance obtained the last time its face was
+    encoded, and the face is only encoded again when the track is new, when its
+    box moved or was scaled significantly since then, or every refresh_every
+    analysed frames.
+
+    It implements the functions analyseFrame and drawResult of the face
+    comparator, so that it can be given to a streamProcessor instead of the
+    face comparator.
+    """
+    def __init__(self, face_comparator, iou_threshold = 0.3, max_motion = 0.2, max_scale_change = 0.2, refresh_every = 30, max_missed = 2):
+        """
+        Initialization of the class.
+
+        :param face_comparator: The face comparator used to detect, encode and identify the faces.
+        :param iou_threshold: The minimal intersection over union between the boxes of a face in two consecutive frames.
+        :param max_motion: The face is encoded again if the center of its box moved by more than this fraction of the size of the box.
+        :param max_scale_change: The face is encoded again if the size of its box changed by more than this fraction.
+        :param refresh_every: The face is encoded again after this number of analysed frames.
+        :param max_missed: A track is removed after this number of analysed frames without detection.
+        """
+        # Initialize constructors.
+        self.face_comparator = face_comparator
+        self.iou_threshold = iou_threshold
+        self.max_motion = max_motion
+        self.max_scale_change = max_scale_change
+        self.refresh_every = refresh_every
+        self.max_missed = max_missed
+        # Initialize tracks, as dictionaries.
+        self.tracks = []
+        # Initialize metrics.
+        self.nb_frames = 0
+        self.nb_faces = 0
+        self.nb_encoded_faces = 0
+
+
+    def _iou(self, location_1, location_2):
+        """
+        Returns the intersection over union of two locations (top, right, bottom, left).
+        """
+        (top_1, right_1, bottom_1, left_1) = location_1
+        (top_2, right_2, bottom_2, left_2) = location_2
+        width = min(right_1, right_2) - max(left_1, left_2)
+        height = min(bottom_1, bottom_2) - max(top_1, top_2)
+        if width <= 0 or height <= 0:
+            return 0.0
+        intersection = width * height
+        union = (right_1 - left_1) * (bottom_1 - top_1) + (right_2 - left_2) * (bottom_2 - top_2) - intersection
+        return intersection / union
+
+
+    def _isStale(self, track, location):
+        """
+        Returns whether the face of the track must be encoded again at the given location.
+        """
+        if track['age'] >= self.refresh_every:
+            return True
+        (top, right, bottom, left) = location
+        (encoded_top, encoded_right, encoded_bottom, encoded_left) = track['encoded_location']
+        size = np.sqrt((right - left) * (bottom - top))
+        encoded_size = np.sqrt(max(encoded_right - encoded_left, 0) * max(encoded_bottom - encoded_top, 0))
+        # A degenerate box (e.g. clipped at the edge of the frame) cannot be compared with.
+        if encoded_size <= 0 or abs(size / encoded_size - 1) > self.max_scale_change:
+            return True
+        motion = np.hypot((left + right - encoded_left - encoded_right) / 2, (top + bottom - encoded_top - encoded_bottom) / 2)
+        return motion > self.max_motion * encoded_size
+
+
+    def analyseFrame(self, frame, database):
+        """
+        Returns the name of the person corresponding to closest face in the database,
+        along with the corresponding distances, and the corresponding locations.
+        Only the faces of new or stale tracks are encoded.
+
+        :param frame: The image to analyse.
+        :param database: The database to search.
+        :return: A list [(name, distance, location)] corresponding to the identified names and distances in the image.
+        """
+        face_locations = self.face_comparator.face_locations(frame)
+        # Associate the locations with the tracks, by decreasing intersection over union.
+        pairs = sorted(((self._iou(track['location'], location), i, j) for (i, track) in enumerate(self.tracks) for (j, location) in enumerate(face_locations)), reverse = True)
+        face_tracks = [None] * len(face_locations)
+        matched = set()
+        for (iou, i, j) in pairs:
+            if iou < self.iou_threshold:
+                break
+            if i not in matched and face_tracks[j] is None:
+                matched.add(i)
+                face_tracks[j] = self.tracks[i]
+        # Age the tracks, and remove the tracks which were missed too often.
+        for (i, track) in enumerate(self.tracks):
+            track['age'] += 1
+            track['missed'] = 0 if i in matched else track['missed'] + 1
+        self.tracks = [track for track in self.tracks if track['missed'] < self.max_missed]
+        # Create the new tracks, and find the faces to encode.
+        to_encode = []
+        for j in range(len(face_locations)):
+            if face_tracks[j] is None:
+                face_tracks[j] = {'location': face_locations[j], 'missed': 0}
+                self.tracks.append(face_tracks[j])
+                to_encode.append(j)
+            elif self._isStale(face_tracks[j], face_locations[j]):
+                to_encode.append(j)
+            face_tracks[j]['location'] = face_locations[j]
+        # Encode and identify these faces.
+        if len(to_encode) > 0:
+            face_encodings = self.face_comparator.face_encodings(frame, [face_locations[j] for j in to_encode])
+            for (j, (name, distance)) in zip(to_encode, self.face_comparator.identify(face_encodings, database)):
+                face_tracks[j].update({'name': name, 'distance': distance, 'encoded_location': face_locations[j], 'age': 0})
+        # Actualize metrics.
+        self.nb_frames += 1
+        self.nb_faces += len(face_locations)
+        self.nb_encoded_faces += len(to_encode)
+        return [(track['name'], track['distance'], location) for (track, location) in zip(face_tracks, face_locations)]
+
+
+    def drawResult(self, frame, result, *args, **kwargs):
+        """
+        Display the obtained results, with the face comparator.
+        """
+        return self.face_comparator.drawResult(frame, result, *args, **kwargs)
+
+
+    def getMetrics(self):
+        """
+        Returns the metrics of the tracks, as a dictionary with the number of
+        analysed frames, of detected faces and of encoded faces, and the encoder
+        call rate, i.e. the fraction of the detected faces that were encoded.
+        """
+        return {
+            'nb_frames': self.nb_frames,
+            'nb_faces': self.nb_faces,
+            'nb_encoded_faces': self.nb_encoded_faces,
+            'encoder_call_rate': self.nb_encoded_faces / self.nb_faces if self.nb_faces > 0 else 0.0
+        }
 
 
 class streamProcessor:
@@ -72,7 +276,7 @@ class streamProcessor:
         - We average the results over a number of frames.
 
     """
-    def __init__(self, video_stream, face_comparator, nb_frames_in_history = 10, closeness_threshold = 2.5, resize_factor = 5.0, process_every = 2):
+    def __init__(self, video_stream, face_comparator, nb_frames_in_history = 10, closeness_threshold = 2.5, resize_factor = 5.0, process_every = 2, color = None, multi_face = False, motion_gate = None, scheduler = None):
         """
         Initialization of the class.
 
@@ -82,6 +286,10 @@ class streamProcessor:
         :param closeness_threshold: The tolerance used to actualize the current name.
         :param resize_factor: Before applying the detector, each frame is resized by this factor. This allows for a faster computation.
         :param process_every: We do not process each frame, but only a fraction of them. We process only one frame in process_every.
+        :param color: The layout in which frames are given to the face comparator: None (BGR, as read from the stream) or 'RGB'.
+        :param multi_face: Whether the frames with several faces are taken into account in the history.
+        :param motion_gate: If not None, the motionGate deciding whether to analyse frames where no face is detected.
+        :param scheduler: If not None, the adaptiveScheduler choosing process_every and resize_factor.
         """
         # Initialization of constructors.
         self.video_stream = video_stream
@@ -90,9 +298,16 @@ class streamProcessor:
         self.closeness_threshold = closeness_threshold
         self.resize_factor = resize_factor
         self.process_every = process_every
+        # Initialization of the preprocessing of the frames.
+        self.preprocessor = framePreprocessor(resize_factor, color)
+        self.motion_gate = motion_gate
+        self.scheduler = scheduler
+        # The scheduler starts from the configured cadence and downscale factor.
+        if scheduler is not None:
+            scheduler.setInitialDecisions(process_every, resize_factor)
         # Initialization of useful parameters for stream analysis.
         self.frame_counter = 0
-        self.frame_history = []
+        self.identity_voter = identityVoter(nb_frames_in_history, multi_face)
         self.current_frame = None
         # Initialize results.
         self.current_analysis = []
@@ -107,32 +322,39 @@ class streamProcessor:
         """
         # Get current frame.
         self.current_frame = self.video_stream.getCurrentFrame()
+        # Apply the decisions of the scheduler.
+        if self.scheduler is not None:
+            self.scheduler.recordFrame()
+            self.process_every = self.scheduler.process_every
+            self.resize_factor = self.scheduler.resize_factor
+            self.preprocessor.setResizeFactor(self.resize_factor)
         # Only process a fraction of the frames.
         if (self.frame_counter % self.process_every == 0):
+            start_time = time.perf_counter()
             # Resize frame of video for faster face recognition processing.
-            small_frame = scipy.misc.imresize(self.current_frame, 1.0 / self.resize_factor)
-            self.current_analysis = [(name_match, distance, self.resize_factor * np.array(face_location)) for (name_match, distance, face_location) in self.face_comparator.analyseFrame(small_frame, database)]
+            small_frame = self.preprocessor.process(self.current_frame)
+            # Only analyse the frame if it changed or if faces are detected. Otherwise, no face is detected.
+            moving = self.motion_gate is None or self.motion_gate.isMoving(small_frame)
+            if moving or len(self.current_analysis) > 0:
+                preprocessing_time = time.perf_counter()
+                self.current_analysis = [(name_match, distance, self.preprocessor.scaleLocation(face_location)) for (name_match, distance, face_location) in self.face_comparator.analyseFrame(small_frame, database)]
+                # Measure the latency of the analysis.
+                if self.scheduler is not None:
+                    end_time = time.perf_counter()
+                    self.scheduler.recordLatency('preprocessing', preprocessing_time - start_time)
+                    self.scheduler.recordLatency('detection', end_time - preprocessing_time)
+                    self.scheduler.recordAnalysis(end_time - start_time)
             # Actualize frame history.
-            if (len(self.frame_history) >= self.nb_frames_in_history):
-                del self.frame_history[0]
-            self.frame_history.append(self.current_analysis)
+            self.identity_voter.add(self.current_analysis)
             # Nullify frame counter to avoid dealing with very large numbers.
             self.frame_counter = 0
 
-        # Analyse frame history.
-        frame_history_1 = [element for element in self.frame_history if len(element) == 1]
-        results = {}
-        for [(name, distance, location)] in frame_history_1:
-            results[name] = 0
-        for [(name, distance, location)] in frame_history_1:
-            results[name] += 1 - distance
-        results = [(key, results[key]) for key in results]
-        results = sorted(results, key = lambda a : -a[1])
-        # results is now the array [(name, cumulative closeness)] corresponding to the recent history of detections.
-        if len(results) == 0:
+        # Get the name with the best cumulative closeness over the recent history of detections.
+        best = self.identity_voter.getBest()
+        if best is None:
             self.current_name = None
-        elif ((results[0][1] >= self.closeness_threshold) and (self.current_name == None)):
-            self.current_name = results[0][0]
+        elif ((best[1] >= self.closeness_threshold) and (self.current_name == None)):
+            self.current_name = best[0]
         # Increment counter.
         self.frame_counter += 1
 
@@ -164,3 +386,89 @@ class streamProcessor:
         """
         self._actualizeAnalysis(database)
         return (self.current_frame.copy(), self.face_comparator.drawResult(self.current_frame, self.current_analysis))
+
+
+class analysisEngine:
+    """
+    This class runs the analysis of a stream processor on a background thread,
+    so that the graphical user interface never waits for the capture, the
+    detection or the encoding of the faces.
+
+    The thread continuously actualizes the analysis, and publishes after each
+    frame the snapshot
+
+        (sequence, clean_frame, drawn_frame, analysis, name)
+
+    with a single assignment. The frames of a snapshot are not modified
+    afterwards, so that the caller can use them without copy.
+    """
+    def __init__(self, stream_processor, database):
+        """
+        Initialization of the class.
+
+        :param stream_processor: The stream processor whose analysis runs in the background.
+        :param database: The database with which to compare the frames. The face comparator only holds the lock of the database while searching it, so that the database can be modified from another thread.
+        """
+        # Initialize constructors.
+        self.stream_processor = stream_processor
+        self.database = database
+        # Initialize the published snapshot. None until the first frame is analysed.
+        self.current_snapshot = None
+        self.sequence = 0
+        self.reinitialize_name = False
+        self.error = None
+        # Start the background thread.
+        self.running = True
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+
+    def _run(self):
+        """
+        Actualizes the analysis until the engine is closed.
+        """
+        try:
+            while self.running:
+                # Apply the reinitialization of the name asked since the last frame.
+                if self.reinitialize_name:
+                    self.reinitialize_name = False
+                    self.stream_processor.reinitializeCurrentName()
+                (clean_frame, drawn_frame) = self.stream_processor.drawCurrentFrame(self.database)
+                # Publish the snapshot.
+                self.sequence += 1
+                name = None if self.reinitialize_name else self.stream_processor.getCurrentName()
+                self.current_snapshot = (self.sequence, clean_frame, drawn_frame, self.stream_processor.getCurrentAnalysis(), name)
+        except Exception as error:
+            # The error is raised again by the next read.
+            self.error = error
+
+
+    def close(self):
+        """
+        Stops the background thread. The video stream must be closed afterwards.
+        """
+        self.running = False
+        self.thread.join()
+
+
+    def reinitializeCurrentName(self):
+        """
+        Reinitializes the value of the current identified name. The published
+        name is None until the next identification.
+        """
+        # Nothing to do if no name is identified.
+        if self.current_snapshot is None or self.current_snapshot[4] is None:
+            return
+        self.reinitialize_name = True
+        (sequence, clean_frame, drawn_frame, analysis, name) = self.current_snapshot
+        self.current_snapshot = (sequence, clean_frame, drawn_frame, analysis, None)
+
+
+    def getCurrentSnapshot(self):
+        """
+        Returns the last published snapshot, as (sequence, clean_frame,
+        drawn_frame, analysis, name), or None if no frame was analysed yet.
+        """
+        if self.error is not None:
+            raise self.error
+        return self.current_snapshot
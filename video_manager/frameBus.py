@@ -0,0 +1,380 @@
+"""
+The purpose of this module is to share a single camera between several
+processes, e.g. the eyes application, the face recognition application and
+detector worker processes. Both applications import it from this folder.
+
+The frame bus daemon owns the camera, and writes its frames into a ring buffer
+of nb_slots frames in shared memory (multiprocessing.shared_memory). Each frame
+is published with a sequence number and the time at which it was read (as
+given by time.monotonic, which is shared by the processes of the machine). The
+clients map the same shared memory, and read the newest frame without copying
+nor decoding it.
+
+The shared memory is made of a header of HEADER_SIZE int64
+
+    magic, height, width, channels, nb_slots, newest sequence, running
+
+followed by the sequence numbers of the slots (nb_slots int64), the timestamps
+of the slots (nb_slots float64), and the frames of the slots (nb_slots
+height x width x channels uint8).
+
+The sequence number of a slot is set to 0 while its frame is written, so that a
+reader can check that the frame it read was not overwritten in the meantime.
+A frame read without copy remains valid until the daemon writes nb_slots - 1
+newer frames: frameBusStream.isValid tells whether it is still the case.
+
+The daemon is run with
+
+    python video_manager/frameBus.py --webcam 0 --name aiml_eye_frames
+
+and frameBusStream implements the same interface as webcamStream: in
+particular, getCurrentFrame waits for a frame newer than the last read one, so
+that the reads pace the stream processors. A daemon that stopped, or did not
+publish a frame for STALE_AFTER seconds (e.g. because it was killed), is
+reported by frameBusStream with FileNotFoundError when connecting and with
+IOError when reading, so that the applications can fall back to the webcam.
+"""
+
+################################################################################
+# Imports.
+################################################################################
+
+# Utilitary packages.
+import argparse
+import signal
+import time
+from multiprocessing import shared_memory
+
+# Packages for image processing.
+import cv2
+import numpy as np
+
+
+################################################################################
+# Definition of global variables.
+################################################################################
+
+DEFAULT_NAME = 'aiml_eye_frames'
+MAGIC = 0x4149454631
+HEADER_SIZE = 8
+STALE_AFTER = 5.0
+(MAGIC_FIELD, HEIGHT_FIELD, WIDTH_FIELD, CHANNELS_FIELD, NB_SLOTS_FIELD, SEQUENCE_FIELD, RUNNING_FIELD) = range(7)
+
+
+################################################################################
+# Main content of the module.
+################################################################################
+
+def _mapBuffer(buffer, height, width, channels, nb_slots):
+    """
+    Maps the header, the sequence numbers, the timestamps and the frames of the
+    ring buffer on a shared memory buffer.
+
+    :return: A tuple (header, sequences, timestamps, frames) of arrays sharing the memory of the buffer.
+    """
+    header = np.ndarray(HEADER_SIZE, dtype = np.int64, buffer = buffer)
+    offset = header.nbytes
+    sequences = np.ndarray(nb_slots, dtype = np.int64, buffer = buffer, offset = offset)
+    offset += sequences.nbytes
+    timestamps = np.ndarray(nb_slots, dtype = np.float64, buffer = buffer, offset = offset)
+    offset += timestamps.nbytes
+    frames = np.ndarray((nb_slots, height, width, channels), dtype = np.uint8, buffer = buffer, offset = offset)
+    return (header, sequences, timestamps, frames)
+
+
+def _bufferSize(height, width, channels, nb_slots):
+    """
+    Returns the size in bytes of the ring buffer.
+    """
+    return 8 * (HEADER_SIZE + 2 * nb_slots) + nb_slots * height * width * channels
+
+
+class frameBusDaemon:
+    """
+    This class implements the daemon that reads the frames of the webcam and
+    publishes them in shared memory.
+    """
+    def __init__(self, webcam_number = 0, name = DEFAULT_NAME, nb_slots = 8, stale_after = STALE_AFTER):
+        """
+        Initialization of the class. The size of the frames is given by the first
+        frame of the webcam.
+
+        :param webcam_number: The number of the considered webcam (by default 0).
+        :param name: The name of the shared memory, used by the clients.
+        :param nb_slots: The number of frames of the ring buffer.
+        :param stale_after: The shared memory of a daemon that did not publish a frame for this number of seconds is considered as left by a daemon that did not stop properly, and is replaced.
+        """
+        # Remove the shared memory of a daemon that did not stop properly, but never the one of a running daemon.
+        self._removeStaleMemory(name, stale_after)
+        self.video_capture = cv2.VideoCapture(webcam_number)
+        # Keep as few frames as possible in the driver.
+        self.video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        ret, frame = self.video_capture.read()
+        if not ret:
+            self.video_capture.release()
+            raise IOError('Cannot read the webcam ' + str(webcam_number))
+        if frame.ndim == 2:
+            frame = frame[:, :, np.newaxis]
+        (height, width, channels) = frame.shape
+        # Create the shared memory. Raises FileExistsError if another daemon started meanwhile.
+        try:
+            self.shared_memory = shared_memory.SharedMemory(name = name, create = True, size = _bufferSize(height, width, channels, nb_slots))
+        except FileExistsError:
+            self.video_capture.release()
+            raise
+        (self.header, self.sequences, self.timestamps, self.frames) = _mapBuffer(self.shared_memory.buf, height, width, channels, nb_slots)
+        self.sequences[:] = 0
+        self.header[:] = [MAGIC, height, width, channels, nb_slots, 0, 1, 0]
+        self.nb_slots = nb_slots
+        self.sequence = 0
+        self._publish(frame)
+
+
+    def _removeStaleMemory(self, name, stale_after):
+        """
+        Removes the shared memory of the given name if it was left by a daemon
+        that did not stop properly, i.e. if the daemon stopped or did not publish
+        a frame for stale_after seconds.
+
+        :param name: The name of the shared memory.
+        :param stale_after: The number of seconds after which a daemon without new frame is considered as stopped.
+        """
+        try:
+            stale_memory = shared_memory.SharedMemory(name = name, track = False)
+        except TypeError:
+            # Before python 3.13, the shared memory would be removed when the daemon exits, even if it is live.
+            from multiprocessing import resource_tracker
+            try:
+                stale_memory = shared_memory.SharedMemory(name = name)
+            except FileNotFoundError:
+                return
+            resource_tracker.unregister(stale_memory._name, 'shared_memory')
+        except FileNotFoundError:
+            return
+        live = False
+        if stale_memory.size >= 8 * HEADER_SIZE:
+            header = np.ndarray(HEADER_SIZE, dtype = np.int64, buffer = stale_memory.buf)
+            if header[MAGIC_FIELD] == MAGIC and header[RUNNING_FIELD]:
+                (height, width, channels, nb_slots, sequence) = header[[HEIGHT_FIELD, WIDTH_FIELD, CHANNELS_FIELD, NB_SLOTS_FIELD, SEQUENCE_FIELD]].tolist()
+                (header, sequences, timestamps, frames) = _mapBuffer(stale_memory.buf, height, width, channels, nb_slots)
+                live = time.monotonic() - timestamps[sequence % nb_slots] < stale_after
+                del sequences, timestamps, frames
+            del header
+        stale_memory.close()
+        if live:
+            raise IOError('A frame bus daemon is already running with the shared memory ' + name)
+        stale_memory.unlink()
+
+
+    def _publish(self, frame):
+        """
+        Writes a frame in the next slot of the ring buffer, and publishes it.
+
+        :param frame: The frame, or None if it was already decoded in the next slot.
+        """
+        self.sequence += 1
+        slot = self.sequence % self.nb_slots
+        if frame is not None:
+            if frame.ndim == 2:
+                frame = frame[:, :, np.newaxis]
+            if frame.shape == self.frames[slot].shape:
+                self.frames[slot] = frame
+            else:
+                cv2.resize(frame, (self.frames.shape[2], self.frames.shape[1]), dst = self.frames[slot])
+        self.timestamps[slot] = time.monotonic()
+        self.sequences[slot] = self.sequence
+        self.header[SEQUENCE_FIELD] = self.sequence
+
+
+    def run(self, nb_frames = None):
+        """
+        Reads and publishes the frames of the webcam until the daemon is closed
+        or interrupted.
+
+        :param nb_frames: The number of frames to publish. By default, there is no limit.
+        """
+        count = 0
+        while self.header[RUNNING_FIELD] and (nb_frames is None or count < nb_frames):
+            slot = (self.sequence + 1) % self.nb_slots
+            # Invalidate the slot, and decode the frame directly in the shared memory when possible.
+            self.sequences[slot] = 0
+            ret, frame = self.video_capture.read(self.frames[slot])
+            if not ret:
+                # Do not spin if the webcam is not available.
+                time.sleep(0.01)
+                continue
+            self._publish(None if np.shares_memory(frame, self.frames[slot]) else frame)
+            count += 1
+
+
+    def stop(self):
+        """
+        Asks the daemon to stop after the current frame, e.g. from a signal
+        handler. The clients stop waiting for new frames.
+        """
+        self.header[RUNNING_FIELD] = 0
+
+
+    def close(self):
+        """
+        Stops the daemon, releases the webcam and removes the shared memory. The
+        clients keep their mapping until they are closed.
+        """
+        self.header[RUNNING_FIELD] = 0
+        self.video_capture.release()
+        # Release the views on the shared memory before closing it.
+        del self.header, self.sequences, self.timestamps, self.frames
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+
+class frameBusStream:
+    """
+    This class implements the video stream of a frame bus, with the same
+    interface as webcamStream.
+
+    getFrame returns the frames of the ring buffer without copy, as read-only
+    arrays: they are valid until the daemon overwrites their slot, which can be
+    checked with isValid. getCurrentFrame returns a copy by default, as the
+    callers may draw on the frame, and as the stream processors do not check
+    that the frame remains valid during their analysis.
+    """
+    def __init__(self, name = DEFAULT_NAME, copy = True, poll_interval = 0.002, stale_after = STALE_AFTER):
+        """
+        Initialization of the class.
+
+        :param name: The name of the shared memory of the daemon.
+        :param copy: Whether getCurrentFrame copies the frame. Without copy, the frame is read-only, and the caller must check isValid(self.sequence) after using it.
+        :param poll_interval: The interval in seconds between two checks for a new frame.
+        :param stale_after: A daemon that did not publish a frame for this number of seconds is considered as stopped, e.g. if it was killed before removing its shared memory.
+        """
+        # Map the shared memory. Raises FileNotFoundError if no daemon is running.
+        try:
+            self.shared_memory = shared_memory.SharedMemory(name = name, track = False)
+        except TypeError:
+            # Before python 3.13, the shared memory would be removed when the client exits.
+            from multiprocessing import resource_tracker
+            self.shared_memory = shared_memory.SharedMemory(name = name)
+            resource_tracker.unregister(self.shared_memory._name, 'shared_memory')
+        header = np.ndarray(HEADER_SIZE, dtype = np.int64, buffer = self.shared_memory.buf)
+        if header[MAGIC_FIELD] != MAGIC:
+            raise IOError('The shared memory ' + name + ' is not a frame bus')
+        (height, width, channels, nb_slots) = header[[HEIGHT_FIELD, WIDTH_FIELD, CHANNELS_FIELD, NB_SLOTS_FIELD]].tolist()
+        (self.header, self.sequences, self.timestamps, self.frames) = _mapBuffer(self.shared_memory.buf, height, width, channels, nb_slots)
+        self.frames.flags.writeable = False
+        self.nb_slots = nb_slots
+        self.copy = copy
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        # The shared memory of a daemon that was killed remains: the callers fall back as if there was no daemon.
+        if self._isStale():
+            self.close()
+            raise FileNotFoundError('The frame bus daemon of the shared memory ' + name + ' stopped')
+        # Initialize the sequence number and the timestamp of the last read frame.
+        self.sequence = 0
+        self.timestamp = None
+
+
+    def close(self):
+        """
+        Unmaps the shared memory. The frames returned without copy must not be
+        used afterwards.
+        """
+        if self.shared_memory is None:
+            return
+        del self.header, self.sequences, self.timestamps, self.frames
+        try:
+            self.shared_memory.close()
+        except BufferError:
+            # Frames returned without copy are still referenced: the mapping is released with them.
+            pass
+        self.shared_memory = None
+
+
+    def _isStale(self):
+        """
+        Returns whether the daemon stopped, or did not publish a frame for
+        stale_after seconds.
+        """
+        if not self.header[RUNNING_FIELD]:
+            return True
+        sequence = int(self.header[SEQUENCE_FIELD])
+        return sequence > 0 and time.monotonic() - self.timestamps[sequence % self.nb_slots] >= self.stale_after
+
+
+    def isValid(self, sequence):
+        """
+        Returns whether the frame of the given sequence number is still in the
+        ring buffer, i.e. whether a frame returned without copy was not overwritten.
+
+        :param sequence: The sequence number of the frame.
+        """
+        return sequence > 0 and self.sequences[sequence % self.nb_slots] == sequence
+
+
+    def getFrame(self, newer_than = 0, timeout = None, copy = False):
+        """
+        Returns the newest frame of the stream, along with its sequence number and
+        its timestamp.
+
+        :param newer_than: Waits until the sequence number of the newest frame is larger than this number. By default, waits for the first frame only.
+        :param timeout: The maximal waiting time in seconds. By default, there is no limit.
+        :param copy: Whether to copy the frame. Without copy, the frame is a read-only view on the shared memory.
+        :return: A tuple (sequence, timestamp, frame). If the timeout expires, the newest frame is returned anyway: the caller should check its sequence number.
+        :raises IOError: If the daemon stopped, or did not publish a frame for stale_after seconds, and there is no frame newer than newer_than, so that the caller can fall back to another stream.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            sequence = int(self.header[SEQUENCE_FIELD])
+            stale = sequence <= newer_than and self._isStale()
+            waiting = sequence <= newer_than and not stale and (deadline is None or time.monotonic() < deadline)
+            if waiting:
+                time.sleep(self.poll_interval)
+                continue
+            if stale:
+                raise IOError('The frame bus daemon stopped')
+            if sequence == 0:
+                return (0, None, None)
+            slot = sequence % self.nb_slots
+            timestamp = float(self.timestamps[slot])
+            frame = self.frames[slot]
+            if copy:
+                frame = frame.copy()
+            # Read again if the slot was overwritten in the meantime.
+            if self.isValid(sequence):
+                break
+        if frame.shape[2] == 1:
+            frame = frame[:, :, 0]
+        self.sequence = sequence
+        self.timestamp = timestamp
+        return (sequence, timestamp, frame)
+
+
+    def getCurrentFrame(self):
+        """
+        Returns the current frame of the stream, as np.array. Waits for a frame
+        newer than the last read one, as the reads of a webcam do.
+
+        :raises IOError: If the daemon stopped, or stalled, and all its frames were read.
+        """
+        sequence, timestamp, frame = self.getFrame(newer_than = self.sequence, copy = self.copy)
+        return frame
+
+
+if __name__ == '__main__':
+    # Parse arguments.
+    parser = argparse.ArgumentParser(description = 'Publishes the frames of a webcam in shared memory, for all the applications of the exhibit.')
+    parser.add_argument('--webcam', type = int, default = 0, help = 'Number of the webcam.')
+    parser.add_argument('--name', default = DEFAULT_NAME, help = 'Name of the shared memory.')
+    parser.add_argument('--slots', type = int, default = 8, help = 'Number of frames of the ring buffer.')
+    arguments = parser.parse_args()
+
+    # Run the daemon until it is interrupted or terminated, e.g. by a service manager.
+    daemon = frameBusDaemon(arguments.webcam, arguments.name, arguments.slots)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
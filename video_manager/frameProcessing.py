@@ -0,0 +1,345 @@
+"""
+The purpose of this module is to implement the processing of the frames shared
+by the stream processors of both applications (streamProcessor.py and
+streamProcessorEyes.py), which import it from this folder.
+
+The class framePreprocessor downscales the frames before the analysis, and maps
+the locations found in the downscaled frames back to the frames. The class
+adaptiveScheduler chooses how often the frames are analysed and by which factor
+they are downscaled, from the measured latency of the analysis. The class
+motionGate decides whether a frame changed enough since the previous one to be
+worth analysing.
+"""
+
+################################################################################
+# Imports.
+################################################################################
+
+# Utilitary packages.
+import time
+
+# Packages for image processing.
+import cv2
+import numpy as np
+
+
+################################################################################
+# Main content of the module.
+################################################################################
+
+class framePreprocessor:
+    """
+    This class implements the preprocessing of the frames before the analysis:
+    each frame is downscaled with cv2.resize (INTER_AREA interpolation) and
+    optionally converted to the layout needed by the detector. The results are
+    written in buffers allocated once, so that no array is allocated per frame.
+
+    The returned frame is overwritten by the next call to process.
+    """
+    def __init__(self, resize_factor = 4.0, color = None):
+        """
+        Initialization of the class.
+
+        :param resize_factor: Each frame is downscaled by this factor.
+        :param color: The layout of the returned frame, from BGR frames: None (unchanged), 'RGB' or 'GRAY'.
+        """
+        # Initialize constructors.
+        self.resize_factor = resize_factor
+        self.color = color
+        self.conversion = {None: None, 'RGB': cv2.COLOR_BGR2RGB, 'GRAY': cv2.COLOR_BGR2GRAY}[color]
+        # Initialize buffers, allocated for the size of the first frame.
+        self.frame_shape = None
+        self.small_frame = None
+        self.converted_frame = None
+        # Initialize scale factors from the downscaled frame to the frame, as [scale_x, scale_y].
+        self.scale = [resize_factor, resize_factor]
+
+
+    def _allocate(self, frame):
+        """
+        Allocates the buffers for frames with the shape of the given frame.
+
+        :param frame: The frame to process.
+        """
+        height, width = frame.shape[:2]
+        small_width = max(1, int(width / self.resize_factor))
+        small_height = max(1, int(height / self.resize_factor))
+        self.frame_shape = frame.shape
+        self.small_frame = np.empty((small_height, small_width) + frame.shape[2:], dtype = frame.dtype)
+        self.converted_frame = None
+        if self.conversion is not None:
+            self.converted_frame = cv2.cvtColor(self.small_frame, self.conversion)
+        self.scale = [width / small_width, height / small_height]
+
+
+    def process(self, frame):
+        """
+        Returns the downscaled and converted frame.
+
+        :param frame: The frame to process, as np.array.
+        """
+        if frame.shape != self.frame_shape or frame.dtype != self.small_frame.dtype:
+            self._allocate(frame)
+        cv2.resize(frame, (self.small_frame.shape[1], self.small_frame.shape[0]), dst = self.small_frame, interpolation = cv2.INTER_AREA)
+        if self.conversion is None:
+            return self.small_frame
+        cv2.cvtColor(self.small_frame, self.conversion, dst = self.converted_frame)
+        return self.converted_frame
+
+
+    def setResizeFactor(self, resize_factor):
+        """
+        Changes the factor by which frames are downscaled. The buffers are
+        allocated again at the next frame.
+
+        :param resize_factor: The new factor.
+        """
+        if resize_factor != self.resize_factor:
+            self.resize_factor = resize_factor
+            self.frame_shape = None
+
+
+    def scaleLocation(self, location):
+        """
+        Maps a location of the downscaled frame back to the frame.
+
+        :param location: The location (top, right, bottom, left) in the downscaled frame.
+        :return: The location (top, right, bottom, left) in the frame, as np.array of integers.
+        """
+        [scale_x, scale_y] = self.scale
+        return np.rint(np.array(location) * [scale_y, scale_x, scale_y, scale_x]).astype(int)
+
+
+    def scaleLocations(self, locations):
+        """
+        Maps detections of the downscaled frame back to the frame, in place.
+
+        :param locations: The batch of detections in the downscaled frame.
+        :return: The batch of detections in the frame.
+        """
+        [scale_x, scale_y] = self.scale
+        locations['box'] = np.rint(locations['box'] * [scale_x, scale_y, scale_x, scale_y])
+        return locations
+
+
+class adaptiveScheduler:
+    """
+    This class chooses online how often frames are analysed and by which
+    factor they are downscaled, from the measured latency of the analysis.
+
+    The latency of the analysis is roughly proportional to the number of pixels
+    of the downscaled frame, i.e. to 1 / resize_factor^2. From the measured
+    latencies, we estimate the cost of the analysis at full resolution, and we
+    choose:
+
+        - the smallest resize_factor for which the analysis takes at most
+        target_latency seconds,
+        - the smallest process_every for which the analysis takes on average at
+        most a fraction detection_budget of the time of a frame at the
+        measured frame rate of the stream processor (or at target_fps until
+        the frame rate is measured),
+
+    within the given bounds. The measures are smoothed with an exponential
+    moving average. Until the first measure, the decisions are the cadence and
+    the downscale factor configured in the stream processor (see
+    setInitialDecisions).
+    """
+    def __init__(self, target_latency = 0.1, target_fps = 30.0, detection_budget = 0.5, min_process_every = 1, max_process_every = 10, min_resize_factor = 1.0, max_resize_factor = 8.0, resize_step = 0.25, smoothing = 0.2):
+        """
+        Initialization of the class.
+
+        :param target_latency: The target latency of the analysis of a frame, in seconds.
+        :param target_fps: The number of frames per second of the stream processor assumed until the frame rate is measured.
+        :param detection_budget: The fraction of the time of a frame that the analysis may take on average.
+        :param min_process_every: The minimal number of frames between two analysed frames.
+        :param max_process_every: The maximal number of frames between two analysed frames.
+        :param min_resize_factor: The minimal factor by which frames are downscaled.
+        :param max_resize_factor: The maximal factor by which frames are downscaled.
+        :param resize_step: The resize factor is a multiple of this step, so that the buffers of the frames are not allocated at every change.
+        :param smoothing: The weight of a new measure in the moving averages.
+        """
+        # Initialize constructors.
+        self.target_latency = target_latency
+        self.target_fps = target_fps
+        self.detection_budget = detection_budget
+        self.min_process_every = min_process_every
+        self.max_process_every = max_process_every
+        self.min_resize_factor = min_resize_factor
+        self.max_resize_factor = max_resize_factor
+        self.resize_step = resize_step
+        self.smoothing = smoothing
+        # Initialize the measures: the average latency of each stage, the average period of the frames, and the estimated cost at full resolution.
+        self.latencies = {}
+        self.frame_period = None
+        self.last_frame_time = None
+        self.full_resolution_cost = None
+        # Initialize decisions.
+        self.process_every = min_process_every
+        self.resize_factor = min_resize_factor
+
+
+    def setInitialDecisions(self, process_every, resize_factor):
+        """
+        Sets the decisions used until the first measure, within the bounds. The
+        stream processors call it with their configured process_every and
+        resize_factor, so that the first analysed frames are not analysed at
+        the minimal downscale factor. It has no effect once a latency was
+        measured.
+
+        :param process_every: The initial number of frames between two analysed frames.
+        :param resize_factor: The initial factor by which frames are downscaled.
+        """
+        if self.full_resolution_cost is not None:
+            return
+        self.process_every = min(max(process_every, self.min_process_every), self.max_process_every)
+        self.resize_factor = float(min(max(resize_factor, self.min_resize_factor), self.max_resize_factor))
+
+
+    def _average(self, average, value):
+        """
+        Returns the actualized moving average.
+        """
+        return value if average is None else (1 - self.smoothing) * average + self.smoothing * value
+
+
+    def recordFrame(self):
+        """
+        Records that a frame was processed, to measure the frame rate.
+        """
+        now = time.perf_counter()
+        if self.last_frame_time is not None:
+            self.frame_period = self._average(self.frame_period, now - self.last_frame_time)
+        self.last_frame_time = now
+
+
+    def recordLatency(self, stage, latency):
+        """
+        Records the latency of a stage of the analysis of a frame, for monitoring.
+
+        :param stage: The name of the stage, e.g. 'preprocessing' or 'detection'.
+        :param latency: The latency in seconds.
+        """
+        self.latencies[stage] = self._average(self.latencies.get(stage), latency)
+
+
+    def recordAnalysis(self, latency):
+        """
+        Records the total latency of the analysis of a frame downscaled by the
+        current resize factor, and actualizes the decisions.
+
+        :param latency: The latency in seconds.
+        """
+        self.recordLatency('analysis', latency)
+        self.full_resolution_cost = self._average(self.full_resolution_cost, latency * self.resize_factor ** 2)
+        # Choose the resize factor, rounded up to the step.
+        resize_factor = np.sqrt(self.full_resolution_cost / self.target_latency)
+        resize_factor = np.ceil(resize_factor / self.resize_step) * self.resize_step
+        self.resize_factor = float(min(max(resize_factor, self.min_resize_factor), self.max_resize_factor))
+        # Choose the number of frames between two analysed frames, at the measured frame rate.
+        expected_latency = self.full_resolution_cost / self.resize_factor ** 2
+        fps = 1.0 / self.frame_period if self.frame_period else self.target_fps
+        process_every = int(np.ceil(expected_latency * fps / self.detection_budget))
+        self.process_every = min(max(process_every, self.min_process_every), self.max_process_every)
+
+
+    def getDecisions(self):
+        """
+        Returns the current decisions and measures, as a dictionary.
+        """
+        return {
+            'process_every': self.process_every,
+            'resize_factor': self.resize_factor,
+            'latencies': dict(self.latencies),
+            'fps': 1.0 / self.frame_period if self.frame_period else None
+        }
+
+
+class motionGate:
+    """
+    This class decides whether a frame changed enough since the previous one to
+    be worth analysing. The frames are downscaled to a small grayscale image,
+    and the gate opens when the fraction of changed pixels exceeds
+    area_threshold.
+
+    The changed pixels are either the pixels whose difference with the
+    previous frame exceeds pixel_threshold, or, if a background subtractor is
+    given (e.g. the one of peopleDetector.peopleDetectorBackSub), the pixels of
+    the foreground mask.
+    """
+    def __init__(self, area_threshold = 0.01, pixel_threshold = 25, width = 80, background_subtractor = None, refresh_every = None):
+        """
+        Initialization of the class.
+
+        :param area_threshold: The minimal fraction of changed pixels for the gate to open.
+        :param pixel_threshold: The minimal difference of gray level for a pixel to be changed.
+        :param width: The width of the downscaled images that are compared.
+        :param background_subtractor: An opencv background subtractor, used instead of the difference between frames.
+        :param refresh_every: If not None, the gate opens at least once every refresh_every frames.
+        """
+        # Initialize constructors.
+        self.area_threshold = area_threshold
+        self.pixel_threshold = pixel_threshold
+        self.width = width
+        self.background_subtractor = background_subtractor
+        self.refresh_every = refresh_every
+        # Initialize buffers, allocated for the size of the first frame.
+        self.frame_shape = None
+        self.small_frame = None
+        self.gray_frame = None
+        self.previous_frame = None
+        self.difference = None
+        # Initialize counters.
+        self.nb_closed = 0
+        self.nb_frames = 0
+        self.nb_opened = 0
+
+
+    def _allocate(self, frame):
+        """
+        Allocates the buffers for frames with the shape of the given frame.
+
+        :param frame: The considered frame.
+        """
+        height, width = frame.shape[:2]
+        small_width = min(width, self.width)
+        small_height = max(1, int(round(height * small_width / width)))
+        self.frame_shape = frame.shape
+        self.small_frame = np.empty((small_height, small_width) + frame.shape[2:], dtype = np.uint8)
+        self.gray_frame = np.empty((small_height, small_width), dtype = np.uint8)
+        self.previous_frame = None
+        self.difference = np.empty((small_height, small_width), dtype = np.uint8)
+
+
+    def isMoving(self, frame):
+        """
+        Returns whether the frame changed enough since the previous one.
+
+        :param frame: The considered frame, as BGR or grayscale np.array of uint8.
+        """
+        if frame.shape != self.frame_shape:
+            self._allocate(frame)
+        # Downscale the frame to grayscale.
+        cv2.resize(frame, (self.small_frame.shape[1], self.small_frame.shape[0]), dst = self.small_frame, interpolation = cv2.INTER_AREA)
+        if self.small_frame.ndim == 3:
+            cv2.cvtColor(self.small_frame, cv2.COLOR_BGR2GRAY, dst = self.gray_frame)
+        else:
+            self.gray_frame[...] = self.small_frame
+        # Compute the changed pixels.
+        if self.background_subtractor is not None:
+            mask = self.background_subtractor.apply(self.gray_frame)
+            changed = cv2.countNonZero(cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1])
+        elif self.previous_frame is None:
+            self.previous_frame = self.gray_frame.copy()
+            changed = self.gray_frame.size
+        else:
+            cv2.absdiff(self.gray_frame, self.previous_frame, dst = self.difference)
+            changed = cv2.countNonZero(cv2.threshold(self.difference, self.pixel_threshold, 255, cv2.THRESH_BINARY)[1])
+            self.previous_frame[...] = self.gray_frame
+        # Decide.
+        self.nb_frames += 1
+        moving = changed >= self.area_threshold * self.gray_frame.size
+        if not moving and self.refresh_every is not None and self.nb_closed + 1 >= self.refresh_every:
+            moving = True
+        self.nb_closed = 0 if moving else self.nb_closed + 1
+        self.nb_opened += moving
+        return moving
@@ -0,0 +1,453 @@
+"""
+The purpose of this module is to implement the video streams shared by the
+stream processors of both applications (streamProcessor.py and
+streamProcessorEyes.py), which import it from this folder. A video stream must
+implement the function
+
+    getCurrentFrame()
+
+which returns the current frame of the stream as np array.
+
+The class webcamStream reads the frames of a webcam, on a background thread.
+The classes videoFileStream and imageDirectoryStream replay recordings instead
+of the webcam, so that the processors can be profiled without a webcam.
+"""
+
+################################################################################
+# Imports.
+################################################################################
+
+# Utilitary packages.
+import json
+import os
+import threading
+import time
+
+# Packages for image processing.
+import cv2
+import numpy as np
+
+
+################################################################################
+# Main content of the module.
+################################################################################
+
+class webcamStream:
+    """
+    This class implements the video stream of a webcam.
+
+    By default, each call to getCurrentFrame reads a frame from the webcam, and
+    thus waits for the next frame of the camera. With threaded = True, frames
+    are read continuously on a dedicated thread and only the newest one is
+    kept, along with its sequence number and the time at which it was read:
+    getCurrentFrame then returns immediately, and the frames that were not
+    used are dropped instead of queuing up in the driver.
+    """
+    def __init__(self, webcam_number = 0, threaded = False, read_timeout = 0.5):
+        """
+        Initialization of the class.
+
+        :param webcam_number: The number of the considered webcam (by default 0).
+        :param threaded: Whether to read the frames on a dedicated thread.
+        :param read_timeout: With threaded = True, the maximal time in seconds that getCurrentFrame waits for a new frame.
+        """
+        self.video_capture = cv2.VideoCapture(webcam_number)
+        self.threaded = threaded
+        self.read_timeout = read_timeout
+        # Initialize the newest frame, its sequence number and its timestamp (as given by time.monotonic).
+        self.frame = None
+        self.sequence = 0
+        self.timestamp = None
+        # Initialize the sequence number of the last frame returned by getCurrentFrame.
+        self.read_sequence = 0
+        # Start reading the frames.
+        self.condition = threading.Condition()
+        self.running = threaded
+        self.thread = None
+        if threaded:
+            # Keep as few frames as possible in the driver.
+            self.video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            self.thread = threading.Thread(target = self._grabFrames, daemon = True)
+            self.thread.start()
+
+
+    def _readFrame(self):
+        """
+        Reads a frame of the webcam, and actualizes the sequence number and the
+        timestamp. Returns None if no frame could be read.
+        """
+        ret, frame = self.video_capture.read()
+        if not ret:
+            return None
+        self.sequence += 1
+        self.timestamp = time.monotonic()
+        return frame
+
+
+    def _grabFrames(self):
+        """
+        Reads the frames of the webcam until the stream is closed, and keeps the
+        newest one.
+        """
+        while self.running:
+            ret, frame = self.video_capture.read()
+            if not ret:
+                # Do not spin if the webcam is not available.
+                time.sleep(0.01)
+                continue
+            # Frames are shared between readers: they must not be modified.
+            frame.flags.writeable = False
+            with self.condition:
+                self.frame = frame
+                self.sequence += 1
+                self.timestamp = time.monotonic()
+                self.condition.notify_all()
+
+
+    def close(self):
+        """
+        Closes the process of the stream.
+        """
+        if self.thread is not None:
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+            self.thread.join()
+            self.thread = None
+        self.video_capture.release()
+
+
+    def getFrame(self, newer_than = 0, timeout = None):
+        """
+        Returns the newest frame of the stream, along with its sequence number and
+        its timestamp. With threaded = True, the frame is shared between the
+        readers, and is thus read-only.
+
+        :param newer_than: Waits until the sequence number of the newest frame is larger than this number. By default, waits for the first frame only.
+        :param timeout: The maximal waiting time in seconds. By default, there is no limit.
+        :return: A tuple (sequence, timestamp, frame). If the timeout expires, the newest frame is returned anyway (or (0, None, None) if there is none yet): the caller should check its sequence number.
+        """
+        if not self.threaded:
+            frame = self._readFrame()
+            return (self.sequence, self.timestamp, frame)
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > newer_than or not self.running, timeout)
+            return (self.sequence, self.timestamp, self.frame)
+
+
+    def getCurrentFrame(self):
+        """
+        Returns the current frame of the stream, as np.array. With threaded =
+        True, waits for a frame newer than the last returned one, so that the
+        reads are paced by the webcam as without thread. Returns None if no
+        frame could be read (within read_timeout with threaded = True).
+        """
+        if not self.threaded:
+            return self._readFrame()
+        sequence, timestamp, frame = self.getFrame(newer_than = self.read_sequence, timeout = self.read_timeout)
+        # The webcam is missing or stalled, as a failed read.
+        if sequence <= self.read_sequence:
+            return None
+        self.read_sequence = sequence
+        # The caller may draw on the frame.
+        return None if frame is None else frame.copy()
+
+
+class replayStream:
+    """
+    This class implements the common part of the replay video streams, which
+    read recorded frames instead of the frames of a webcam, with the same
+    interface as webcamStream.
+
+    With realtime = True, the frames are paced at the frame rate of the
+    recording as a webcam would: a call to getCurrentFrame waits for the next
+    frame, and the frames that were not read in time are dropped. Otherwise,
+    each call returns the next frame immediately, so that the stream runs as
+    fast as its consumer. With loop = True, the recording is replayed
+    indefinitely, otherwise getCurrentFrame returns None at its end.
+
+    With a cache file, all the frames are decoded once and written in the
+    cache file, which is then memory-mapped: the frames are served without
+    decoding. The cache is decoded again only if the source changed.
+
+    The subclasses implement _sourceKey, _rewind and _readSource.
+    """
+    def __init__(self, fps, realtime = True, loop = False, cache_file = None):
+        """
+        Initialization of the class.
+
+        :param fps: The frame rate of the recording, in frames per second.
+        :param realtime: Whether to pace the frames at the frame rate of the recording.
+        :param loop: Whether to replay the recording indefinitely.
+        :param cache_file: The prefix of the files of the cache of decoded frames (prefix + '.frames' and prefix + '.json'). By default, frames are decoded as they are read.
+        """
+        # Initialize constructors.
+        self.fps = fps
+        self.realtime = realtime
+        self.loop = loop
+        self.cache_file = cache_file
+        # Initialize the newest frame, its sequence number and its timestamp (as given by time.monotonic), as for webcamStream.
+        self.frame = None
+        self.sequence = 0
+        self.timestamp = None
+        # Initialize the replay: the index of the next frame of the recording, the number of played frames and the start time.
+        self.index = 0
+        self.nb_played = 0
+        self.start_time = None
+        self.finished = False
+        # Initialize the cache.
+        self.frames = None
+        if cache_file is not None:
+            self._loadCache()
+
+
+    def _sourceKey(self):
+        """
+        Returns a description of the recording (files, modification times and
+        sizes) which changes when the recording changes.
+        """
+        raise NotImplementedError
+
+
+    def _rewind(self):
+        """
+        Restarts the decoding at the beginning of the recording.
+        """
+        raise NotImplementedError
+
+
+    def _readSource(self, nb_skipped = 0):
+        """
+        Skips frames of the recording, and decodes the next one.
+
+        :param nb_skipped: The number of frames to skip.
+        :return: The frame, or None at the end of the recording.
+        """
+        raise NotImplementedError
+
+
+    def _loadCache(self):
+        """
+        Maps the cache of decoded frames, after decoding the recording into the
+        cache if it does not correspond to the recording.
+        """
+        key = self._sourceKey()
+        # Read the description of the cache, ignoring an invalid one.
+        info = None
+        if os.path.isfile(self.cache_file + '.json') and os.path.isfile(self.cache_file + '.frames'):
+            try:
+                with open(self.cache_file + '.json') as file:
+                    info = json.load(file)
+            except ValueError:
+                info = None
+        # Decode all the frames into the cache.
+        if info is None or info.get('key') != key:
+            self._rewind()
+            shape = None
+            nb_frames = 0
+            with open(self.cache_file + '.frames.tmp', 'wb') as file:
+                frame = self._readSource()
+                while frame is not None:
+                    if shape is None:
+                        shape = list(frame.shape)
+                    elif list(frame.shape) != shape:
+                        raise ValueError('All the frames of a cached recording must have the same shape')
+                    file.write(np.ascontiguousarray(frame, dtype = np.uint8).tobytes())
+                    nb_frames += 1
+                    frame = self._readSource()
+            info = {'key': key, 'shape': shape, 'nb_frames': nb_frames}
+            os.replace(self.cache_file + '.frames.tmp', self.cache_file + '.frames')
+            with open(self.cache_file + '.json.tmp', 'w') as file:
+                json.dump(info, file)
+            os.replace(self.cache_file + '.json.tmp', self.cache_file + '.json')
+            self._rewind()
+        if info['nb_frames'] > 0:
+            self.frames = np.memmap(self.cache_file + '.frames', dtype = np.uint8, mode = 'r', shape = tuple([info['nb_frames']] + info['shape']))
+        else:
+            self.frames = np.zeros((0, 1, 1, 3), dtype = np.uint8)
+
+
+    def _nextFrame(self, nb_skipped):
+        """
+        Skips frames of the recording, and returns the next one, looping if needed.
+
+        :param nb_skipped: The number of frames to skip.
+        :return: The frame, or None at the end of the recording.
+        """
+        # Serve the frames from the cache.
+        if self.frames is not None:
+            index = self.index + nb_skipped
+            if index >= len(self.frames):
+                if not self.loop or len(self.frames) == 0:
+                    return None
+                index %= len(self.frames)
+            self.index = index + 1
+            return self.frames[index]
+        # Decode the frames.
+        frame = self._readSource(nb_skipped)
+        if frame is None and self.loop:
+            self._rewind()
+            frame = self._readSource()
+        return frame
+
+
+    def close(self):
+        """
+        Closes the process of the stream.
+        """
+        self.frames = None
+
+
+    def getFrame(self, newer_than = 0, timeout = None):
+        """
+        Returns the next frame of the recording, along with its sequence number
+        and its timestamp.
+
+        :param newer_than: Unused, the returned frame is always a new frame.
+        :param timeout: Unused, the waiting time is given by the frame rate.
+        :return: A tuple (sequence, timestamp, frame), with frame None at the end of the recording.
+        """
+        if self.finished:
+            return (self.sequence, self.timestamp, None)
+        # Compute the number of frames to drop, and wait for the next frame if we are ahead.
+        nb_skipped = 0
+        if self.realtime:
+            now = time.monotonic()
+            if self.start_time is None:
+                self.start_time = now
+            nb_expected = int((now - self.start_time) * self.fps)
+            if nb_expected < self.nb_played:
+                time.sleep(self.start_time + self.nb_played / self.fps - now)
+            nb_skipped = max(nb_expected - self.nb_played, 0)
+        frame = self._nextFrame(nb_skipped)
+        if frame is None:
+            self.finished = True
+            return (self.sequence, self.timestamp, None)
+        self.nb_played += nb_skipped + 1
+        self.frame = frame
+        self.sequence += 1
+        self.timestamp = time.monotonic()
+        return (self.sequence, self.timestamp, frame)
+
+
+    def getCurrentFrame(self):
+        """
+        Returns the current frame of the stream, as np.array.
+        """
+        sequence, timestamp, frame = self.getFrame()
+        # Cached frames are read-only, and the caller may draw on the frame.
+        if frame is not None and self.frames is not None:
+            frame = frame.copy()
+        return frame
+
+
+class videoFileStream(replayStream):
+    """
+    This class implements the replay of a video file (see replayStream).
+    """
+    def __init__(self, file_name, realtime = True, loop = False, cache_file = None, fps = None):
+        """
+        Initialization of the class.
+
+        :param file_name: The video file.
+        :param realtime: Whether to pace the frames at the frame rate of the video.
+        :param loop: Whether to replay the video indefinitely.
+        :param cache_file: The prefix of the files of the cache of decoded frames. By default, frames are decoded as they are read.
+        :param fps: The frame rate of the replay. By default, the frame rate of the video.
+        """
+        self.file_name = file_name
+        self.video_capture = cv2.VideoCapture(file_name)
+        if not self.video_capture.isOpened():
+            raise IOError('Cannot read video ' + file_name)
+        if fps is None:
+            fps = self.video_capture.get(cv2.CAP_PROP_FPS) or 30.0
+        replayStream.__init__(self, fps, realtime, loop, cache_file)
+
+
+    def _sourceKey(self):
+        """
+        Returns a description of the video file.
+        """
+        status = os.stat(self.file_name)
+        return [os.path.abspath(self.file_name), status.st_mtime_ns, status.st_size]
+
+
+    def _rewind(self):
+        """
+        Restarts the decoding at the beginning of the video.
+        """
+        self.video_capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+
+    def _readSource(self, nb_skipped = 0):
+        """
+        Skips frames of the video without decoding them, and decodes the next one.
+        """
+        for i in range(nb_skipped):
+            if not self.video_capture.grab():
+                return None
+        ret, frame = self.video_capture.read()
+        return frame if ret else None
+
+
+    def close(self):
+        """
+        Closes the process of the stream.
+        """
+        replayStream.close(self)
+        self.video_capture.release()
+
+
+class imageDirectoryStream(replayStream):
+    """
+    This class implements the replay of a directory of images, in the order of
+    their file names (see replayStream).
+    """
+    def __init__(self, folder_name, fps = 30.0, realtime = True, loop = False, cache_file = None, extensions = ('.jpg', '.jpeg', '.png', '.bmp')):
+        """
+        Initialization of the class.
+
+        :param folder_name: The directory of images.
+        :param fps: The frame rate of the replay.
+        :param realtime: Whether to pace the frames at the given frame rate.
+        :param loop: Whether to replay the images indefinitely.
+        :param cache_file: The prefix of the files of the cache of decoded frames. By default, frames are decoded as they are read.
+        :param extensions: The extensions of the replayed files.
+        """
+        self.folder_name = folder_name
+        self.file_names = sorted(name for name in os.listdir(folder_name) if name.lower().endswith(extensions))
+        self.position = 0
+        replayStream.__init__(self, fps, realtime, loop, cache_file)
+
+
+    def _sourceKey(self):
+        """
+        Returns a description of the images of the directory.
+        """
+        key = [os.path.abspath(self.folder_name)]
+        for name in self.file_names:
+            status = os.stat(os.path.join(self.folder_name, name))
+            key.append([name, status.st_mtime_ns, status.st_size])
+        return key
+
+
+    def _rewind(self):
+        """
+        Restarts the decoding at the first image.
+        """
+        self.position = 0
+
+
+    def _readSource(self, nb_skipped = 0):
+        """
+        Skips images, and reads the next one.
+        """
+        self.position += nb_skipped
+        if self.position >= len(self.file_names):
+            return None
+        file_name = os.path.join(self.folder_name, self.file_names[self.position])
+        frame = cv2.imread(file_name)
+        if frame is None:
+            raise IOError('Cannot read image ' + file_name)
+        self.position += 1
+        return frame